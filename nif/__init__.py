@@ -1,18 +1,67 @@
 from .__about__ import __version__
 
-import tensorflow as tf
-from tensorflow.keras import mixed_precision
+import importlib
 
-from .model import NIFMultiScale, NIF, NIFMultiScaleLastLayerParameterized, PNIF
+# everything is imported on first access, so that, e.g., `nif.demo`, `nif.runtime` or
+# `nif.ShapeNetWeightLayout` can be used without importing tensorflow
+_lazy_attributes = {
+    "NIFMultiScale": ".model",
+    "NIFMultiScaleLastLayerParameterized": ".model",
+    "NIF": ".model",
+    "PNIF": ".model",
+    "NIFCompact": ".model",
+    "NIFInference": ".inference",
+    "ShapeNetWeightLayout": ".layout",
+    "mixed_precision": "tensorflow.keras",
+}
+_lazy_submodules = ["model", "layers", "layout", "inference", "optimizers", "demo", "pruning", "quantization",
+                    "export", "runtime", "distributed", "benchmarks"]
+
+
+def __getattr__(name):
+    if name == "tf":
+        value = importlib.import_module("tensorflow")
+    elif name in _lazy_submodules:
+        value = importlib.import_module("." + name, __name__)
+    elif name in _lazy_attributes:
+        value = getattr(importlib.import_module(_lazy_attributes[name], __name__), name)
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__))
+
+
+def configure_devices(memory_growth=True, verbose=True, n_cpu_devices=None):
+    """
+    configure the GPUs for tensorflow, it has to be called before any tensor is created.
+
+    Args:
+        memory_growth: allocate GPU memory as needed instead of all of it at once.
+        verbose: print the number of physical and logical GPUs.
+        n_cpu_devices: split the CPU into this many logical devices, e.g., to run a model sharded
+            over devices (`cfg_parameter_net['head_devices']`) on a CPU-only machine.
+
+    Returns:
+        the list of physical GPUs
+    """
+    import tensorflow as tf
+    if n_cpu_devices is not None:
+        cpu = tf.config.list_physical_devices('CPU')[0]
+        tf.config.set_logical_device_configuration(cpu, [tf.config.LogicalDeviceConfiguration()]*n_cpu_devices)
+    gpus = tf.config.experimental.list_physical_devices('GPU')
+    if len(gpus) > 0:
+        # Currently, memory growth needs to be the same across GPUs
+        for gpu in gpus:
+            tf.config.experimental.set_memory_growth(gpu, memory_growth)
+        logical_gpus = tf.config.experimental.list_logical_devices('GPU')
+        if verbose:
+            print(len(gpus), "Physical GPUs,", len(logical_gpus), "Logical GPUs")
+    return gpus
 
-gpus = tf.config.experimental.list_physical_devices('GPU')
-if len(gpus) > 0:
-    # Currently, memory growth needs to be the same across GPUs
-    for gpu in gpus:
-        tf.config.experimental.set_memory_growth(gpu, True)
-    logical_gpus = tf.config.experimental.list_physical_devices('GPU')
-    # logical_gpus = tf.config.list_logical_devices('GPU')
-    print(len(gpus), "Physical GPUs,", len(logical_gpus), "Logical GPUs")
 
 __all__ = [
     "tf",
@@ -21,6 +70,15 @@ __all__ = [
     "NIF",
     "mixed_precision",
     "optimizers",
-    "demo", 
-    "PNIF"
-]
\ No newline at end of file
+    "demo",
+    "pruning",
+    "quantization",
+    "export",
+    "runtime",
+    "distributed",
+    "PNIF",
+    "NIFCompact",
+    "NIFInference",
+    "ShapeNetWeightLayout",
+    "configure_devices"
+]
@@ -0,0 +1,19 @@
+from .throughput import benchmark_case, benchmark_case_isolated, run_grid, compare_to_baseline, make_model
+from .throughput import synthetic_batch, save_results, load_results, DATASETS, VARIANTS
+from .scaling import run_scaling
+from .convergence import compare_optimizers
+
+__all__ = [
+    "benchmark_case",
+    "benchmark_case_isolated",
+    "run_grid",
+    "compare_to_baseline",
+    "make_model",
+    "synthetic_batch",
+    "save_results",
+    "load_results",
+    "run_scaling",
+    "compare_optimizers",
+    "DATASETS",
+    "VARIANTS"
+]
@@ -0,0 +1,60 @@
+"""
+throughput benchmark of NIF models, e.g.,
+
+    python -m nif.benchmarks --variants nif nif_multiscale --units 30 64 --batch-sizes 512 4096 \
+        --output bench.json --baseline baseline.json
+
+exits with 1 if any case is slower than `--tolerance` w.r.t. the baseline.
+
+`--mixed-policy mixed_bfloat16` (or `mixed_float16`) benchmarks mixed precision. Each case runs in its
+own process, so `peak_rss_mb` and `case_rss_mb` (the memory added by the case) are per case,
+`--in-process` runs them all in this process, which is faster but only times them.
+"""
+import argparse
+import sys
+
+from .. import configure_devices
+from .throughput import run_grid, compare_to_baseline, save_results, load_results, DATASETS, VARIANTS, PHASES
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m nif.benchmarks',
+                                     description='forward/backward/train_step throughput of NIF models')
+    parser.add_argument('--variants', nargs='+', default=VARIANTS, choices=VARIANTS)
+    parser.add_argument('--datasets', nargs='+', default=list(DATASETS.keys()), choices=list(DATASETS.keys()))
+    parser.add_argument('--units', nargs='+', type=int, default=[30])
+    parser.add_argument('--nlayers', nargs='+', type=int, default=[2])
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[512])
+    parser.add_argument('--points-per-snapshot', nargs='+', type=int, default=[1, 200],
+                        help='points sharing one parameter in a batch')
+    parser.add_argument('--phases', nargs='+', default=PHASES, choices=PHASES)
+    parser.add_argument('--n-iters', type=int, default=20)
+    parser.add_argument('--group-by-parameter', action='store_true')
+    parser.add_argument('--mixed-policy', default='float32',
+                        choices=['float32', 'mixed_float16', 'mixed_bfloat16'])
+    parser.add_argument('--in-process', action='store_true',
+                        help='do not run each case in its own process, the memory is then not per case')
+    parser.add_argument('--output', default=None, help='write the results as json')
+    parser.add_argument('--baseline', default=None, help='json written by a previous run with --output')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative drop of points/sec')
+    args = parser.parse_args(argv)
+
+    results = run_grid(args.variants, args.datasets, args.units, args.nlayers, args.batch_sizes,
+                       args.points_per_snapshot, args.n_iters, args.phases, isolate=not args.in_process,
+                       group_by_parameter=args.group_by_parameter, mixed_policy=args.mixed_policy)
+    if args.output is not None:
+        save_results(results, args.output)
+
+    if args.baseline is not None:
+        regressions = compare_to_baseline(results, load_results(args.baseline), args.tolerance, args.phases)
+        for r in regressions:
+            print("REGRESSION {case} {phase}: {points_per_sec:.0f} points/sec, "
+                  "baseline {baseline_points_per_sec:.0f} ({ratio:.2f}x)".format(**r))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    configure_devices(verbose=False)
+    sys.exit(main())
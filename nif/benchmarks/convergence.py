@@ -0,0 +1,135 @@
+"""
+convergence speed of the optimizers of `nif.optimizers` against Adam on `TravelingWave`, e.g.,
+
+    python -m nif.benchmarks.convergence --optimizers adam adabelief l4adam --epochs 2000 --output convergence.json
+
+trains the tutorial NIF with each optimizer (same random seed) and reports the loss curve, the
+wall time and the number of epochs to reach a target loss.
+"""
+import argparse
+import json
+import sys
+import time
+import numpy as np
+
+# default learning rates: the one of the TravelingWave tutorial for Adam and AdaBelief, and
+# the fraction of the loss gap recommended by the L4 paper for L4Adam
+LEARNING_RATES = {'adam': 5e-3, 'adabelief': 5e-3, 'l4adam': 0.15}
+
+OPTIMIZERS = list(LEARNING_RATES.keys())
+
+
+def make_optimizer(name, learning_rate=None):
+    import tensorflow as tf
+    from ..optimizers import AdaBeliefOptimizer, L4Adam
+    learning_rate = LEARNING_RATES[name] if learning_rate is None else learning_rate
+    if name == 'adam':
+        return tf.keras.optimizers.Adam(learning_rate)
+    if name == 'adabelief':
+        return AdaBeliefOptimizer(learning_rate, print_change_log=False)
+    if name == 'l4adam':
+        return L4Adam(learning_rate)
+    raise ValueError("unknown optimizer {}, it can only be one of {}".format(name, OPTIMIZERS))
+
+
+def make_traveling_wave_model(units=30, nlayers=2):
+    """the NIF of the TravelingWave tutorial"""
+    from ..model import NIF
+    cfg_shape_net = {
+        "use_resblock": False,
+        "connectivity": 'full',
+        "input_dim": 1,
+        "output_dim": 1,
+        "units": units,
+        "nlayers": nlayers,
+        "activation": 'swish'
+    }
+    cfg_parameter_net = {
+        "use_resblock": False,
+        "input_dim": 1,
+        "latent_dim": 1,
+        "units": units,
+        "nlayers": nlayers,
+        "activation": 'swish'
+    }
+    return NIF(cfg_shape_net, cfg_parameter_net)
+
+
+def convergence_case(name, learning_rate=None, epochs=2000, batch_size=512, units=30, nlayers=2, seed=0,
+                     target_loss=1e-2):
+    import tensorflow as tf
+    from ..demo import TravelingWave
+    data = TravelingWave().data
+    tf.random.set_seed(seed)
+    model = make_traveling_wave_model(units, nlayers)
+    model.compile(make_optimizer(name, learning_rate), tf.keras.losses.MeanSquaredError())
+    t0 = time.perf_counter()
+    history = model.fit(data[:, :2], data[:, 2:3], batch_size=batch_size, epochs=epochs, shuffle=True, verbose=0)
+    wall_time = time.perf_counter() - t0
+    losses = [float(l) for l in history.history['loss']]
+    finite = [l for l in losses if np.isfinite(l)]
+    reached = [i + 1 for i, l in enumerate(losses) if l <= target_loss]
+    return {'optimizer': name,
+            'learning_rate': LEARNING_RATES[name] if learning_rate is None else learning_rate,
+            'seed': seed,
+            'epochs': epochs,
+            'batch_size': batch_size,
+            'wall_time': wall_time,
+            'final_loss': losses[-1],
+            'best_loss': min(finite) if finite else float('nan'),
+            'target_loss': target_loss,
+            'epochs_to_target': reached[0] if reached else None,
+            'losses': losses}
+
+
+def compare_optimizers(optimizers=OPTIMIZERS, learning_rates=None, epochs=2000, batch_size=512, units=30, nlayers=2,
+                       seeds=(0,), target_loss=1e-2, verbose=True):
+    """
+    train the TravelingWave NIF with each of `optimizers` (and each of `seeds`) with the same random seed.
+
+    Args:
+        learning_rates: dict of the learning rate of an optimizer, `LEARNING_RATES` by default.
+
+    Returns:
+        a list of results, each with the loss of every epoch in `losses`
+    """
+    learning_rates = {} if learning_rates is None else learning_rates
+    results = []
+    for seed in seeds:
+        for name in optimizers:
+            result = convergence_case(name, learning_rates.get(name), epochs, batch_size, units, nlayers, seed,
+                                      target_loss)
+            if verbose:
+                print("{optimizer} (lr={learning_rate:g}, seed={seed}): final loss {final_loss:.3e}, "
+                      "best {best_loss:.3e}, {epochs_to_target} epochs to {target_loss:g}, "
+                      "{wall_time:.1f}s".format(**result))
+            results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m nif.benchmarks.convergence',
+                                     description='convergence speed of the optimizers on TravelingWave')
+    parser.add_argument('--optimizers', nargs='+', default=OPTIMIZERS, choices=OPTIMIZERS)
+    parser.add_argument('--lr', nargs='+', default=[], metavar='NAME=LR',
+                        help='learning rate of an optimizer, e.g., l4adam=0.05')
+    parser.add_argument('--epochs', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--units', type=int, default=30)
+    parser.add_argument('--nlayers', type=int, default=2)
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0])
+    parser.add_argument('--target-loss', type=float, default=1e-2)
+    parser.add_argument('--output', default=None, help='write the results as json')
+    args = parser.parse_args(argv)
+
+    learning_rates = {name: float(lr) for name, lr in (s.split('=') for s in args.lr)}
+    results = compare_optimizers(args.optimizers, learning_rates, args.epochs, args.batch_size, args.units,
+                                 args.nlayers, args.seeds, args.target_loss)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+data-parallel scaling benchmark of `NIF.train_step` over local worker processes (see `nif.distributed`), e.g.,
+
+    python -m nif.benchmarks.scaling --workers 1 2 4 8 --variant nif --units 64 --output scaling.json
+
+reports the global training points/sec of `fit` for each number of workers.
+"""
+import argparse
+import json
+import sys
+import time
+import numpy as np
+
+from ..distributed import run_local_workers
+from .throughput import DATASETS, VARIANTS
+
+
+def synthetic_point_wise_data(dataset, n_snapshots, n_points, seed=0):
+    """a normalized `PointWiseData` of `n_snapshots` random snapshots of `n_points` points"""
+    from ..demo import PointWiseData
+    dims = DATASETS[dataset]
+    rng = np.random.default_rng(seed)
+    p = np.repeat(rng.uniform(-1, 1, (n_snapshots, dims['pi_dim'])), n_points, axis=0)
+    x = rng.uniform(-1, 1, (n_snapshots*n_points, dims['si_dim']))
+    u = np.sin(np.sum(x, axis=-1, keepdims=True) + p[:, :1]) + np.zeros((1, dims['so_dim']))
+    data = PointWiseData(p, x, u)
+    data.normalize()
+    return data
+
+
+def scaling_worker(strategy, worker_index, n_workers, variant, dataset, units, nlayers, n_snapshots, n_points,
+                   snapshots_per_batch, points_per_snapshot, n_steps, n_warmup_steps=5):
+    import tensorflow as tf
+    from .throughput import make_model
+    data = synthetic_point_wise_data(dataset, n_snapshots, n_points)
+    with strategy.scope():
+        model = make_model(variant, dataset, units, nlayers)
+        model.compile(tf.keras.optimizers.Adam(1e-4), tf.keras.losses.MeanSquaredError())
+    # `fit` splits each batch of a worker between all the replicas, so each worker batches `n_workers` times
+    # the snapshots it trains on per step
+    train_dataset = data.snapshot_dataset(n_workers*snapshots_per_batch, points_per_snapshot, seed=worker_index,
+                                          num_shards=n_workers, shard_index=worker_index, repeat=True)
+    # tracing and the first collectives are not timed
+    model.fit(train_dataset, epochs=1, steps_per_epoch=n_warmup_steps, verbose=0)
+    t0 = time.perf_counter()
+    model.fit(train_dataset, epochs=1, steps_per_epoch=n_steps, verbose=0)
+    return time.perf_counter() - t0
+
+
+def run_scaling(worker_counts=(1, 2, 4, 8), variant='nif', dataset='cylinder_flow', units=30, nlayers=2,
+                n_snapshots=64, n_points=4096, snapshots_per_batch=4, points_per_snapshot=256, n_steps=50,
+                threads_per_worker=None, verbose=True):
+    """
+    train on `n_workers` local workers for each of `worker_counts`, each worker trains on
+    `snapshots_per_batch*points_per_snapshot` points of its shard of the snapshots per step, i.e., the global
+    batch grows with the number of workers (weak scaling).
+
+    Returns:
+        a list of results, `points_per_sec` is the global number of points trained on per second
+    """
+    results = []
+    for n_workers in worker_counts:
+        times = run_local_workers(scaling_worker, n_workers,
+                                  args=(variant, dataset, units, nlayers, n_snapshots, n_points,
+                                        snapshots_per_batch, points_per_snapshot, n_steps),
+                                  threads_per_worker=threads_per_worker)
+        step_time = max(times)/n_steps
+        points_per_step = n_workers*snapshots_per_batch*points_per_snapshot
+        result = {'n_workers': n_workers,
+                  'variant': variant,
+                  'dataset': dataset,
+                  'units': units,
+                  'nlayers': nlayers,
+                  'points_per_worker_step': snapshots_per_batch*points_per_snapshot,
+                  'step_time': step_time,
+                  'points_per_sec': points_per_step/step_time}
+        result['speedup'] = result['points_per_sec']/results[0]['points_per_sec'] if results else 1.
+        if verbose:
+            print("{n_workers} workers: {points_per_sec:.0f} points/sec, {speedup:.2f}x".format(**result))
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m nif.benchmarks.scaling',
+                                     description='data-parallel scaling of NIF training over local workers')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--variant', default='nif', choices=VARIANTS)
+    parser.add_argument('--dataset', default='cylinder_flow', choices=list(DATASETS.keys()))
+    parser.add_argument('--units', type=int, default=30)
+    parser.add_argument('--nlayers', type=int, default=2)
+    parser.add_argument('--n-snapshots', type=int, default=64)
+    parser.add_argument('--n-points', type=int, default=4096, help='points per snapshot in the data')
+    parser.add_argument('--snapshots-per-batch', type=int, default=4)
+    parser.add_argument('--points-per-snapshot', type=int, default=256, help='points per snapshot in a batch')
+    parser.add_argument('--n-steps', type=int, default=50)
+    parser.add_argument('--threads-per-worker', type=int, default=None)
+    parser.add_argument('--output', default=None, help='write the results as json')
+    args = parser.parse_args(argv)
+
+    results = run_scaling(args.workers, args.variant, args.dataset, args.units, args.nlayers, args.n_snapshots,
+                          args.n_points, args.snapshots_per_batch, args.points_per_snapshot, args.n_steps,
+                          args.threads_per_worker)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+import json
+import multiprocessing
+import queue
+import resource
+import time
+import traceback
+import numpy as np
+import tensorflow as tf
+
+from .. import configure_devices
+from ..model import NIF, NIFMultiScale, NIFMultiScaleLastLayerParameterized
+
+# dimensions of the demo datasets, synthetic data of the same shape is used for benchmarking
+DATASETS = {
+    'traveling_wave': {'pi_dim': 1, 'si_dim': 1, 'so_dim': 1},
+    'cylinder_flow': {'pi_dim': 1, 'si_dim': 2, 'so_dim': 2},
+}
+
+VARIANTS = ['nif', 'nif_multiscale', 'nif_multiscale_resblock', 'nif_multiscale_last_layer']
+
+PHASES = ['forward', 'backward', 'train_step']
+
+
+def make_model(variant, dataset, units, nlayers, latent_dim=2, **model_kwargs):
+    dims = DATASETS[dataset]
+    cfg_shape_net = {
+        "connectivity": 'full',
+        "input_dim": dims['si_dim'],
+        "output_dim": dims['so_dim'],
+        "units": units,
+        "nlayers": nlayers,
+        "activation": 'swish'
+    }
+    cfg_parameter_net = {
+        "input_dim": dims['pi_dim'],
+        "latent_dim": latent_dim,
+        "units": units,
+        "nlayers": nlayers,
+        "activation": 'swish'
+    }
+    if variant == 'nif':
+        return NIF(cfg_shape_net, cfg_parameter_net, **model_kwargs)
+
+    cfg_shape_net.update({"use_resblock": variant == 'nif_multiscale_resblock',
+                          "omega_0": 30.,
+                          "weight_init_factor": 0.01})
+    cfg_parameter_net.update({"use_resblock": False})
+    if variant in ['nif_multiscale', 'nif_multiscale_resblock']:
+        return NIFMultiScale(cfg_shape_net, cfg_parameter_net, **model_kwargs)
+    if variant == 'nif_multiscale_last_layer':
+        cfg_shape_net['connectivity'] = 'last_layer'
+        return NIFMultiScaleLastLayerParameterized(cfg_shape_net, cfg_parameter_net, **model_kwargs)
+    raise ValueError("unknown variant {}, it can only be one of {}".format(variant, VARIANTS))
+
+
+def synthetic_batch(dataset, batch_size, points_per_snapshot, seed=0):
+    """a batch of `batch_size` points, in snapshots of `points_per_snapshot` points sharing a parameter"""
+    dims = DATASETS[dataset]
+    rng = np.random.default_rng(seed)
+    n_snapshots = -(-batch_size // points_per_snapshot)
+    p = np.repeat(rng.uniform(-1, 1, (n_snapshots, dims['pi_dim'])), points_per_snapshot, axis=0)[:batch_size]
+    x = rng.uniform(-1, 1, (batch_size, dims['si_dim']))
+    u = rng.uniform(-1, 1, (batch_size, dims['so_dim']))
+    return tf.constant(np.hstack([p, x]), tf.float32), tf.constant(u, tf.float32)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux, it is the peak of the whole process so far, so it never goes down,
+    # see `benchmark_case_isolated`
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def time_function(fn, n_iters):
+    """returns the time of the first call (tracing and compilation) and the mean time of the next `n_iters`"""
+    t0 = time.perf_counter()
+    _ = [t.numpy() for t in tf.nest.flatten(fn())]
+    compile_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        outputs = fn()
+    _ = [t.numpy() for t in tf.nest.flatten(outputs)]
+    return compile_time, (time.perf_counter() - t0)/n_iters
+
+
+def benchmark_case(variant, dataset, units, nlayers, batch_size, points_per_snapshot, n_iters=20,
+                   phases=PHASES, **model_kwargs):
+    """
+    time the `phases` of a model on a synthetic batch. `peak_rss_mb` is the peak of the process and
+    `case_rss_mb` what this case added to it, i.e., they only measure this case in a fresh process.
+    """
+    rss_before = peak_rss_mb()
+    model = make_model(variant, dataset, units, nlayers, **model_kwargs)
+    model.compile(tf.keras.optimizers.Adam(1e-4), tf.keras.losses.MeanSquaredError())
+    x, y = synthetic_batch(dataset, batch_size, points_per_snapshot)
+    # build the variables before any timing
+    model(x)
+
+    @tf.function
+    def forward():
+        return model(x, training=False)
+
+    @tf.function
+    def backward():
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.square(model(x, training=True) - y))
+        return tape.gradient(loss, model.trainable_variables)
+
+    @tf.function
+    def train_step():
+        return model.train_step((x, y))
+
+    functions = {'forward': forward, 'backward': backward, 'train_step': train_step}
+    result = {'variant': variant,
+              'dataset': dataset,
+              'units': units,
+              'nlayers': nlayers,
+              'batch_size': batch_size,
+              'points_per_snapshot': points_per_snapshot,
+              'mixed_policy': model.mixed_policy.name,
+              'n_parameters': int(sum(np.prod(v.shape) for v in model.trainable_variables))}
+    for phase in phases:
+        compile_time, step_time = time_function(functions[phase], n_iters)
+        result[phase] = {'compile_time': compile_time,
+                         'step_time': step_time,
+                         'points_per_sec': batch_size/step_time}
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['case_rss_mb'] = result['peak_rss_mb'] - rss_before
+    return result
+
+
+def _benchmark_case_main(results, args, kwargs):
+    try:
+        configure_devices(verbose=False)
+        results.put((benchmark_case(*args, **kwargs), None))
+    except Exception:
+        results.put((None, traceback.format_exc()))
+
+
+def benchmark_case_isolated(*args, **kwargs):
+    """
+    `benchmark_case` in a new ('spawn') process, so the memory of the previous cases does not
+    count, `case_rss_mb` is then the memory of the model, the batch and the compiled functions.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_benchmark_case_main, args=(results, args, kwargs))
+    process.start()
+    try:
+        while True:
+            try:
+                result, error = results.get(timeout=1.)
+                break
+            except queue.Empty:
+                if not process.is_alive() and results.empty():
+                    raise RuntimeError("the benchmark process exited with code {}".format(process.exitcode))
+    finally:
+        process.join()
+    if error is not None:
+        raise RuntimeError("benchmark case failed:\n{}".format(error))
+    return result
+
+
+def case_key(result):
+    key = "{variant}/{dataset}/units={units}/nlayers={nlayers}/batch={batch_size}/pps={points_per_snapshot}".format(
+        **result)
+    if result.get('mixed_policy', 'float32') != 'float32':
+        key += "/policy={}".format(result['mixed_policy'])
+    return key
+
+
+def run_grid(variants, datasets, units_list, nlayers_list, batch_sizes, points_per_snapshot_list, n_iters=20,
+             phases=PHASES, verbose=True, isolate=True, **model_kwargs):
+    """
+    benchmark every case of the grid, each in its own process with `isolate`, otherwise the memory
+    of the cases is not comparable (see `peak_rss_mb`).
+    """
+    run_case = benchmark_case_isolated if isolate else benchmark_case
+    results = []
+    for variant in variants:
+        for dataset in datasets:
+            for units in units_list:
+                for nlayers in nlayers_list:
+                    for batch_size in batch_sizes:
+                        for points_per_snapshot in points_per_snapshot_list:
+                            result = run_case(variant, dataset, units, nlayers, batch_size,
+                                              points_per_snapshot, n_iters, phases, **model_kwargs)
+                            if verbose:
+                                print(case_key(result), ', '.join(
+                                    '{}: {:.0f} points/sec'.format(phase, result[phase]['points_per_sec'])
+                                    for phase in phases))
+                            results.append(result)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1, phases=PHASES):
+    """
+    returns the cases whose points/sec dropped by more than `tolerance` (relative) w.r.t. `baseline`.
+    cases missing from the baseline are skipped.
+    """
+    baseline = {case_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        key = case_key(result)
+        if key not in baseline:
+            continue
+        for phase in phases:
+            if phase not in result or phase not in baseline[key]:
+                continue
+            new, old = result[phase]['points_per_sec'], baseline[key][phase]['points_per_sec']
+            if new < (1. - tolerance)*old:
+                regressions.append({'case': key, 'phase': phase, 'points_per_sec': new,
+                                    'baseline_points_per_sec': old, 'ratio': new/old})
+    return regressions
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump({'tensorflow': tf.__version__, 'results': results}, f, indent=2)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        return json.load(f)['results']
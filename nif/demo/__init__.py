@@ -2,10 +2,16 @@ from .traveling_wave import TravelingWave
 from .traveling_wave_high_freq import TravelingWaveHighFreq
 from .cylinderflow import CylinderFlow
 from .point_wise_data import PointWiseData
+from .scaler import Scaler
+from .columnar import convert_npz_to_columnar, load_columnar, write_columnar
 
 __all__ = [
     "TravelingWave",
     "TravelingWaveHighFreq",
     "CylinderFlow",
-    "PointWiseData"
+    "PointWiseData",
+    "Scaler",
+    "convert_npz_to_columnar",
+    "load_columnar",
+    "write_columnar"
 ]
\ No newline at end of file
@@ -0,0 +1,179 @@
+import json
+import os
+import struct
+import zipfile
+import numpy as np
+
+META_FILE = 'meta.json'
+OFFSETS_FILE = 'snapshot_offsets.npy'
+
+
+def _count_snapshots(parameter_data, chunk_size):
+    """
+    number the snapshots of `parameter_data` in the (lexicographic) order of their parameter, like
+    `np.unique(parameter_data, axis=0)`, reading `chunk_size` rows at a time.
+
+    returns a dict from the bytes of each unique parameter to its snapshot id, and the number of rows
+    of each snapshot, only the unique parameters are kept in memory.
+    """
+    rows, counts = {}, {}
+    for i in range(0, parameter_data.shape[0], chunk_size):
+        for row, n in zip(*np.unique(np.asarray(parameter_data[i:i + chunk_size]), axis=0, return_counts=True)):
+            key = row.tobytes()
+            rows.setdefault(key, row)
+            counts[key] = counts.get(key, 0) + n
+    unique = np.array(list(rows.values())).reshape(len(rows), parameter_data.shape[-1])
+    ids = np.empty(len(rows), dtype=np.int64)
+    ids[np.lexsort(unique.T[::-1])] = np.arange(len(rows))
+    snapshot_counts = np.zeros(len(rows), dtype=np.int64)
+    snapshot_counts[ids] = list(counts.values())
+    return dict(zip(rows.keys(), ids)), snapshot_counts
+
+
+def _snapshot_ids(parameter_chunk, snapshot_ids):
+    """the snapshot id of each row of `parameter_chunk`, see `_count_snapshots`"""
+    unique, inverse = np.unique(np.asarray(parameter_chunk), axis=0, return_inverse=True)
+    return np.array([snapshot_ids[row.tobytes()] for row in unique], dtype=np.int64)[inverse.ravel()]
+
+
+def write_columnar(out_dir, parameter_data, x_data, u_data, sample_weight=None, chunk_size=1000000):
+    """
+    write point-wise data into a columnar directory, one raw `.npy` file per column group.
+
+    rows are reordered such that each snapshot (points sharing the same parameter) is
+    contiguous, `snapshot_offsets.npy` holds the start row of each snapshot. Inputs can
+    be arrays or memmaps, they are read `chunk_size` rows at a time, so memory does not
+    depend on the number of rows.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    columns = {'parameter': parameter_data, 'x': x_data, 'u': u_data}
+    if sample_weight is not None:
+        columns['sample_weight'] = np.reshape(sample_weight, (-1, 1))
+    n_rows = parameter_data.shape[0]
+
+    snapshot_ids, counts = _count_snapshots(parameter_data, chunk_size)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    outs = {name: np.lib.format.open_memmap(os.path.join(out_dir, name + '.npy'), mode='w+',
+                                            dtype=column.dtype, shape=(n_rows, column.shape[-1]))
+            for name, column in columns.items()}
+    # next free row of each snapshot, rows keep their order within a snapshot
+    cursor = offsets[:-1].copy()
+    for i in range(0, n_rows, chunk_size):
+        ids = _snapshot_ids(parameter_data[i:i + chunk_size], snapshot_ids)
+        order = np.argsort(ids, kind='stable')
+        chunk_counts = np.bincount(ids, minlength=len(cursor))
+        chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+        rows = np.empty_like(ids)
+        rows[order] = cursor[ids[order]] + np.arange(len(ids)) - chunk_starts[ids[order]]
+        cursor += chunk_counts
+        for name, column in columns.items():
+            outs[name][rows] = column[i:i + chunk_size]
+    for out in outs.values():
+        out.flush()
+    del outs
+    np.save(os.path.join(out_dir, OFFSETS_FILE), offsets)
+
+    meta = {'n_rows': int(n_rows),
+            'n_p': int(parameter_data.shape[-1]),
+            'n_x': int(x_data.shape[-1]),
+            'n_o': int(u_data.shape[-1]),
+            'columns': list(columns.keys())}
+    with open(os.path.join(out_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def _open_npz_member(npz_path, name, scratch_path, chunk_size=1 << 26):
+    """
+    memory-map the array `name` of an `.npz` file without reading it into memory.
+
+    members of an uncompressed `.npz` (`np.savez`) are mapped in place, members of a compressed
+    one (`np.savez_compressed`) are first decompressed, `chunk_size` bytes at a time, into the
+    raw file `scratch_path`.
+    """
+    with zipfile.ZipFile(npz_path) as zf:
+        info = zf.getinfo(name + '.npy')
+        with zf.open(info) as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError("{} of {} holds python objects and can not be memory-mapped".format(name, npz_path))
+            header_size = f.tell()
+            order = 'F' if fortran_order else 'C'
+            if info.compress_type == zipfile.ZIP_STORED:
+                # the data starts after the local file header of the member, see the zip specification
+                with open(npz_path, 'rb') as raw:
+                    raw.seek(info.header_offset)
+                    local_header = raw.read(30)
+                n_name, n_extra = struct.unpack('<HH', local_header[26:30])
+                offset = info.header_offset + 30 + n_name + n_extra + header_size
+                return np.memmap(npz_path, dtype=dtype, mode='r', offset=offset, shape=shape, order=order)
+            out = np.memmap(scratch_path, dtype=np.uint8, mode='w+', shape=(int(np.prod(shape))*dtype.itemsize,))
+            for i in range(0, out.shape[0], chunk_size):
+                block = f.read(chunk_size)
+                out[i:i + len(block)] = np.frombuffer(block, dtype=np.uint8)
+            out.flush()
+            del out
+    return np.memmap(scratch_path, dtype=dtype, mode='r', shape=shape, order=order)
+
+
+def convert_npz_to_columnar(npz_path, out_dir, n_p, n_x, n_o, sample_weight=False, chunk_size=1000000):
+    """
+    convert the `.npz` files of `nif.demo`, which store `data` as `[parameter, x, u, (sample_weight)]`
+    columns, into the columnar format.
+
+    `data` is memory-mapped and copied `chunk_size` rows at a time, a compressed `.npz` is
+    decompressed into a temporary file in `out_dir` first.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    scratch_path = os.path.join(out_dir, 'data.npz.tmp')
+    data = _open_npz_member(npz_path, 'data', scratch_path)
+    try:
+        return write_columnar(out_dir,
+                              data[:, :n_p],
+                              data[:, n_p:n_p + n_x],
+                              data[:, n_p + n_x:n_p + n_x + n_o],
+                              data[:, -1] if sample_weight else None,
+                              chunk_size=chunk_size)
+    finally:
+        del data
+        if os.path.exists(scratch_path):
+            os.remove(scratch_path)
+
+
+def load_columnar(data_dir):
+    """
+    memory-map a columnar directory.
+
+    returns `(meta, columns, snapshot_offsets)` where `columns` maps each column group to a
+    read-only memmap, nothing is read into memory until it is indexed.
+    """
+    with open(os.path.join(data_dir, META_FILE), 'r') as f:
+        meta = json.load(f)
+    columns = {name: np.load(os.path.join(data_dir, name + '.npy'), mmap_mode='r') for name in meta['columns']}
+    offsets = np.load(os.path.join(data_dir, OFFSETS_FILE))
+    return meta, columns, offsets
+
+
+def iter_row_chunks(columns, chunk_size=1000000):
+    """yield `[chunk_size, n_columns]` float64 blocks of the horizontally stacked `columns`"""
+    n_rows = columns[0].shape[0]
+    for i in range(0, n_rows, chunk_size):
+        yield np.hstack([np.asarray(c[i:i + chunk_size], dtype=np.float64) for c in columns])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='convert a nif.demo .npz file into the columnar format')
+    parser.add_argument('npz_path')
+    parser.add_argument('out_dir')
+    parser.add_argument('--n-p', type=int, required=True)
+    parser.add_argument('--n-x', type=int, required=True)
+    parser.add_argument('--n-o', type=int, required=True)
+    parser.add_argument('--sample-weight', action='store_true')
+    args = parser.parse_args()
+    print(convert_npz_to_columnar(args.npz_path, args.out_dir, args.n_p, args.n_x, args.n_o, args.sample_weight))
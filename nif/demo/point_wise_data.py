@@ -1,16 +1,22 @@
+import os
 import numpy as np
+from .columnar import load_columnar, iter_row_chunks
+from .scaler import Scaler
 
 class PointWiseData(object):
     def __init__(self, parameter_data, x_data, u_data, sample_weight=None):
-        if sample_weight != None:
+        if sample_weight is not None:
             self.data_raw = np.hstack([parameter_data, x_data, u_data, sample_weight])
         else:
             self.data_raw = np.hstack([parameter_data, x_data, u_data])
         self.data = None
         self.sample_weight = None
+        self.scaler = None
         self.n_p = parameter_data.shape[-1]
         self.n_x = x_data.shape[-1]
         self.n_o = u_data.shape[-1]
+        self._snapshot_order = None
+        self._snapshot_offsets = None
 
     @property
     def parameter(self):
@@ -24,37 +30,271 @@ class PointWiseData(object):
     def u(self):
         return self.data[:,self.n_p+self.n_x:self.n_p+self.n_x+self.n_o]
 
+    @property
+    def snapshot_order(self):
+        """
+        row indices of the data, sorted such that rows of the same snapshot are contiguous.
+        `None` if the rows are already stored snapshot by snapshot, e.g., columnar data.
+        """
+        if self._snapshot_offsets is None:
+            self._build_snapshot_index()
+        return self._snapshot_order
+
+    @property
+    def snapshot_offsets(self):
+        """snapshot `i` is `snapshot_order[snapshot_offsets[i]:snapshot_offsets[i+1]]`"""
+        if self._snapshot_offsets is None:
+            self._build_snapshot_index()
+        return self._snapshot_offsets
+
+    @property
+    def n_snapshots(self):
+        return len(self.snapshot_offsets) - 1
+
+    def load_columnar(self, data_dir, normalization='standard', n_target=None, area_weighted=False,
+                      cache_path=None, dtype=np.float64, chunk_size=1000000):
+        """
+        initialize from a columnar directory (see `nif.demo.columnar`) without loading it into memory.
+
+        the raw columns are memory-mapped and `self.scaler` is fitted in a single streaming pass.
+        `self.data` and `self.sample_weight` normalize the rows as they are read, e.g., batch by batch
+        in `snapshot_dataset`, so nothing is written to `data_dir`.
+
+        Args:
+            cache_path: if given, the normalized data is also stored as a `.npy` memmap at this path
+                (or reused if it already exists with the same shape and dtype), which trades disk
+                space for not normalizing the rows at every read.
+            dtype: dtype of the normalized data, float64 like `normalize`.
+        """
+        meta, columns, offsets = load_columnar(data_dir)
+        self.n_p, self.n_x, self.n_o = meta['n_p'], meta['n_x'], meta['n_o']
+        self.columns = columns
+        self.data_raw = None
+        self._snapshot_order = None
+        self._snapshot_offsets = offsets
+
+        column_list = [columns[name] for name in meta['columns']]
+        n_target = self.n_o if n_target is None else n_target
+        self.scaler = Scaler(normalization, self.n_p, self.n_x, n_target, area_weighted)
+        self.scaler.fit(iter_row_chunks(column_list, chunk_size))
+        self.mean, self.std = self.scaler.mean, self.scaler.std
+
+        normalized = _NormalizedRows(column_list, self.scaler, dtype)
+        if cache_path is not None:
+            normalized = _normalized_cache(normalized, cache_path, chunk_size)
+
+        if area_weighted:
+            self.data, self.sample_weight = normalized[:, :-1], normalized[:, -1]
+        else:
+            self.data, self.sample_weight = normalized, None
+
+    def _build_snapshot_index(self):
+        # a snapshot is the set of points sharing the same parameter
+        _, inverse = np.unique(self.data_raw[:, :self.n_p], axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        self._snapshot_order = np.argsort(inverse, kind='stable')
+        self._snapshot_offsets = np.concatenate([[0], np.cumsum(np.bincount(inverse))])
+
+    def snapshot_dataset(self, n_snapshots_per_batch, n_points_per_snapshot, shuffle_snapshots=True,
+                         shuffle_points=True, seed=None, num_parallel_calls=None, prefetch=None,
+                         num_shards=1, shard_index=0, repeat=False):
+        """
+        build a `tf.data.Dataset` of snapshot-major batches that can be fed to NIF models directly.
+
+        each batch is `n_snapshots_per_batch` snapshots times `n_points_per_snapshot` points,
+        i.e., `x` is `[K, M, n_p + n_x]` and `u` is `[K, M, n_o]` (plus a `[K, M]` sample
+        weight if there is one). One epoch visits each point of each snapshot once, chunks
+        that are not full wrap around within the snapshot.
+
+        Only snapshot ids and point indices live in the pipeline, rows are gathered from
+        `self.data` batch by batch. In-memory data is gathered with tensorflow ops from a float32
+        copy, so the `num_parallel_calls` batches are gathered in parallel. Memory-mapped (columnar)
+        data is read with `tf.numpy_function` instead, so host memory stays bounded by the batch
+        size, but it holds the GIL: those batches are read one at a time whatever `num_parallel_calls`
+        is, and only `prefetch` overlaps the reading with training.
+
+        Args:
+            n_snapshots_per_batch: number of snapshots K in a batch.
+            n_points_per_snapshot: number of points M per snapshot in a batch.
+            shuffle_snapshots: shuffle the order of the snapshots every epoch.
+            shuffle_points: shuffle the points within each snapshot every epoch, otherwise
+                chunks are contiguous.
+            seed: random seed for the shuffling.
+            num_parallel_calls: parallelism of the chunking and gathering, default AUTOTUNE, see above
+                for memory-mapped data.
+            prefetch: number of batches to prefetch, default AUTOTUNE.
+            num_shards: split the snapshots into `num_shards` disjoint shards, e.g., one per worker
+                for data-parallel training (see `nif.distributed`).
+            shard_index: the shard of the snapshots in this dataset.
+            repeat: repeat the dataset indefinitely, so shards with different numbers of batches
+                can run the same number of steps (`steps_per_epoch` of `fit`).
+        """
+        import tensorflow as tf
+        autotune = tf.data.experimental.AUTOTUNE
+        num_parallel_calls = autotune if num_parallel_calls is None else num_parallel_calls
+        prefetch = autotune if prefetch is None else prefetch
+        n_batch_snapshots = n_snapshots_per_batch
+        n_batch_points = n_points_per_snapshot
+
+        offsets = tf.constant(self.snapshot_offsets, tf.int64)
+        order = self.snapshot_order
+        n_px = self.n_p + self.n_x
+        has_weight = self.sample_weight is not None
+
+        def point_chunks(s):
+            start = offsets[s]
+            n = offsets[s + 1] - start
+            local = tf.range(n)
+            if shuffle_points:
+                local = tf.random.shuffle(local, seed=seed)
+            # wrap around so the last chunk, or a snapshot with less than M points, is full
+            n_chunks = (n + n_batch_points - 1) // n_batch_points
+            local = tf.gather(local, tf.range(n_chunks*n_batch_points) % n)
+            return tf.data.Dataset.from_tensor_slices(tf.reshape(start + local, [-1, n_batch_points]))
+
+        def gather_rows(positions):
+            # sorted rows give contiguous reads, the order of points in a snapshot does not matter
+            rows = positions if order is None else np.sort(order[positions], axis=-1)
+            data = self.data[rows]
+            outputs = [data[..., :n_px].astype(np.float32),
+                       data[..., n_px:n_px + self.n_o].astype(np.float32)]
+            if has_weight:
+                outputs.append(np.asarray(self.sample_weight[rows]).astype(np.float32))
+            return outputs
+
+        in_memory = isinstance(self.data, np.ndarray) and not isinstance(self.data, np.memmap)
+        if in_memory:
+            data_tensor = tf.constant(self.data, tf.float32)
+            order_tensor = None if order is None else tf.constant(order, tf.int64)
+            weight_tensor = tf.constant(self.sample_weight, tf.float32) if has_weight else None
+
+        def gather_rows_in_memory(positions):
+            rows = positions if order is None else tf.sort(tf.gather(order_tensor, positions), axis=-1)
+            data = tf.gather(data_tensor, rows)
+            outputs = [data[..., :n_px], data[..., n_px:n_px + self.n_o]]
+            if has_weight:
+                outputs.append(tf.gather(weight_tensor, rows))
+            return outputs
+
+        def load_batch(positions):
+            if in_memory:
+                outputs = gather_rows_in_memory(positions)
+            else:
+                outputs = tf.numpy_function(gather_rows, [positions], [tf.float32]*(3 if has_weight else 2))
+            outputs[0].set_shape([n_batch_snapshots, n_batch_points, n_px])
+            outputs[1].set_shape([n_batch_snapshots, n_batch_points, self.n_o])
+            if has_weight:
+                outputs[2].set_shape([n_batch_snapshots, n_batch_points])
+            return tuple(outputs)
+
+        dataset = tf.data.Dataset.range(self.n_snapshots)
+        n_shard_snapshots = self.n_snapshots
+        if num_shards > 1:
+            dataset = dataset.shard(num_shards, shard_index)
+            n_shard_snapshots = len(range(shard_index, self.n_snapshots, num_shards))
+        if shuffle_snapshots:
+            dataset = dataset.shuffle(n_shard_snapshots, seed=seed, reshuffle_each_iteration=True)
+        # round-robin over K snapshots, so each batch holds chunks of K different snapshots
+        dataset = dataset.interleave(point_chunks, cycle_length=n_batch_snapshots, block_length=1,
+                                     num_parallel_calls=num_parallel_calls)
+        dataset = dataset.batch(n_batch_snapshots, drop_remainder=True)
+        dataset = dataset.map(load_batch, num_parallel_calls=num_parallel_calls)
+        if repeat:
+            dataset = dataset.repeat()
+        if num_shards > 1:
+            # the snapshots are already sharded, a distribution strategy must not shard them again
+            options = tf.data.Options()
+            options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+            dataset = dataset.with_options(options)
+        return dataset.prefetch(prefetch)
+
+    def normalize(self, normalization='standard', n_target=None, area_weighted=False):
+        """
+        fit `self.scaler` on `self.data_raw` and set the normalized `self.data`, `self.mean`,
+        `self.std` and, with `area_weighted`, `self.sample_weight`.
+        """
+        n_target = self.n_o if n_target is None else n_target
+        self.scaler = Scaler(normalization, self.n_p, self.n_x, n_target, area_weighted).fit(self.data_raw)
+        self.mean, self.std = self.scaler.mean, self.scaler.std
+        normalized_data = self.scaler.transform(self.data_raw)
+        if area_weighted:
+            self.data, self.sample_weight = normalized_data[:, :-1], normalized_data[:, -1]
+        else:
+            self.data = normalized_data
+
     @staticmethod
     def standard_normalize(raw_data, area_weighted=False):
-        mean = raw_data.mean(axis=0)
-        std = raw_data.std(axis=0)
+        scaler = Scaler('standard', area_weighted=area_weighted).fit(raw_data)
+        normalized_data = scaler.transform(raw_data)
         if area_weighted:
-            mean[-1] = 0.
-            std[-1] = np.mean(raw_data[:,-1])
-            normalized_data = (raw_data - mean)/std
-            return normalized_data[:,:-1], mean, std,normalized_data[:,-1]
+            return normalized_data[:,:-1], scaler.mean, scaler.std, normalized_data[:,-1]
         else:
-            normalized_data = (raw_data - mean)/std
-            return normalized_data, mean, std
+            return normalized_data, scaler.mean, scaler.std
 
     @staticmethod
     def minmax_normalize(raw_data, n_para, n_x, n_target, area_weighted=False):
-        mean = raw_data.mean(axis=0)
-        std = raw_data.std(axis=0)
-        for i in range(n_para + n_x):
-            mean[i] = 0.5*(np.min(raw_data[:,i])+np.max(raw_data[:,i]))
-            std[i] = 0.5*(-np.min(raw_data[:,i])+np.max(raw_data[:,i]))
-
-        # also we normalize the output target to make sure the maximal is most 1
-        for j in range(n_para + n_x, n_para + n_x + n_target):
-            std[j] = np.max(np.abs(raw_data[:,j]))
-
+        # parameter and x are mapped to [-1, 1], the output target is normalized such that its maximal is at most 1,
+        # for area, simply take the mean as std for normalize
+        scaler = Scaler('minmax', n_para, n_x, n_target, area_weighted).fit(raw_data)
+        normalized_data = scaler.transform(raw_data)
         if area_weighted:
-            # for area, simply take the mean as std for normalize
-            mean[-1] = 0.
-            std[-1] = np.mean(raw_data[:,-1])
-            normalized_data = (raw_data - mean)/std
-            return normalized_data[:,:-1], mean, std, normalized_data[:,-1]
+            return normalized_data[:,:-1], scaler.mean, scaler.std, normalized_data[:,-1]
         else:
-            normalized_data = (raw_data - mean)/std
-            return normalized_data, mean, std
\ No newline at end of file
+            return normalized_data, scaler.mean, scaler.std
+
+
+class _NormalizedRows(object):
+    """
+    read-only 2d view of the horizontally stacked raw `columns` (memmaps), normalized with `scaler`
+    when indexed, so only the rows (and columns) that are read are normalized and held in memory.
+    Slicing the columns, e.g., `rows[:, :-1]` or `rows[:, -1]`, gives another view, which only reads
+    the raw columns it needs, e.g., `rows[:, -1][index]` only reads the sample weight column.
+    """
+    def __init__(self, columns, scaler, dtype, column_index=None):
+        self.raw_columns = columns
+        self.scaler = scaler
+        self.dtype = np.dtype(dtype)
+        self.widths = np.array([c.shape[-1] for c in columns])
+        # raw column group of each column, and its position within the group
+        self.column_group = np.repeat(np.arange(len(columns)), self.widths)
+        self.column_offset = np.concatenate([np.arange(w) for w in self.widths])
+        n_columns = self.widths.sum()
+        self.column_index = np.arange(n_columns) if column_index is None else column_index
+        n_rows = columns[0].shape[0]
+        self.shape = (n_rows,) + np.shape(self.column_index)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        index = index if isinstance(index, tuple) else (index,)
+        rows = index[0]
+        column_index = self.column_index if len(index) == 1 else self.column_index[index[1]]
+        if len(index) > 1 and isinstance(rows, slice) and rows == slice(None):
+            # a view of some columns, nothing is read yet
+            return _NormalizedRows(self.raw_columns, self.scaler, self.dtype, column_index)
+        # only the raw column groups holding `column_index` are read
+        groups = np.unique(self.column_group[column_index])
+        group_start = np.zeros(len(self.raw_columns), dtype=np.int64)
+        group_start[groups] = np.cumsum(self.widths[groups]) - self.widths[groups]
+        raw = np.concatenate([np.asarray(self.raw_columns[g][rows], dtype=np.float64) for g in groups], axis=-1)
+        raw = raw[..., group_start[self.column_group[column_index]] + self.column_offset[column_index]]
+        return self.scaler.transform(raw, columns=column_index, out=raw).astype(self.dtype, copy=False)
+
+    def __array__(self, dtype=None):
+        rows = self[np.arange(self.shape[0])]
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
+
+def _normalized_cache(normalized, cache_path, chunk_size):
+    """the normalized rows as a memmap at `cache_path`, written chunk by chunk unless it already exists"""
+    if os.path.exists(cache_path):
+        cache = np.load(cache_path, mmap_mode='r')
+        if cache.shape == normalized.shape and cache.dtype == normalized.dtype:
+            return cache
+    cache = np.lib.format.open_memmap(cache_path, mode='w+', dtype=normalized.dtype, shape=normalized.shape)
+    for i in range(0, normalized.shape[0], chunk_size):
+        cache[i:i + chunk_size] = normalized[i:i + chunk_size]
+    cache.flush()
+    return np.load(cache_path, mmap_mode='r')
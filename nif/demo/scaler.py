@@ -0,0 +1,140 @@
+import json
+import numpy as np
+
+
+class Scaler(object):
+    """
+    column-wise normalization `(data - mean)/std` fitted in a single streaming pass.
+
+    `normalization` follows `PointWiseData`:
+        - 'standard': mean and std of each column.
+        - 'minmax': parameter and x columns are mapped to [-1, 1], the first `n_target`
+          target columns are divided by their max(abs), the rest is standardized.
+    with `area_weighted`, the last column is a sample weight and is only divided by its mean.
+
+    count, mean and variance of each chunk are merged with the parallel algorithm of Chan et al.,
+    together with min, max and max(abs), so `partial_fit` can be fed with chunks of any size
+    and only keeps a few vectors of state. The scaler can be saved as json next to a model
+    checkpoint and reloaded to denormalize model output without the training data.
+    """
+    def __init__(self, normalization='standard', n_para=0, n_x=0, n_target=0, area_weighted=False):
+        if normalization not in ['standard', 'minmax']:
+            raise ValueError("normalization can only be 'standard' or 'minmax'")
+        self.normalization = normalization
+        self.n_para = n_para
+        self.n_x = n_x
+        self.n_target = n_target
+        self.area_weighted = area_weighted
+        self.count = 0
+        self.col_mean = None
+        self.col_m2 = None
+        self.col_min = None
+        self.col_max = None
+        self.col_absmax = None
+
+    def partial_fit(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float64)
+        n_b = chunk.shape[0]
+        if n_b == 0:
+            return self
+        mean_b = chunk.mean(axis=0)
+        m2_b = ((chunk - mean_b)**2).sum(axis=0)
+        if self.count == 0:
+            self.count, self.col_mean, self.col_m2 = n_b, mean_b, m2_b
+            self.col_min, self.col_max = chunk.min(axis=0), chunk.max(axis=0)
+            self.col_absmax = np.abs(chunk).max(axis=0)
+            return self
+        delta = mean_b - self.col_mean
+        n_ab = self.count + n_b
+        self.col_mean = self.col_mean + delta*n_b/n_ab
+        self.col_m2 = self.col_m2 + m2_b + delta**2*self.count*n_b/n_ab
+        self.count = n_ab
+        self.col_min = np.minimum(self.col_min, chunk.min(axis=0))
+        self.col_max = np.maximum(self.col_max, chunk.max(axis=0))
+        self.col_absmax = np.maximum(self.col_absmax, np.abs(chunk).max(axis=0))
+        return self
+
+    def fit(self, data, chunk_size=1000000):
+        """`data` is an array (or memmap), read `chunk_size` rows at a time, or an iterable of chunks"""
+        chunks = data
+        if hasattr(data, 'shape'):
+            chunks = (data[i:i + chunk_size] for i in range(0, data.shape[0], chunk_size))
+        for chunk in chunks:
+            self.partial_fit(chunk)
+        return self
+
+    @property
+    def mean(self):
+        mean = self.col_mean.copy()
+        n_px = self.n_para + self.n_x
+        if self.normalization == 'minmax':
+            mean[:n_px] = 0.5*(self.col_min[:n_px] + self.col_max[:n_px])
+        if self.area_weighted:
+            mean[-1] = 0.
+        return mean
+
+    @property
+    def std(self):
+        std = np.sqrt(self.col_m2/self.count)
+        n_px = self.n_para + self.n_x
+        if self.normalization == 'minmax':
+            std[:n_px] = 0.5*(self.col_max[:n_px] - self.col_min[:n_px])
+            std[n_px:n_px + self.n_target] = self.col_absmax[n_px:n_px + self.n_target]
+        if self.area_weighted:
+            std[-1] = self.col_mean[-1]
+        return std
+
+    def transform(self, data, columns=None, out=None):
+        """
+        normalize `data`, whose columns are `columns` (index or slice, default all) of the fitted data.
+        pass `out=data` to normalize in place.
+        """
+        mean, std = self._select(columns)
+        out = np.subtract(data, mean, out=out)
+        return np.divide(out, std, out=out)
+
+    def inverse_transform(self, data, columns=None, out=None):
+        """inverse of `transform`, e.g., `columns=slice(n_p+n_x, n_p+n_x+n_o)` to denormalize model output"""
+        mean, std = self._select(columns)
+        out = np.multiply(data, std, out=out)
+        return np.add(out, mean, out=out)
+
+    def transform_chunks(self, chunks, columns=None):
+        for chunk in chunks:
+            yield self.transform(chunk, columns)
+
+    def _select(self, columns):
+        if columns is None:
+            return self.mean, self.std
+        return self.mean[columns], self.std[columns]
+
+    def get_config(self):
+        return {'normalization': self.normalization,
+                'n_para': self.n_para,
+                'n_x': self.n_x,
+                'n_target': self.n_target,
+                'area_weighted': self.area_weighted,
+                'count': self.count,
+                'col_mean': self.col_mean.tolist(),
+                'col_m2': self.col_m2.tolist(),
+                'col_min': self.col_min.tolist(),
+                'col_max': self.col_max.tolist(),
+                'col_absmax': self.col_absmax.tolist()}
+
+    @classmethod
+    def from_config(cls, config):
+        scaler = cls(config['normalization'], config['n_para'], config['n_x'], config['n_target'],
+                     config['area_weighted'])
+        scaler.count = config['count']
+        for key in ['col_mean', 'col_m2', 'col_min', 'col_max', 'col_absmax']:
+            setattr(scaler, key, np.array(config[key], dtype=np.float64))
+        return scaler
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.get_config(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_config(json.load(f))
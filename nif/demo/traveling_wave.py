@@ -3,7 +3,11 @@ from .point_wise_data import PointWiseData
 import os
 
 class TravelingWave(PointWiseData):
-    def __init__(self):
+    def __init__(self, data_dir=None):
+        if data_dir is not None:
+            # columnar, memory-mapped version of the same data, see `nif.demo.columnar`
+            self.load_columnar(data_dir, normalization='standard')
+            return
         path = os.path.abspath(__file__)
         dir_path = os.path.dirname(path)
         data = np.load(dir_path+'/data/traveling_wave.npz')['data']
@@ -11,12 +15,16 @@ class TravelingWave(PointWiseData):
         x_data = data[:,[1]]
         u_data = data[:,[2]]
         super(TravelingWave, self).__init__(parameter_data, x_data, u_data)
-        self.data, self.mean, self.std = self.standard_normalize(self.data_raw)
+        self.normalize('standard')
 
 if __name__=='__main__':
-    tw = TravelingWave()
-    print(tw.data.mean(axis=0))
-    print(tw.data.std(axis=0))
+    import sys
+    # optionally the columnar directory of the same data, see `nif.demo.columnar`
+    tw = TravelingWave(sys.argv[1] if len(sys.argv) > 1 else None)
+    # columnar data is normalized as it is read, `np.asarray` reads all rows
+    data = np.asarray(tw.data)
+    print(data.mean(axis=0))
+    print(data.std(axis=0))
     print(tw.parameter.shape)
     print(tw.x.shape)
     print(tw.u.shape)
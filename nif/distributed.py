@@ -0,0 +1,129 @@
+"""
+multi-process data-parallel training on one (CPU) node.
+
+`run_local_workers` starts `n_workers` processes on localhost, each creates a
+`tf.distribute.MultiWorkerMirroredStrategy` over the local cluster and runs `fn`. Every worker
+builds the model in `strategy.scope()` and feeds its own shard of the snapshots, e.g., with
+`PointWiseData.snapshot_dataset(..., num_shards=n_workers, shard_index=worker_index, repeat=True)`,
+so `fit` (and `NIF.train_step`) all-reduces the gradients between the workers every step.
+
+`fit` treats a batch of the dataset of a worker as the global batch and splits it between all the
+replicas, so for each worker to train on K snapshots per step, its dataset has batches of
+`n_workers*K` snapshots.
+
+```python
+def train(strategy, worker_index, n_workers, data_dir):
+    data = nif.demo.PointWiseData(...)
+    with strategy.scope():
+        model = nif.NIF(cfg_shape_net, cfg_parameter_net)
+        model.compile(tf.keras.optimizers.Adam(1e-3), 'mse')
+    # 4 snapshots of 256 points per worker and step
+    dataset = data.snapshot_dataset(4*n_workers, 256, num_shards=n_workers, shard_index=worker_index, repeat=True)
+    model.fit(dataset, epochs=10, steps_per_epoch=100, verbose=worker_index == 0)
+    return model.get_weights() if worker_index == 0 else None
+
+weights = nif.distributed.run_local_workers(train, 8, args=(data_dir,))[0]
+```
+"""
+__all__ = ["local_cluster", "configure_worker", "run_local_workers"]
+
+import json
+import multiprocessing
+import os
+import socket
+import traceback
+
+
+def _free_ports(n):
+    sockets = []
+    for _ in range(n):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('localhost', 0))
+        sockets.append(s)
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def local_cluster(n_workers, ports=None):
+    """the cluster spec of `n_workers` workers on localhost, on free ports by default"""
+    ports = _free_ports(n_workers) if ports is None else ports
+    return {'worker': ['localhost:{}'.format(port) for port in ports]}
+
+
+def configure_worker(worker_index, cluster, threads_per_worker=None):
+    """
+    set `TF_CONFIG` and the number of threads of this process, then create its strategy.
+    It has to be called before tensorflow runs anything in the process.
+
+    Args:
+        worker_index: index of this worker in `cluster['worker']`.
+        cluster: cluster spec of `local_cluster`.
+        threads_per_worker: intra-op threads of this worker, by default the cores are split evenly
+            between the workers, so they do not oversubscribe the node.
+
+    Returns:
+        a `tf.distribute.MultiWorkerMirroredStrategy`
+    """
+    os.environ['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': worker_index}})
+    import tensorflow as tf
+    n_workers = len(cluster['worker'])
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1)//n_workers)
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    tf.config.set_visible_devices([], 'GPU')
+    communication = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=communication)
+
+
+def _worker_main(fn, worker_index, cluster, args, kwargs, threads_per_worker, queue):
+    try:
+        strategy = configure_worker(worker_index, cluster, threads_per_worker)
+        queue.put((worker_index, fn(strategy, worker_index, len(cluster['worker']), *args, **kwargs), None))
+    except Exception:
+        queue.put((worker_index, None, traceback.format_exc()))
+
+
+def run_local_workers(fn, n_workers, args=(), kwargs=None, threads_per_worker=None, timeout=None):
+    """
+    run `fn(strategy, worker_index, n_workers, *args, **kwargs)` in `n_workers` processes
+    forming a `MultiWorkerMirroredStrategy` cluster on localhost.
+
+    `fn`, `args` and the return values are pickled, so `fn` has to be defined at module level.
+    Processes are started with 'spawn', tensorflow is not imported in this process.
+
+    Returns:
+        the list of the return values of `fn`, by worker index
+    """
+    kwargs = {} if kwargs is None else kwargs
+    cluster = local_cluster(n_workers)
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    processes = [context.Process(target=_worker_main,
+                                 args=(fn, i, cluster, args, kwargs, threads_per_worker, queue))
+                 for i in range(n_workers)]
+    for p in processes:
+        p.start()
+
+    results, errors = [None]*n_workers, []
+    completed = False
+    try:
+        for _ in range(n_workers):
+            worker_index, result, error = queue.get(timeout=timeout)
+            results[worker_index] = result
+            if error is not None:
+                errors.append("worker {}:\n{}".format(worker_index, error))
+                # the other workers would wait for it in the next collective
+                break
+        completed = not errors
+    finally:
+        for p in processes:
+            if not completed:
+                p.terminate()
+            p.join()
+    if errors:
+        raise RuntimeError("\n".join(errors))
+    return results
@@ -0,0 +1,138 @@
+__all__ = ["export_frozen"]
+
+import json
+import numpy as np
+import tensorflow as tf
+
+from .layers import SIREN, SIREN_ResNet, HyperLinearForSIREN, MLP_ResNet, MLP_SimpleShortCut, MaskLayer
+from .layers import ActiveColumnDense, Dense, ShardedHyperLinearForSIREN
+from .model import NIFMultiScale, NIFMultiScaleLastLayerParameterized
+from .quantization import QuantizedDense
+from .runtime import MAGIC, ALIGNMENT, ACTIVATIONS
+
+
+def _activation_name(act):
+    name = 'linear' if act is None else getattr(act, '__name__', str(act))
+    if name not in ACTIVATIONS:
+        raise NotImplementedError("activation {} is not supported by the numpy runtime".format(name))
+    return name
+
+
+class _Packer(object):
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.arrays = {}
+
+    def add(self, name, value, dtype=None):
+        self.arrays[name] = np.ascontiguousarray(np.asarray(value), dtype=dtype or self.dtype)
+        return name
+
+    def layer(self, prefix, layer):
+        """the spec of a parameter_net (or last-layer shapenet) layer for `FrozenNIF._call_layer`"""
+        if isinstance(layer, Dense):
+            return {'type': 'dense', 'activation': _activation_name(layer.activation),
+                    'w': self.add(prefix + 'w', layer.kernel.numpy()), 'b': self.add(prefix + 'b', layer.bias.numpy())}
+        if isinstance(layer, MLP_SimpleShortCut):
+            return {'type': 'shortcut', 'activation': _activation_name(layer.L1.activation),
+                    'w': self.add(prefix + 'w', layer.L1.kernel.numpy()),
+                    'b': self.add(prefix + 'b', layer.L1.bias.numpy())}
+        if isinstance(layer, MLP_ResNet):
+            return {'type': 'resnet', 'activation': _activation_name(layer.act),
+                    'w': self.add(prefix + 'w', layer.L1.kernel.numpy()),
+                    'b': self.add(prefix + 'b', layer.L1.bias.numpy()),
+                    'w2': self.add(prefix + 'w2', layer.L2.kernel.numpy()),
+                    'b2': self.add(prefix + 'b2', layer.L2.bias.numpy())}
+        if isinstance(layer, SIREN_ResNet):
+            return {'type': 'siren_resnet', 'omega_0': float(layer.omega_0.numpy()),
+                    'w': self.add(prefix + 'w', layer.w.numpy()), 'b': self.add(prefix + 'b', layer.b.numpy()),
+                    'w2': self.add(prefix + 'w2', layer.w2.numpy()), 'b2': self.add(prefix + 'b2', layer.b2.numpy())}
+        if isinstance(layer, SIREN):
+            return {'type': 'siren', 'omega_0': float(layer.omega_0.numpy()),
+                    'linear': layer.layer_position in ['last', 'bottleneck'],
+                    'w': self.add(prefix + 'w', layer.w.numpy()), 'b': self.add(prefix + 'b', layer.b.numpy())}
+        if isinstance(layer, HyperLinearForSIREN):
+            return {'type': 'dense', 'activation': 'linear',
+                    'w': self.add(prefix + 'w', layer.w.numpy()), 'b': self.add(prefix + 'b', layer.b.numpy())}
+        if isinstance(layer, ShardedHyperLinearForSIREN):
+            w, b = layer.full_weights()
+            return {'type': 'dense', 'activation': 'linear',
+                    'w': self.add(prefix + 'w', w), 'b': self.add(prefix + 'b', b)}
+        if isinstance(layer, MaskLayer):
+            w, b = layer.effective_weights()
+            return {'type': 'dense', 'activation': _activation_name(layer.act),
+                    'w': self.add(prefix + 'w', w), 'b': self.add(prefix + 'b', b)}
+        if isinstance(layer, ActiveColumnDense):
+            return {'type': 'active_columns',
+                    'w': self.add(prefix + 'w', layer.w.numpy()), 'b': self.add(prefix + 'b', layer.b.numpy()),
+                    'index': self.add(prefix + 'index', layer.index.numpy(), np.int32)}
+        if isinstance(layer, QuantizedDense):
+            n_out = layer.q.shape[1]
+            spec = {'type': 'dense', 'activation': 'linear',
+                    'w': self.add(prefix + 'w', layer._dequantize(layer.q, layer.scale, 0, n_out).numpy()),
+                    'b': self.add(prefix + 'b', layer._dequantize(layer.q_b, layer.scale_b, 0, n_out).numpy()[0])}
+            if layer.index is not None:
+                spec.update({'type': 'active_columns',
+                             'index': self.add(prefix + 'index', layer.index.numpy(), np.int32)})
+            return spec
+        raise NotImplementedError("layer {} can not be exported".format(type(layer).__name__))
+
+
+def export_frozen(model, path):
+    """
+    freeze a trained NIF model into a single file for `nif.runtime.FrozenNIF`.
+
+    The file is a json header (model dimensions, the parameter net as a list of layer specs,
+    the shapenet type and its `ShapeNetWeightLayout`) followed by all weights packed into one
+    aligned buffer, which the runtime memory-maps, so loading does not need tensorflow and
+    takes milliseconds.
+    """
+    packer = _Packer(model.variable_Dtype)
+    pnet = [packer.layer('pnet_{}_'.format(i), l) for i, l in enumerate(model.pnet_list)]
+
+    if isinstance(model, NIFMultiScaleLastLayerParameterized):
+        shape_net = {'type': 'last_layer',
+                     'layers': [packer.layer('snet_{}_'.format(i), l) for i, l in enumerate(model.snet_list)],
+                     'bias': packer.add('snet_bias', model.last_layer_bias.numpy())}
+    else:
+        layout = model.weight_layout
+        shape_net = {'layout': [{'name': s.name, 'shape': list(s.shape), 'offset': s.offset, 'size': s.size}
+                                for s in layout.segments],
+                     'hidden_names': layout.hidden_names}
+        if isinstance(model, NIFMultiScale):
+            shape_net.update({'type': 'siren', 'omega_0': float(model.cfg_shape_net['omega_0']),
+                              'resblock': layout.resblock})
+        else:
+            shape_net.update({'type': 'nif',
+                              'activation': _activation_name(tf.keras.activations.get(
+                                  model.cfg_shape_net['activation']))})
+
+    # pack the arrays into one buffer, each aligned
+    offset = 0
+    arrays = {}
+    for name, a in packer.arrays.items():
+        arrays[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset += -(-a.nbytes//ALIGNMENT)*ALIGNMENT
+
+    header = {'format_version': 1,
+              'model': type(model).__name__,
+              'dtype': np.dtype(model.variable_Dtype).str,
+              'pi_dim': model.pi_dim,
+              'si_dim': model.si_dim,
+              'so_dim': model.so_dim,
+              'parameter_net': pnet,
+              'shape_net': shape_net,
+              'arrays': arrays}
+    # the data offset is part of the header, so its length is fixed by padding the json
+    header['data_offset'] = 0
+    n_header = len(json.dumps(header)) + 32
+    header['data_offset'] = -(-(len(MAGIC) + 8 + n_header)//ALIGNMENT)*ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8').ljust(n_header)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array(n_header, dtype='<u8').tobytes())
+        f.write(header_bytes)
+        for name, a in packer.arrays.items():
+            f.seek(header['data_offset'] + arrays[name]['offset'])
+            f.write(a.tobytes())
+    return header
@@ -0,0 +1,136 @@
+__all__ = ["NIFInference"]
+
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+
+
+class NIFInference(object):
+    """
+    Inference on a trained NIF model that memoizes the generated shapenet weights per parameter.
+
+    The model is split into `model_p_to_lr`, `model_lr_to_w` and `model_x_to_u_given_w`. The
+    output of the first two, i.e., the weights and biases of the shapenet for a parameter
+    vector `p`, are kept in a bounded LRU cache, so a repeated query for the same `p` only
+    costs the shapenet evaluation, which runs as one dense matmul per snapshot.
+
+    Args:
+        model: a `NIF`, `NIFMultiScale` or `NIFMultiScaleLastLayerParameterized` instance.
+        max_entries: maximal number of cached parameter vectors.
+        max_bytes: maximal size of the cached weights in bytes, `None` for no limit.
+
+    Example:
+    ```python
+    engine = NIFInference(model_ori, max_entries=512)
+    u = engine.predict(p, x)  # p: [pi_dim] or [n_snapshots, pi_dim], x: [n_points, si_dim]
+    engine.cache_info()
+    ```
+    """
+    def __init__(self, model, max_entries=1024, max_bytes=None):
+        self.pi_dim = model.pi_dim
+        self.si_dim = model.si_dim
+        self.dtype = model.variable_Dtype
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.model_p_to_lr = model.model_p_to_lr()
+        try:
+            self.model_lr_to_w = model.model_lr_to_w()
+        except ValueError:
+            # NIFMultiScaleLastLayerParameterized: `w` is the same as `lr`
+            self.model_lr_to_w = None
+        self.model_x_to_u_given_w = model.model_x_to_u_given_w(snapshot_major=True)
+        # traced once for any number of snapshots and points
+        self._p_to_w = tf.function(self._call_p_to_w, input_signature=[
+            tf.TensorSpec([None, self.pi_dim], self.dtype)])
+        self._x_to_u = tf.function(self._call_x_to_u, input_signature=[
+            tf.TensorSpec([None, None, self.si_dim], self.dtype),
+            tf.TensorSpec([None, None], self.dtype)])
+
+        self._cache = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _call_p_to_w(self, p):
+        w = self.model_p_to_lr(p)
+        if self.model_lr_to_w is not None:
+            w = self.model_lr_to_w(w)
+        return w
+
+    def _call_x_to_u(self, x, w):
+        return self.model_x_to_u_given_w([x, w])
+
+    def weights(self, p):
+        """shapenet weights `[n_snapshots, po_dim]` for each row of `p`, only cache misses are computed"""
+        p = np.asarray(p, dtype=self.dtype).reshape(-1, self.pi_dim)
+        keys = [row.tobytes() for row in p]
+        w = [None]*len(keys)
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                w[i] = self._cache[key]
+                self.hits += 1
+            elif key in missing:
+                # repeated within the same query, computed once
+                missing[key].append(i)
+                self.hits += 1
+            else:
+                missing[key] = [i]
+                self.misses += 1
+
+        if missing:
+            rows = [idx[0] for idx in missing.values()]
+            w_new = self._p_to_w(tf.constant(p[rows])).numpy()
+            for (key, idx), w_row in zip(missing.items(), w_new):
+                # a copy, so an entry does not keep the whole batch `w_new` alive
+                w_row = w_row.copy()
+                for i in idx:
+                    w[i] = w_row
+                self._insert(key, w_row)
+        return np.stack(w)
+
+    def predict(self, p, x):
+        """
+        evaluate the field at points `x` for each parameter `p`.
+
+        `p` is `[pi_dim]` or `[n_snapshots, pi_dim]`, `x` is `[n_points, si_dim]` shared by all
+        snapshots or `[n_snapshots, n_points, si_dim]`. Returns `[n_points, so_dim]` for a single
+        parameter vector, `[n_snapshots, n_points, so_dim]` otherwise.
+        """
+        single = np.ndim(p) == 1
+        w = self.weights(p)
+        x = np.asarray(x, dtype=self.dtype)
+        if x.ndim == 2:
+            x = np.broadcast_to(x, (w.shape[0],) + x.shape)
+        u = self._x_to_u(tf.constant(x), tf.constant(w, dtype=self.dtype)).numpy()
+        return u[0] if single else u
+
+    def _insert(self, key, w_row):
+        if self.max_bytes is not None and w_row.nbytes > self.max_bytes:
+            return
+        self._cache[key] = w_row
+        self.nbytes += w_row.nbytes
+        while len(self._cache) > self.max_entries or \
+                (self.max_bytes is not None and self.nbytes > self.max_bytes):
+            _, w_old = self._cache.popitem(last=False)
+            self.nbytes -= w_old.nbytes
+            self.evictions += 1
+
+    def cache_info(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._cache),
+                'nbytes': self.nbytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes}
+
+    def clear_cache(self):
+        self._cache.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
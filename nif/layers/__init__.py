@@ -1,9 +1,11 @@
 from .siren import SIREN
 from .siren import SIREN_ResNet
 from .siren import HyperLinearForSIREN
+from .siren import ShardedHyperLinearForSIREN
 from .mlp import MLP_ResNet
 from .mlp import MLP_SimpleShortCut
 from .masklayer import MaskLayer
+from .masklayer import ActiveColumnDense
 
 
 from tensorflow.keras.layers import Dense
@@ -13,7 +15,9 @@ __all__ = [
     "SIREN_ResNet",
     "Dense",
     "HyperLinearForSIREN",
+    "ShardedHyperLinearForSIREN",
     "MLP_ResNet",
     "MLP_SimpleShortCut",
-    "MaskLayer"
+    "MaskLayer",
+    "ActiveColumnDense"
 ]
\ No newline at end of file
@@ -1,75 +1,101 @@
 import tensorflow as tf
 import numpy as np
 
+def magnitude_mask(w_abs, sparsity):
+    """
+    keep-mask of the flat `w_abs` pruning exactly `round(sparsity*size)` of the smallest values, computed
+    with one `top_k`. Ties at the threshold are broken by position (`top_k` returns the lower index first),
+    so equal magnitudes never prune more than requested. Already pruned weights are zeros in `w_abs`,
+    so they are counted in `sparsity`.
+    """
+    n_prune = tf.cast(tf.round(tf.cast(sparsity, w_abs.dtype)*tf.cast(tf.size(w_abs), w_abs.dtype)), tf.int32)
+    pruned = tf.math.top_k(tf.negative(w_abs), k=n_prune).indices
+    return tf.tensor_scatter_nd_update(tf.ones_like(w_abs), pruned[:, tf.newaxis], tf.zeros_like(w_abs[:n_prune]))
+
+
 class MaskLayer(tf.keras.layers.Layer):
-    def __init__(self, input_dim, width, activation, kernel_initializer, bias_initializer):
-        super(MaskLayer, self).__init__()
+    def __init__(self, input_dim, width, activation, kernel_initializer, bias_initializer, mask_bias=False,
+                 mixed_policy=tf.keras.mixed_precision.experimental.Policy('float32')):
+        super(MaskLayer, self).__init__(dtype=mixed_policy)
+        self.mixed_policy = mixed_policy
+        self.compute_Dtype = self.mixed_policy.compute_dtype
+        self.variable_Dtype = self.mixed_policy.variable_dtype
         self.act = tf.keras.activations.get(activation)
+        # if True, the bias of a fully pruned output column is pruned as well, so the column is exactly zero
+        self.mask_bias = mask_bias
         self.w = tf.Variable(
-            initial_value=kernel_initializer(shape=(input_dim, width), dtype="float32"),
+            initial_value=kernel_initializer(shape=(input_dim, width), dtype=self.variable_Dtype),
             trainable=True)
         
         self.b = tf.Variable(
-            initial_value=bias_initializer(shape=(width,), dtype="float32"), trainable=True)
+            initial_value=bias_initializer(shape=(width,), dtype=self.variable_Dtype), trainable=True)
         
         self.mask = tf.Variable(
-            initial_value=tf.ones((input_dim,width)), trainable=False)
+            initial_value=tf.ones((input_dim,width), dtype=self.variable_Dtype), trainable=False)
         
     def call(self, inputs):
-        return self.act(tf.matmul(inputs, tf.multiply(self.w, self.mask)) + self.b)
+        b = self.b
+        if self.mask_bias:
+            b = tf.multiply(b, tf.reduce_max(self.mask, axis=0))
+        w = tf.cast(tf.multiply(self.w, self.mask), self.compute_Dtype)
+        return self.act(tf.matmul(inputs, w) + tf.cast(b, self.compute_Dtype))
+
+    def set_mask(self, mask):
+        self.mask.assign(mask)
+
+    def effective_weights(self):
+        """masked kernel and bias as numpy arrays"""
+        w = (self.w*self.mask).numpy()
+        b = self.b.numpy()
+        if self.mask_bias:
+            b = b*np.max(self.mask.numpy(), axis=0)
+        return w, b
         
     def pruneLowMagnitude(self, sparsity):
-        sparsityPercent = sparsity*100
-        print('PRUNING %s percent of weights' %(sparsityPercent))
-        numTotal = self.w.shape[0]*self.w.shape[1] #Total number of weights in layer
-        numPrune = np.rint(sparsity*numTotal) #Number of weights we want to prune 
-        
-        #Finds the lowest numPrune weights and their indices 
-        result = tf.math.top_k(tf.negative(tf.reshape(self.w, [-1])), k=numPrune)
-        idx = tf.reshape(result.indices, [tf.Variable(numPrune, dtype='int32'),1])
-        
-        #Flatten mask for manipulation
-        flatMask = tf.reshape(self.mask, [-1])
-        fm = tf.reshape(flatMask, [len(flatMask), 1])
-        
-        #Update the mask
-        num_updates, index_depth = idx.shape.as_list()
-        fm = tf.tensor_scatter_nd_update(fm, idx, tf.zeros([num_updates,1], tf.float32))
-        
-        #Set self.mask to updated mask 
-        fm = tf.reshape(fm, self.mask.shape)
-        self.mask = fm
+        '''
+        prune the `sparsity` fraction of weights with the smallest |w|, pruned weights count as zero
+        so they stay pruned. The mask is updated in place, so it also works inside `tf.function`.
+        '''
+        w_abs = tf.abs(tf.multiply(self.w, self.mask))
+        keep = tf.reshape(magnitude_mask(tf.reshape(w_abs, [-1]), sparsity), tf.shape(w_abs))
+        self.mask.assign(tf.multiply(self.mask, tf.cast(keep, self.mask.dtype)))
         
     def pruneShapeNet(self, sparsity, si_dim, n_sx, l_sx, so_dim):
-        sparsityPercent = sparsity*100
-        print('PRUNING %s percent of weights of ShapeNet' %(sparsityPercent))
-        
         '''
         ShapeNet is completely determined by the last layer of ParameterNet. The weight 
         matrix to prune is latent_dim by po_dim (ParameterNet output dimension or number
         of weights and biases in ShapeNet).
         '''
-        sn_weights = self.w[:,:si_dim*n_sx + l_sx*n_sx**2 + so_dim*n_sx]  
-        avgw = tf.reduce_mean(sn_weights, axis=0) #Take average of weights because we want to prune entire node from ShapeNet
-        
-        numTotal = avgw.shape[0] #Total number of weights in layer
-        numPrune = np.rint(sparsity*numTotal) #Number of weights we want to prune 
-        
-        #Finds the lowest numPrune weights and their indices 
-        result = tf.math.top_k(tf.negative(avgw), k=numPrune)
-        idx = tf.reshape(result.indices, [tf.Variable(numPrune, dtype='int32'),1])
-        
-        #Flatten mask for manipulation
-        flatMask = self.mask[0,:]
-        fm = tf.reshape(flatMask, [len(flatMask), 1])
-        
-        #Update the mask
-        num_updates, index_depth = idx.shape.as_list()
-        fm = tf.transpose(tf.tensor_scatter_nd_update(fm, idx, tf.zeros([num_updates,1], tf.float32)))
-        
-        self.mask = tf.repeat(fm, [self.w.shape[0]], axis=0)
-        print(self.mask[:,0:300])
+        n_weights = si_dim*n_sx + l_sx*n_sx**2 + so_dim*n_sx
+        #Take average magnitude over the latent dimension because a whole column is one shapenet weight
+        avgw = tf.reduce_mean(tf.abs(tf.multiply(self.w, self.mask))[:, :n_weights], axis=0)
+
+        #Biases of the shapenet are not pruned
+        col_mask = tf.concat([tf.cast(magnitude_mask(avgw, sparsity), self.mask.dtype),
+                              tf.ones([self.mask.shape[1] - n_weights], self.mask.dtype)], axis=0)
+        self.mask.assign(tf.multiply(self.mask, col_mask))
         
     def pruneOtherWay(self):
         pass
-        
\ No newline at end of file
+
+
+class ActiveColumnDense(tf.keras.layers.Layer):
+    """
+    dense layer that only computes `num_active` of its `num_outputs` columns, the others are zero.
+
+    used as the last layer of a compacted parameter net: `index` maps each output column to
+    its active column, or to `num_active` for a pruned one.
+    """
+    def __init__(self, num_inputs, num_active, num_outputs, mixed_policy):
+        super(ActiveColumnDense, self).__init__(dtype=mixed_policy)
+        self.mixed_policy = mixed_policy
+        self.compute_Dtype = self.mixed_policy.compute_dtype
+        self.variable_Dtype = self.mixed_policy.variable_dtype
+        self.w = tf.Variable(tf.zeros((num_inputs, num_active), dtype=self.variable_Dtype))
+        self.b = tf.Variable(tf.zeros((num_active,), dtype=self.variable_Dtype))
+        self.index = tf.Variable(tf.fill((num_outputs,), num_active), trainable=False)
+
+    def call(self, x, **kwargs):
+        y = tf.matmul(x, tf.cast(self.w, self.compute_Dtype)) + tf.cast(self.b, self.compute_Dtype)
+        y = tf.concat([y, tf.zeros_like(y[:, :1])], axis=-1)
+        return tf.gather(y, self.index, axis=-1)
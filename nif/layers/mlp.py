@@ -2,7 +2,7 @@ import tensorflow as tf
 
 class MLP_ResNet(tf.keras.layers.Layer):
     def __init__(self, width, activation, kernel_initializer, bias_initializer, mixed_policy):
-        super(MLP_ResNet, self).__init__()
+        super(MLP_ResNet, self).__init__(dtype=mixed_policy)
         self.compute_Dtype = mixed_policy.compute_dtype
         self.variable_Dtype = mixed_policy.variable_dtype
         # dtype = tf.float16 if mixed_policy == 'mixed_float16' else tf.float32
@@ -22,13 +22,12 @@ class MLP_ResNet(tf.keras.layers.Layer):
         # classic ResNet, replace ReLU with Swish
         h1 = self.L1(x)
         h2 = self.L2(h1)
-        y = self.act(x + tf.cast(h2, self.compute_Dtype))
-        return tf.cast(y, self.variable_Dtype)
+        return self.act(x + h2)
 
 
 class MLP_SimpleShortCut(tf.keras.layers.Layer):
     def __init__(self, width, activation, kernel_initializer, bias_initializer, mixed_policy):
-        super(MLP_SimpleShortCut, self).__init__()
+        super(MLP_SimpleShortCut, self).__init__(dtype=mixed_policy)
         # dtype = tf.float16 if mixed_policy == 'mixed_float16' else tf.float32
         self.compute_Dtype = mixed_policy.compute_dtype
         self.variable_Dtype = mixed_policy.variable_dtype
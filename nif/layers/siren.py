@@ -15,7 +15,8 @@ def gen_hypernetwork_weights_bias_for_siren_shapenet(
 ):
     w_init = tf.random.uniform((num_inputs, num_outputs),
                                -np.sqrt(6.0/num_inputs)*weight_factor,
-                               np.sqrt(6.0/num_inputs)*weight_factor)
+                               np.sqrt(6.0/num_inputs)*weight_factor,
+                               dtype=variable_dtype)
 
     scale_matrix = np.ones((num_outputs), dtype=variable_dtype)
     scale_matrix[:num_weight_first] /= input_dim  # 1st layer weights
@@ -53,12 +54,13 @@ class SIREN(tf.keras.layers.Layer):
     def __init__(self, num_inputs, num_outputs, layer_position,
                  omega_0=30., cfg_shape_net=None,
                  mixed_policy=tf.keras.mixed_precision.experimental.Policy('float32')):
-        super(SIREN, self).__init__()
+        super(SIREN, self).__init__(dtype=mixed_policy)
         self.mixed_policy = mixed_policy
         self.compute_Dtype = self.mixed_policy.compute_dtype
         self.variable_Dtype = self.mixed_policy.variable_dtype
         self.layer_position = layer_position
         self.omega_0 = tf.cast(omega_0, self.variable_Dtype)
+        self.omega_0_compute = tf.cast(omega_0, self.compute_Dtype)
 
         # initialize the weights
         if layer_position == 'first':
@@ -121,7 +123,7 @@ class SIREN(tf.keras.layers.Layer):
         if self.layer_position == 'last' or self.layer_position == 'bottleneck':
             y = tf.matmul(x,  tf.cast(self.w, self.compute_Dtype)) + tf.cast(self.b, self.compute_Dtype)
         else:
-            y = tf.math.sin(self.omega_0*tf.matmul(x, tf.cast(self.w, self.compute_Dtype)) +
+            y = tf.math.sin(self.omega_0_compute*tf.matmul(x, tf.cast(self.w, self.compute_Dtype)) +
                             tf.cast(self.b,self.compute_Dtype))
         return y
 
@@ -139,43 +141,92 @@ class SIREN_ResNet(SIREN):
         self.b2 = tf.Variable(self.b_init, dtype=self.variable_Dtype)
 
     def call(self, x, training=None, mask=None):
-        h = tf.math.sin(self.omega_0*tf.matmul(x, tf.cast(self.w, self.compute_Dtype)) +
+        h = tf.math.sin(self.omega_0_compute*tf.matmul(x, tf.cast(self.w, self.compute_Dtype)) +
                         tf.cast(self.b,self.compute_Dtype))
-        return 0.5*(x + tf.math.sin(self.omega_0*tf.matmul(h, tf.cast(self.w2, self.compute_Dtype)) +
+        return 0.5*(x + tf.math.sin(self.omega_0_compute*tf.matmul(h, tf.cast(self.w2, self.compute_Dtype)) +
                                             tf.cast(self.b2, self.compute_Dtype)))
 
+def _hyper_linear_init(num_inputs, num_outputs, cfg_shape_net, variable_dtype, connectivity='full'):
+    # compute the indices needed for generating weights for shapenet
+    if connectivity == 'full':
+        num_weight_first, num_weight_hidden, num_weight_last = compute_number_of_weightbias_by_its_position_for_shapenet(cfg_shape_net)
+    elif connectivity == 'last_layer':
+        num_weight_first, num_weight_hidden, num_weight_last = 0, 0, num_outputs
+    else:
+        raise ValueError("connectivity should be set to `full` or `last_layer`")
+
+    return gen_hypernetwork_weights_bias_for_siren_shapenet(
+        num_inputs=num_inputs,
+        num_outputs=num_outputs,
+        weight_factor=cfg_shape_net['weight_init_factor'],
+        num_weight_first=num_weight_first,
+        num_weight_hidden=num_weight_hidden,
+        num_weight_last=num_weight_last,
+        input_dim=cfg_shape_net['input_dim'],
+        width=cfg_shape_net['units'],
+        omega_0=cfg_shape_net['omega_0'],
+        variable_dtype=variable_dtype
+    )
+
+
 class HyperLinearForSIREN(tf.keras.layers.Layer):
     def __init__(self, num_inputs, num_outputs, cfg_shape_net, mixed_policy, connectivity='full'):
-        super(HyperLinearForSIREN, self).__init__()
+        super(HyperLinearForSIREN, self).__init__(dtype=mixed_policy)
         self.mixed_policy = mixed_policy
         self.compute_Dtype = self.mixed_policy.compute_dtype
         self.variable_Dtype = self.mixed_policy.variable_dtype
 
-        # compute the indices needed for generating weights for shapenet
-        if connectivity == 'full':
-            num_weight_first, num_weight_hidden, num_weight_last = compute_number_of_weightbias_by_its_position_for_shapenet(cfg_shape_net)
-        elif connectivity == 'last_layer':
-            num_weight_first, num_weight_hidden, num_weight_last = 0, 0, num_outputs
-        else:
-            raise ValueError("connectivity should be set to `full` or `last_layer`")
-
-        w_init, b_init = gen_hypernetwork_weights_bias_for_siren_shapenet(
-            num_inputs=num_inputs,
-            num_outputs=num_outputs,
-            weight_factor=cfg_shape_net['weight_init_factor'],
-            num_weight_first=num_weight_first,
-            num_weight_hidden=num_weight_hidden,
-            num_weight_last=num_weight_last,
-            input_dim=cfg_shape_net['input_dim'],
-            width=cfg_shape_net['units'],
-            omega_0=cfg_shape_net['omega_0'],
-            variable_dtype=self.variable_Dtype
-        )
-
-        self.w = tf.Variable(w_init, self.variable_Dtype)
-        self.b = tf.Variable(b_init, self.variable_Dtype)
+        w_init, b_init = _hyper_linear_init(num_inputs, num_outputs, cfg_shape_net, self.variable_Dtype, connectivity)
+
+        self.w = tf.Variable(w_init, dtype=self.variable_Dtype)
+        self.b = tf.Variable(b_init, dtype=self.variable_Dtype)
 
     def call(self, x, **kwargs):
         y = tf.matmul(x, tf.cast(self.w, self.compute_Dtype)) + tf.cast(self.b, self.compute_Dtype)
         return y
 
+
+class ShardedHyperLinearForSIREN(tf.keras.layers.Layer):
+    """
+    `HyperLinearForSIREN` (with `connectivity='full'`) whose kernel is split column-wise over `devices`.
+
+    the split follows the `ShapeNetWeightLayout` of the output: shard `i` holds the columns of the
+    weights and biases of a contiguous group of shapenet layers (`layout.shard_layers`) and computes
+    them on `devices[i]`, so the largest matmul, its gradient and the optimizer slots are spread over the
+    devices. The outputs are concatenated back into `pnet_output` on the device of the caller.
+    """
+    def __init__(self, num_inputs, cfg_shape_net, mixed_policy, devices, layout):
+        super(ShardedHyperLinearForSIREN, self).__init__(dtype=mixed_policy)
+        self.mixed_policy = mixed_policy
+        self.compute_Dtype = self.mixed_policy.compute_dtype
+        self.variable_Dtype = self.mixed_policy.variable_dtype
+        self.devices = list(devices)
+        self.layout = layout
+
+        # same initialization as the unsharded layer
+        w_init, b_init = _hyper_linear_init(num_inputs, layout.po_dim, cfg_shape_net, self.variable_Dtype)
+        self.shard_segments = [layout.layer_segments(names) for names in layout.shard_layers(len(self.devices))]
+        self.w_list, self.b_list = [], []
+        for device, segments in zip(self.devices, self.shard_segments):
+            columns = np.concatenate([np.arange(s.offset, s.offset + s.size) for s in segments])
+            with tf.device(device):
+                self.w_list.append(tf.Variable(tf.gather(w_init, columns, axis=1), dtype=self.variable_Dtype))
+                self.b_list.append(tf.Variable(tf.gather(b_init, columns), dtype=self.variable_Dtype))
+
+    def call(self, x, **kwargs):
+        parts = {}
+        for device, segments, w, b in zip(self.devices, self.shard_segments, self.w_list, self.b_list):
+            with tf.device(device):
+                y = tf.matmul(x, tf.cast(w, self.compute_Dtype)) + tf.cast(b, self.compute_Dtype)
+                parts.update(zip([s.name for s in segments], tf.split(y, [s.size for s in segments], axis=-1)))
+        return tf.concat([parts[s.name] for s in self.layout.segments], axis=-1)
+
+    def full_weights(self):
+        """the kernel and bias of the equivalent `HyperLinearForSIREN`, as numpy arrays"""
+        w = np.zeros((self.w_list[0].shape[0], self.layout.po_dim), dtype=self.variable_Dtype)
+        b = np.zeros((self.layout.po_dim,), dtype=self.variable_Dtype)
+        for segments, w_shard, b_shard in zip(self.shard_segments, self.w_list, self.b_list):
+            columns = np.concatenate([np.arange(s.offset, s.offset + s.size) for s in segments])
+            w[:, columns] = w_shard.numpy()
+            b[columns] = b_shard.numpy()
+        return w, b
@@ -0,0 +1,174 @@
+__all__ = ["ShapeNetWeightLayout"]
+
+from collections import namedtuple
+import numpy as np
+
+Segment = namedtuple('Segment', ['name', 'shape', 'offset', 'size'])
+
+
+class ShapeNetWeightLayout(object):
+    """
+    layout of the shapenet weights and biases in a row of `pnet_output`.
+
+    All offsets are computed once from the shapenet configuration. A row of `pnet_output`
+    is laid out as
+        w_1, w_hidden_0, ..., w_hidden_{l-1}, w_l, b_1, b_hidden_0, ..., b_hidden_{l-1}, b_l
+    where, with a resblock shapenet, each hidden layer `i` holds two matrices (biases),
+    named `w_hidden_i_0` and `w_hidden_i_1` (`b_hidden_i_0` and `b_hidden_i_1`).
+
+    `unpack` carves out all of them with a single `tf.split`, and `segment`, `slice` and
+    `columns` let pruning, quantization or caching code address a given weight or bias.
+
+    Example:
+    ```python
+    layout = ShapeNetWeightLayout.from_cfg(cfg_shape_net)
+    layout.po_dim
+    layout.slice('w_hidden_0')  # columns of pnet_output holding the first hidden weight
+    ```
+    """
+    def __init__(self, si_dim, so_dim, n_sx, l_sx, resblock=False):
+        self.si_dim = si_dim
+        self.so_dim = so_dim
+        self.n_sx = n_sx
+        self.l_sx = l_sx
+        self.resblock = resblock
+
+        hidden_names = []
+        for i in range(l_sx):
+            hidden_names += ['hidden_{}_0'.format(i), 'hidden_{}_1'.format(i)] if resblock else ['hidden_{}'.format(i)]
+        self.hidden_names = hidden_names
+
+        shapes = [('w_1', (si_dim, n_sx))]
+        shapes += [('w_' + name, (n_sx, n_sx)) for name in hidden_names]
+        shapes += [('w_l', (n_sx, so_dim)), ('b_1', (n_sx,))]
+        shapes += [('b_' + name, (n_sx,)) for name in hidden_names]
+        shapes += [('b_l', (so_dim,))]
+
+        self.segments = []
+        offset = 0
+        for name, shape in shapes:
+            size = int(np.prod(shape))
+            self.segments.append(Segment(name, shape, offset, size))
+            offset += size
+        self._index = {s.name: i for i, s in enumerate(self.segments)}
+        self.sizes = [s.size for s in self.segments]
+        self.offsets = [s.offset for s in self.segments]
+        self.po_dim = offset
+        self.n_weights = self.segment('b_1').offset
+
+    @classmethod
+    def from_cfg(cls, cfg_shape_net):
+        return cls(cfg_shape_net['input_dim'],
+                   cfg_shape_net['output_dim'],
+                   cfg_shape_net['units'],
+                   cfg_shape_net['nlayers'],
+                   cfg_shape_net.get('use_resblock', False))
+
+    def segment(self, name):
+        return self.segments[self._index[name]]
+
+    def slice(self, name):
+        """columns of `pnet_output` holding `name`"""
+        s = self.segment(name)
+        return slice(s.offset, s.offset + s.size)
+
+    def columns(self, name):
+        """column indices of `pnet_output` holding `name`, in the (row-major) order of its shape"""
+        s = self.segment(name)
+        return np.arange(s.offset, s.offset + s.size).reshape(s.shape)
+
+    def neuron_outgoing_columns(self, k):
+        """columns of `pnet_output` holding the weights that read the output of shapenet neuron `k`"""
+        names = ['w_' + name for name in self.hidden_names] + ['w_l']
+        return np.concatenate([self.columns(name)[k, :] for name in names])
+
+    def compact_columns(self, keep):
+        """
+        for the layout that only keeps the shapenet neurons `keep` (in every layer), the column
+        of this layout that each of its columns comes from, i.e., `pnet_output[:, compact_columns(keep)]`
+        is the `pnet_output` of the narrower shapenet.
+        """
+        keep = np.asarray(keep)
+        columns = []
+        for s in self.segments:
+            c = self.columns(s.name)
+            if s.name == 'w_1':
+                c = c[:, keep]
+            elif s.name == 'w_l':
+                c = c[keep, :]
+            elif s.name.startswith('w_'):
+                c = c[keep][:, keep]
+            elif s.name != 'b_l':
+                c = c[keep]
+            columns.append(c.ravel())
+        return np.concatenate(columns)
+
+    @property
+    def layer_names(self):
+        """names of the shapenet layers, the weight and bias of layer `name` are `w_<name>` and `b_<name>`"""
+        return ['1'] + self.hidden_names + ['l']
+
+    def shard_layers(self, n_shards):
+        """
+        split the shapenet layers into `n_shards` contiguous groups with about the same number of
+        columns of `pnet_output`, e.g., to shard the last layer of parameter_net over devices.
+        """
+        names = self.layer_names
+        if not 0 < n_shards <= len(names):
+            raise ValueError("the {} shapenet layers can not be split into {} shards".format(len(names), n_shards))
+        sizes = [self.segment('w_' + name).size + self.segment('b_' + name).size for name in names]
+        shards, start, total = [], 0, 0
+        for i in range(n_shards - 1):
+            target = sum(sizes)*(i + 1)/n_shards
+            stop = start + 1
+            # leave at least one layer for each of the remaining shards
+            while stop < len(names) - (n_shards - i - 1) and total + sizes[stop - 1] + sizes[stop]/2 < target:
+                total += sizes[stop - 1]
+                stop += 1
+            total += sizes[stop - 1]
+            shards.append(names[start:stop])
+            start = stop
+        shards.append(names[start:])
+        return shards
+
+    def layer_segments(self, names):
+        """the segments of the weights and biases of the shapenet layers `names`, in the order of `pnet_output`"""
+        segments = [self.segment(prefix + name) for prefix in ['w_', 'b_'] for name in names]
+        return sorted(segments, key=lambda s: s.offset)
+
+    def unpack(self, pnet_output, snapshot_major=False):
+        """
+        split `pnet_output` `[-1, po_dim]` into the weights and biases of the shapenet.
+
+        weights are shaped as `[-1, n_in, n_out]`. Biases are shaped as `[-1, n_out]`,
+        or as `[-1, 1, n_out]` if `snapshot_major` so they broadcast over the points of a snapshot.
+
+        Returns:
+            `w_1, w_hidden_list, w_l, b_1, b_hidden_list, b_l`, with pairs in the hidden lists for a resblock
+        """
+        import tensorflow as tf
+        bias_shape = [-1, 1] if snapshot_major else [-1]
+        parts = tf.split(pnet_output, self.sizes, axis=-1)
+        tensors = []
+        for s, part in zip(self.segments, parts):
+            shape = [-1] + list(s.shape) if len(s.shape) == 2 else bias_shape + list(s.shape)
+            tensors.append(tf.reshape(part, shape))
+
+        n_hidden = len(self.hidden_names)
+        w_1, w_hidden_list, w_l = tensors[0], tensors[1:1 + n_hidden], tensors[1 + n_hidden]
+        b_1, b_hidden_list, b_l = tensors[2 + n_hidden], tensors[3 + n_hidden:-1], tensors[-1]
+        if self.resblock:
+            w_hidden_list = [w_hidden_list[2*i:2*i + 2] for i in range(self.l_sx)]
+            b_hidden_list = [b_hidden_list[2*i:2*i + 2] for i in range(self.l_sx)]
+        return w_1, w_hidden_list, w_l, b_1, b_hidden_list, b_l
+
+    def get_config(self):
+        return {'si_dim': self.si_dim,
+                'so_dim': self.so_dim,
+                'n_sx': self.n_sx,
+                'l_sx': self.l_sx,
+                'resblock': self.resblock}
+
+    def __repr__(self):
+        return "ShapeNetWeightLayout(si_dim={si_dim}, so_dim={so_dim}, n_sx={n_sx}, l_sx={l_sx}, " \
+               "resblock={resblock})".format(**self.get_config())
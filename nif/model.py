@@ -1,13 +1,29 @@
-__all__ = ["NIFMultiScale", "NIF", "NIFMultiScaleLastLayerParameterized", "PNIF"]
+__all__ = ["NIFMultiScale", "NIF", "NIFMultiScaleLastLayerParameterized", "PNIF", "NIFCompact"]
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import Model, initializers
 from .layers import *
+from .layout import ShapeNetWeightLayout
+from .layers.masklayer import magnitude_mask
 from tensorflow.python.eager import backprop
 from tensorflow.python.keras.engine import data_adapter
 
+
+def _apply_generated_weight(u, w):
+    """
+    multiply `u` with weights generated by parameter_net.
+
+    point-wise: `[batch, n_in] x [batch, n_in, n_out]`, i.e., one matrix-vector product per point.
+    snapshot-major: `[n_snapshots, n_points, n_in] x [n_snapshots, n_in, n_out]`, i.e., one GEMM per snapshot.
+    """
+    if u.shape.rank == 3:
+        return tf.matmul(u, w)
+    return tf.einsum('ai,aij->aj', u, w)
+
+
 class NIF(Model):
-    def __init__(self, cfg_shape_net, cfg_parameter_net, mixed_policy='float32'):
+    def __init__(self, cfg_shape_net, cfg_parameter_net, mixed_policy='float32', group_by_parameter=False):
         super(NIF, self).__init__()
         self.cfg_shape_net = cfg_shape_net
         self.si_dim = cfg_shape_net['input_dim']
@@ -23,23 +39,57 @@ class NIF(Model):
         self.variable_Dtype = self.mixed_policy.variable_dtype
         self.compute_Dtype = self.mixed_policy.compute_dtype
 
+        # if True, parameter_net only runs on the unique rows of `input_p` in a batch, i.e., once per
+        # snapshot instead of once per point, and the shapenet once per group of points, see `_call_grouped`
+        self.group_by_parameter = group_by_parameter
+
+        # see `compile`
+        self.jit_compile_train_step = False
+        # debug flag, see `_split_inputs`
+        self.check_snapshot_parameters = False
+        self._loss_scaling = False
+
         # initialize the parameter net structure
         self.pnet_list = self._initialize_pnet(cfg_parameter_net, cfg_shape_net)
 
+        # traced once for any number of snapshots and points, see `predict_field`
+        self._predict_field_chunk = tf.function(self._call_predict_field_chunk, input_signature=[
+            tf.TensorSpec([None, self.si_dim], self.variable_Dtype),
+            tf.TensorSpec([None, None], self.variable_Dtype)])
 
-    def call(self, inputs, training=None, mask=None):
-        input_p = inputs[:, 0:self.pi_dim]
-        input_s = inputs[:, self.pi_dim:self.pi_dim+self.si_dim]
+    def call(self, inputs, training=None, mask=None, groups=None):
+        """
+        `groups` is `_group_parameter_rows` of the parameters of point-wise `inputs` if it is already
+        computed (e.g., outside of XLA in `train_step`), only used with `group_by_parameter`.
+        """
+        input_p, input_s = self._split_inputs(inputs)
+        if self.group_by_parameter and inputs.shape.rank == 2:
+            return self._call_grouped(input_s, self._group_parameter_rows(input_p) if groups is None else groups)
         # get parameter from parameter_net
         self.pnet_output = self._call_parameter_net(input_p, self.pnet_list)[0]
-        return self._call_shape_net(tf.cast(input_s,self.compute_Dtype),
-                                    self.pnet_output,
-                                    si_dim=self.si_dim,
-                                    so_dim=self.so_dim,
-                                    n_sx=self.n_sx,
-                                    l_sx=self.l_sx,
-                                    activation=self.cfg_shape_net['activation'],
-                                    variable_dtype=self.variable_Dtype)
+        return self._call_shape_net_given_w(input_s, self.pnet_output)
+
+    def _split_inputs(self, inputs):
+        """
+        split `inputs` into parameter and spatial inputs.
+
+        `inputs` is either point-wise, `[batch, pi_dim + si_dim]`, or snapshot-major,
+        `[n_snapshots, n_points, pi_dim + si_dim]` where all points of a snapshot share the
+        same parameter. For the latter, the parameter is taken from the first point of each
+        snapshot and the shapenet runs as one dense matmul per snapshot. The parameters of the
+        other points are ignored, it is up to the caller that they are the same, set
+        `check_snapshot_parameters` to assert it on every call.
+        """
+        if inputs.shape.rank == 3:
+            input_p = inputs[:, 0, 0:self.pi_dim]
+            if self.check_snapshot_parameters:
+                tf.debugging.assert_equal(inputs[:, :, 0:self.pi_dim], input_p[:, None, :],
+                                          message="points of a snapshot have different parameters")
+            input_s = inputs[:, :, self.pi_dim:self.pi_dim+self.si_dim]
+        else:
+            input_p = inputs[:, 0:self.pi_dim]
+            input_s = inputs[:, self.pi_dim:self.pi_dim+self.si_dim]
+        return input_p, input_s
 
     def train_step(self, data):
         """The logic for one training step.
@@ -70,16 +120,84 @@ class NIF(Model):
         data = data_adapter.expand_1d(data)
         x, y, sample_weight = data_adapter.unpack_x_y_sample_weight(data)
 
-        with backprop.GradientTape() as tape:
-            y_pred = self(x, training=True)
-            loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
-        self.optimizer.minimize(loss, self.trainable_variables, tape=tape)
+        if self.jit_compile_train_step:
+            # the groups have a data-dependent shape, so they are found before the XLA cluster, with their
+            # shape rounded up to powers of two so the cluster is only compiled for a few shapes
+            group = self.group_by_parameter and x.shape.rank == 2
+            groups = self._group_parameter_rows(self._split_inputs(x)[0], bucket=True) if group else None
+            loss, y_pred, grads = self._compiled_loss_and_gradients(x, y, sample_weight, groups)
+            self._apply_gradients(grads, loss)
+        elif self._loss_scaling:
+            # float16: the loss is scaled so small gradients do not underflow, the optimizer
+            # skips the steps with non-finite gradients and adjusts the scale
+            with backprop.GradientTape() as tape:
+                y_pred = self(x, training=True)
+                loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+                scaled_loss = self.optimizer.get_scaled_loss(loss)
+            grads = self.optimizer.get_unscaled_gradients(tape.gradient(scaled_loss, self.trainable_variables))
+            self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
+        else:
+            with backprop.GradientTape() as tape:
+                y_pred = self(x, training=True)
+                loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+            self.optimizer.minimize(loss, self.trainable_variables, tape=tape)
         self.compiled_metrics.update_state(y, y_pred, sample_weight)
         return {m.name: m.result() for m in self.metrics}
 
+    def _apply_gradients(self, grads, loss):
+        # optimizers whose step size depends on the loss (e.g., `L4Adam`) get it with the gradients
+        if getattr(self.optimizer, 'requires_loss', False):
+            self.optimizer.apply_gradients(zip(grads, self.trainable_variables), loss=loss)
+        else:
+            self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
+
+    @tf.function(jit_compile=True)
+    def _compiled_loss_and_gradients(self, x, y, sample_weight, groups=None):
+        # forward and backward pass as one XLA cluster, so the slicing and reshaping of the generated
+        # weights in the shapenet are fused instead of being dispatched op by op
+        with backprop.GradientTape() as tape:
+            y_pred = self(x, training=True, groups=groups)
+            loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+            scaled_loss = self.optimizer.get_scaled_loss(loss) if self._loss_scaling else loss
+        grads = tape.gradient(scaled_loss, self.trainable_variables)
+        if self._loss_scaling:
+            grads = self.optimizer.get_unscaled_gradients(grads)
+        return loss, y_pred, grads
+
+    def compile(self, optimizer='rmsprop', loss=None, metrics=None, jit_compile_train_step=False,
+                steps_per_execution=None, **kwargs):
+        """
+        same as `tf.keras.Model.compile`, with an opt-in compiled training mode.
+
+        Args:
+            jit_compile_train_step: compile the forward and backward pass of `train_step` with XLA.
+                With `group_by_parameter`, the unique parameters of a batch are found outside of
+                XLA (their number is data dependent), the number of groups and of points in the largest
+                group are rounded up to powers of two, so the cluster is compiled once per such bucket.
+            steps_per_execution: number of `train_step` (i.e., optimizer steps) run inside one
+                `tf.function` call, as a `tf.while_loop`, which removes the per-batch Python dispatch
+                that dominates small-batch training.
+
+        With a float16 `mixed_policy`, the optimizer is wrapped in a `LossScaleOptimizer` with
+        dynamic loss scaling (unless it already is one), bfloat16 does not need loss scaling.
+
+        Note that this applies to `fit` on the NIF instance itself, not to the functional model from `model()`.
+        """
+        super(NIF, self).compile(optimizer=optimizer, loss=loss, metrics=metrics,
+                                 steps_per_execution=steps_per_execution, **kwargs)
+        loss_scale_optimizer = tf.keras.mixed_precision.LossScaleOptimizer
+        if self.compute_Dtype == 'float16' and getattr(self.optimizer, 'requires_loss', False):
+            raise ValueError("{} needs the loss of each step and does not support loss scaling, "
+                             "use a float32 or bfloat16 mixed_policy".format(type(self.optimizer).__name__))
+        if self.compute_Dtype == 'float16' and not isinstance(self.optimizer, loss_scale_optimizer):
+            self.optimizer = loss_scale_optimizer(self.optimizer)
+        self._loss_scaling = isinstance(self.optimizer, loss_scale_optimizer)
+        self.jit_compile_train_step = jit_compile_train_step
+
     def _initialize_pnet(self, cfg_parameter_net, cfg_shape_net):
         # just simple implementation of a shortcut connected parameter net with a similar shapenet
-        self.po_dim = (self.l_sx)*self.n_sx**2 + (self.si_dim + self.so_dim + 1 + self.l_sx)*self.n_sx + self.so_dim
+        self.weight_layout = ShapeNetWeightLayout(self.si_dim, self.so_dim, self.n_sx, self.l_sx)
+        self.po_dim = self.weight_layout.po_dim
 
         # construct parameter_net
         pnet_layers_list = []
@@ -117,43 +235,22 @@ class NIF(Model):
         return pnet_layers_list
 
     @staticmethod
-    def _call_shape_net(input_s, pnet_output, si_dim, so_dim, n_sx, l_sx, activation, variable_dtype):
-        w_1 = tf.reshape(pnet_output[:, :si_dim*n_sx],
-                         [-1, si_dim, n_sx])
-        w_hidden_list = []
-        for i in range(l_sx):
-            w_tmp = tf.reshape(pnet_output[:,
-                               si_dim*n_sx + i*n_sx**2:
-                               si_dim*n_sx + (i + 1)*n_sx**2],
-                               [-1, n_sx, n_sx])
-            w_hidden_list.append(w_tmp)
-        w_l = tf.reshape(pnet_output[:,
-                         si_dim*n_sx + l_sx*n_sx**2:
-                         si_dim*n_sx + l_sx*n_sx**2 + so_dim*n_sx],
-                         [-1, n_sx, so_dim])
-        n_weights = si_dim*n_sx + l_sx*n_sx**2 + so_dim*n_sx
-
-        # distribute bias
-        b_1 = tf.reshape(pnet_output[:, n_weights: n_weights + n_sx],
-                         [-1, n_sx])
-        b_hidden_list = []
-        for i in range(l_sx):
-            b_tmp = tf.reshape(pnet_output[:, n_weights + n_sx + i*n_sx:
-                                              n_weights + n_sx + (i + 1)*n_sx], [-1, n_sx])
-            b_hidden_list.append(b_tmp)
-        b_l = tf.reshape(pnet_output[:,
-                         n_weights + (l_sx + 1)*n_sx:],
-                         [-1, so_dim])
+    def _call_shape_net(input_s, pnet_output, layout, activation, variable_dtype):
+        """
+        `input_s` is either point-wise, `[batch, si_dim]` with one row of `pnet_output` per point,
+        or snapshot-major, `[n_snapshots, n_points, si_dim]` with one row of `pnet_output` per snapshot.
+        `layout` is the `ShapeNetWeightLayout` of `pnet_output`.
+        """
+        w_1, w_hidden_list, w_l, b_1, b_hidden_list, b_l = layout.unpack(pnet_output,
+                                                                         snapshot_major=input_s.shape.rank == 3)
 
         # construct shape net
         act_fun = tf.keras.activations.get(activation)
-        u = act_fun(tf.einsum('ai,aij->aj', input_s, w_1) + b_1)
+        u = act_fun(_apply_generated_weight(input_s, w_1) + b_1)
 
-        for i in range(l_sx):
-            w_tmp = w_hidden_list[i]
-            b_tmp = b_hidden_list[i]
-            u = act_fun(tf.einsum('ai,aij->aj', u, w_tmp) + b_tmp) + u
-        u = tf.einsum('ai,aij->aj', u, w_l) + b_l
+        for w_tmp, b_tmp in zip(w_hidden_list, b_hidden_list):
+            u = act_fun(_apply_generated_weight(u, w_tmp) + b_tmp) + u
+        u = _apply_generated_weight(u, w_l) + b_l
         return tf.cast(u, variable_dtype)
 
     @staticmethod
@@ -164,6 +261,77 @@ class NIF(Model):
         output_final = pnet_list[-1](latent)
         return output_final, latent
 
+    @staticmethod
+    def _unique_parameter_rows(input_p):
+        """
+        find the unique rows of `input_p`.
+
+        returns the unique rows and, for each row of `input_p`, the index of its
+        unique row, so that `tf.gather(unique_p, idx)` recovers `input_p`. Rows are
+        compared exactly, column by column, so it works for any `pi_dim`.
+        """
+        idx = tf.unique(input_p[:, 0])[1]
+        for i in range(1, input_p.shape[-1]):
+            idx_i = tf.unique(input_p[:, i])[1]
+            n_i = tf.cast(tf.reduce_max(idx_i) + 1, tf.int64)
+            # combine the two dense ids and make them dense again, so the key never overflows
+            idx = tf.unique(tf.cast(idx, tf.int64)*n_i + tf.cast(idx_i, tf.int64))[1]
+        n_unique = tf.reduce_max(idx) + 1
+        first_row = tf.math.unsorted_segment_min(tf.range(tf.shape(input_p)[0]), idx, n_unique)
+        return tf.gather(input_p, first_row), idx
+
+    @classmethod
+    def _group_parameter_rows(cls, input_p, bucket=False):
+        """
+        group the rows of `input_p` by their unique parameter, for `_call_grouped`.
+
+        Returns:
+            `(unique_p, slots, idx, pos)`: the unique rows `[n_unique, pi_dim]`; the rows of each group,
+            `[n_unique, max_count]`, padded with `batch`; and, for each row of `input_p`, its group `idx`
+            and its position `pos` in the group, i.e., `slots[idx[i], pos[i]] == i`.
+
+        The shapes are data dependent, so this can not run inside XLA, `train_step` calls it before
+        the compiled forward and backward pass. With `bucket`, `n_unique` and `max_count` are rounded
+        up to powers of two, the extra groups repeat the first parameter and only hold padding, so
+        they cost some compute but do not change the outputs.
+        """
+        unique_p, idx = cls._unique_parameter_rows(input_p)
+        n_unique, batch = tf.shape(unique_p)[0], tf.shape(idx)[0]
+        counts = tf.math.bincount(idx, minlength=n_unique)
+        n_groups, max_count = n_unique, tf.reduce_max(counts)
+        if bucket:
+            n_groups, max_count = cls._next_power_of_two(n_groups), cls._next_power_of_two(max_count)
+            unique_p = tf.concat([unique_p, tf.repeat(unique_p[:1], n_groups - n_unique, axis=0)], axis=0)
+        # position of each row in its group, from a stable sort by group
+        order = tf.argsort(idx, stable=True)
+        pos_sorted = tf.range(batch) - tf.gather(tf.cumsum(counts, exclusive=True), tf.gather(idx, order))
+        pos = tf.scatter_nd(order[:, tf.newaxis], pos_sorted, [batch])
+        slots = tf.tensor_scatter_nd_update(tf.fill([n_groups, max_count], batch),
+                                            tf.stack([idx, pos], axis=-1), tf.range(batch))
+        return unique_p, slots, idx, pos
+
+    @staticmethod
+    def _next_power_of_two(n):
+        # smear the highest bit of `n - 1` into all lower bits, `n` is an int32 >= 1
+        n = n - 1
+        for shift in [1, 2, 4, 8, 16]:
+            n = tf.bitwise.bitwise_or(n, tf.bitwise.right_shift(n, shift))
+        return n + 1
+
+    def _call_grouped(self, input_s, groups):
+        """
+        parameter_net runs once per unique parameter, `pnet_output` is `[n_unique, po_dim]`, and the shapenet
+        runs snapshot-major on the points of each group, padded to the largest group, so neither the
+        generated weights nor anything of size `po_dim` exists per point. The padding costs shapenet
+        activations (not weights) when the groups are unbalanced.
+        """
+        unique_p, slots, idx, pos = groups
+        self.pnet_output = self._call_parameter_net(unique_p, self.pnet_list)[0]
+        # [n_unique, max_count, si_dim], a padding slot reads a row of zeros
+        input_s = tf.gather(tf.concat([input_s, tf.zeros_like(input_s[:1])], axis=0), slots)
+        u = self._call_shape_net_given_w(input_s, self.pnet_output)
+        return tf.gather_nd(u, tf.stack([idx, pos], axis=-1))
+
     def model(self):
         input_tot = tf.keras.layers.Input(shape=(self.si_dim + self.pi_dim), name='input')
         return Model(inputs=[input_tot], outputs=[self.call(input_tot)])
@@ -178,80 +346,99 @@ class NIF(Model):
         # this model: hidden LR -> weights and biases of shapenet
         return Model(inputs=[input_lr],outputs=[self.pnet_list[-1](input_lr)])
 
-    def model_x_to_u_given_w(self):
-        input_s = tf.keras.layers.Input(shape=(self.si_dim), dtype=self.variable_Dtype)
+    def model_x_to_u_given_w(self, snapshot_major=False):
+        # snapshot_major: x is [n_snapshots, n_points, si_dim], with one row of w per snapshot
+        input_s = tf.keras.layers.Input(shape=(None, self.si_dim) if snapshot_major else (self.si_dim),
+                                        dtype=self.variable_Dtype)
         input_pnet = tf.keras.layers.Input(shape=(self.pnet_list[-1].output_shape[1]), dtype=self.variable_Dtype)
         return Model(inputs=[input_s, input_pnet],
                      outputs=[self._call_shape_net(tf.cast(input_s,self.compute_Dtype),
                                                    tf.cast(input_pnet,self.compute_Dtype),
-                                                   si_dim=self.si_dim,
-                                                   so_dim=self.so_dim,
-                                                   n_sx=self.n_sx,
-                                                   l_sx=self.l_sx,
+                                                   layout=self.weight_layout,
                                                    activation=self.cfg_shape_net['activation'],
                                                    variable_dtype=self.variable_Dtype)])
 
-class PNIF(NIF):
-    def __init__(self, cfg_shape_net, cfg_parameter_net, mixed_policy):
-        super(PNIF, self).__init__(cfg_shape_net, cfg_parameter_net, mixed_policy)
-
-        # initialize the mask structure
-        self.mask_list = self._initialize_masks()
-
-    def call(self, inputs, training=None, mask=None):
-        input_p = inputs[:, 0:self.pi_dim]
-        input_s = inputs[:, self.pi_dim:self.pi_dim+self.si_dim]
-        # get parameter from parameter_net
-        self.pnet_output = self._call_parameter_net(input_p, self.pnet_list, self.mask_list)[0]
-        return self._call_shape_net(tf.cast(input_s,self.compute_Dtype),
-                                    self.pnet_output,
-                                    si_dim=self.si_dim,
-                                    so_dim=self.so_dim,
-                                    n_sx=self.n_sx,
-                                    l_sx=self.l_sx,
+    def _call_shape_net_given_w(self, input_s, pnet_output):
+        return self._call_shape_net(tf.cast(input_s, self.compute_Dtype),
+                                    tf.cast(pnet_output, self.compute_Dtype),
+                                    layout=self.weight_layout,
                                     activation=self.cfg_shape_net['activation'],
                                     variable_dtype=self.variable_Dtype)
 
-    def _initialize_masks(self):
-        '''
-        Initializes list of masks that will be inserted into pnet_list.
-        '''
-        mask_list = []
-
-        input_mask = MaskLayer(self.pi_dim, self.n_st)
-        mask_list.append(input_mask)
-        
-    def call(self, inputs, training=None, mask=None):
-        input_p = inputs[:, 0:self.pi_dim]
-        input_s = inputs[:, self.pi_dim:self.pi_dim+self.si_dim]
-        # get parameter from parameter_net
-        self.pnet_output = self._call_parameter_net(input_p, self.pnet_list)[0]
-        return self._call_shape_net(tf.cast(input_s,self.compute_Dtype),
-                                    self.pnet_output,
-                                    si_dim=self.si_dim,
-                                    so_dim=self.so_dim,
-                                    n_sx=self.n_sx,
-                                    l_sx=self.l_sx,
-                                    activation=self.cfg_shape_net['activation'],
-                                    variable_dtype=self.variable_Dtype)
+    def _call_predict_field_chunk(self, x_points, pnet_output):
+        # the points `x_points` `[n_points, si_dim]` are shared by every snapshot, i.e., row of `pnet_output`
+        input_s = tf.broadcast_to(x_points, tf.concat([tf.shape(pnet_output)[:1], tf.shape(x_points)], axis=0))
+        return self._call_shape_net_given_w(input_s, pnet_output)
+
+    def predict_field(self, p, x_points, chunk_size=65536, out=None):
+        """
+        evaluate the field of each parameter in `p` on the points `x_points`, chunk by chunk.
+
+        the shapenet weights are generated once per parameter and applied to `chunk_size`
+        points at a time (one dense matmul per snapshot), the result is written into `out`,
+        so peak memory does not depend on the number of points.
+
+        Args:
+            p: `[pi_dim]` or `[n_snapshots, pi_dim]`.
+            x_points: `[n_points, si_dim]`, can be a memmap.
+            chunk_size: number of points evaluated at once.
+            out: preallocated C-contiguous `[n_snapshots, n_points, so_dim]` array (or `[n_points, so_dim]`
+                for a single parameter), or a file name to create it as a `.npy` memmap. Allocated if `None`.
+
+        Returns:
+            `out`
+        """
+        single = np.ndim(p) == 1
+        p = np.asarray(p, dtype=self.variable_Dtype).reshape(-1, self.pi_dim)
+        n_snapshots, n_points = p.shape[0], x_points.shape[0]
+        shape = (n_snapshots, n_points, self.so_dim)
+        if out is None:
+            out = np.empty(shape[1:] if single else shape, dtype=self.variable_Dtype)
+        elif isinstance(out, str):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=self.variable_Dtype,
+                                            shape=shape[1:] if single else shape)
+        elif out.shape != (shape[1:] if single else shape):
+            raise ValueError("out has shape {}, expected {}".format(out.shape, shape[1:] if single else shape))
+        elif not out.flags.c_contiguous:
+            # reshaping it would silently write into a copy
+            raise ValueError("out must be C-contiguous")
+        elif not np.can_cast(self.variable_Dtype, out.dtype):
+            raise ValueError("out has dtype {}, which can not hold {}".format(out.dtype, self.variable_Dtype))
+        out_3d = out.reshape(shape)
+
+        pnet_output = tf.cast(self._call_parameter_net(tf.constant(p), self.pnet_list)[0], self.variable_Dtype)
+        for i in range(0, n_points, chunk_size):
+            x = np.asarray(x_points[i:i + chunk_size], dtype=self.variable_Dtype)
+            out_3d[:, i:i + chunk_size] = self._predict_field_chunk(tf.constant(x), pnet_output).numpy()
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+class PNIF(NIF):
+    def __init__(self, cfg_shape_net, cfg_parameter_net, mixed_policy='float32'):
+        super(PNIF, self).__init__(cfg_shape_net, cfg_parameter_net, mixed_policy)
+        self.cfg_parameter_net = cfg_parameter_net
 
     def _initialize_pnet(self, cfg_parameter_net, cfg_shape_net):
         # just simple implementation of a shortcut connected parameter net with a similar shapenet
-        self.po_dim = (self.l_sx)*self.n_sx**2 + (self.si_dim + self.so_dim + 1 + self.l_sx)*self.n_sx + self.so_dim
+        self.weight_layout = ShapeNetWeightLayout(self.si_dim, self.so_dim, self.n_sx, self.l_sx)
+        self.po_dim = self.weight_layout.po_dim
 
         # construct parameter_net
         pnet_layers_list = []
         # 1. first layer
         layer_1 = MaskLayer(self.pi_dim, self.n_st, cfg_parameter_net['activation'],
                         kernel_initializer=initializers.TruncatedNormal(stddev=0.1),
-                        bias_initializer=initializers.TruncatedNormal(stddev=0.1))
+                        bias_initializer=initializers.TruncatedNormal(stddev=0.1),
+                        mixed_policy=self.mixed_policy)
         pnet_layers_list.append(layer_1)
 
         # 2. hidden layer
         for i in range(self.l_st):
             tmp_layer = MaskLayer(self.n_st, self.n_st, cfg_parameter_net['activation'],
                                            kernel_initializer=initializers.TruncatedNormal(stddev=0.1),
-                                           bias_initializer=initializers.TruncatedNormal(stddev=0.1))
+                                           bias_initializer=initializers.TruncatedNormal(stddev=0.1),
+                                           mixed_policy=self.mixed_policy)
             # identity_layer = Lambda(lambda x: x)
             # tmp_layer =tf.keras.layers.Add()(identity_layer,tmp_layer)
             pnet_layers_list.append(tmp_layer)
@@ -259,56 +446,164 @@ class PNIF(NIF):
         # 3. bottleneck layer
         bottleneck_layer = MaskLayer(self.n_st, self.pi_hidden, activation=None,
                                  kernel_initializer=initializers.TruncatedNormal(stddev=0.1),
-                                 bias_initializer=initializers.TruncatedNormal(stddev=0.1))
+                                 bias_initializer=initializers.TruncatedNormal(stddev=0.1),
+                                 mixed_policy=self.mixed_policy)
         pnet_layers_list.append(bottleneck_layer)
 
-        # 4. last layer
+        # 4. last layer, a pruned column is a pruned shapenet weight, i.e., exactly zero
         last_layer = MaskLayer(self.pi_hidden, self.po_dim, activation=None,
                            kernel_initializer=initializers.TruncatedNormal(stddev=0.1),
-                           bias_initializer=initializers.TruncatedNormal(stddev=0.1))
+                           bias_initializer=initializers.TruncatedNormal(stddev=0.1),
+                           mask_bias=True,
+                           mixed_policy=self.mixed_policy)
         pnet_layers_list.append(last_layer)
 
         return pnet_layers_list
     
-    def update_masks(self, sparsity):
-        '''
-        Add keyword like "Magnitude" to choose which type of pruning you want to do 
+    def update_masks(self, sparsity, ranking='layer', shape_net='columns'):
         '''
-        for layer in self.pnet_list[:-1]:
-            #omit last layer because it is not prunable 
-            layer.pruneLowMagnitude(sparsity)
-          
-        
-        self.pnet_list[-1].pruneShapeNet(sparsity, self.si_dim, self.n_sx, self.l_sx, self.so_dim)
-            
-        '''
-        Make loop that does model.fit for however many times we want to prune
-        call ori_model.update_masks each time 
+        prune the parameter net and the shapenet to `sparsity`.
+
+        ranking: 'layer' prunes `sparsity` of each layer of the parameter net, 'global' ranks
+            the weights of all its layers together, so layers end up with different sparsity.
+        shape_net: 'columns' prunes single shapenet weights (`MaskLayer.pruneShapeNet`),
+            'neurons' prunes whole shapenet neurons (`prune_shape_net_neurons`).
+
+        see `nif.pruning.PruningScheduler` for the loop of pruning and finetuning.
         '''
+        if ranking == 'layer':
+            for layer in self.pnet_list[:-1]:
+                #omit last layer because it is not prunable
+                layer.pruneLowMagnitude(sparsity)
+        elif ranking == 'global':
+            self.prune_global_magnitude(sparsity)
+        else:
+            raise ValueError("ranking can only be 'layer' or 'global'")
 
-    def call(self, inputs):
-        #Perform element-wise multiplication
-        return tf.multiply(inputs, self.mask)
+        if shape_net == 'columns':
+            self.pnet_list[-1].pruneShapeNet(sparsity, self.si_dim, self.n_sx, self.l_sx, self.so_dim)
+        elif shape_net == 'neurons':
+            self.prune_shape_net_neurons(sparsity)
+        else:
+            raise ValueError("shape_net can only be 'columns' or 'neurons'")
 
-class NIFMultiScale(NIF):
-    def __init__(self, cfg_shape_net, cfg_parameter_net, mixed_policy='float32'):
-        super(NIFMultiScale, self).__init__(cfg_shape_net, cfg_parameter_net, mixed_policy)
+    def prune_global_magnitude(self, sparsity):
+        """
+        prune the `sparsity` fraction of smallest |w| over all layers of the parameter net but the last one.
 
-    def call(self, inputs, training=None, mask=None):
-            input_p = inputs[:, 0:self.pi_dim]
-            input_s = inputs[:, self.pi_dim:self.pi_dim+self.si_dim]
-            # get parameter from parameter_net
-            self.pnet_output = self._call_parameter_net(input_p, self.pnet_list)[0]
-            return self._call_shape_net_mres(tf.cast(input_s, self.compute_Dtype),
-                                             self.pnet_output,
-                                             flag_resblock=self.cfg_shape_net['use_resblock'],
-                                             omega_0=tf.cast(self.cfg_shape_net['omega_0'], self.compute_Dtype),
-                                             si_dim=self.si_dim,
-                                             so_dim=self.so_dim,
-                                             n_sx=self.n_sx,
-                                             l_sx=self.l_sx,
-                                             variable_dtype=self.variable_dtype
-                                             )
+        |w| of all layers is ranked together with one `top_k`, pruned weights count as zero so they
+        stay pruned, and every mask is updated in place, so it also works inside `tf.function`.
+        """
+        layers = self.pnet_list[:-1]
+        w_abs = [tf.abs(tf.multiply(l.w, l.mask)) for l in layers]
+        keep = magnitude_mask(tf.concat([tf.reshape(w, [-1]) for w in w_abs], axis=0), sparsity)
+        for l, k in zip(layers, tf.split(keep, [int(np.prod(w.shape)) for w in w_abs])):
+            l.mask.assign(tf.multiply(l.mask, tf.cast(tf.reshape(k, l.mask.shape), l.mask.dtype)))
+
+    def prune_shape_net_neurons(self, sparsity):
+        """
+        structured pruning of the shapenet: prune every weight read from the `sparsity` fraction of
+        shapenet neurons with the smallest mean |w| in the last layer, so `compact` can remove them.
+        """
+        last_layer = self.pnet_list[-1]
+        w, _ = last_layer.effective_weights()
+        w_col = np.abs(w).mean(axis=0)
+        score = [w_col[self.weight_layout.neuron_outgoing_columns(k)].mean() for k in range(self.n_sx)]
+        mask = last_layer.mask.numpy()
+        for k in np.argsort(score)[:int(np.rint(sparsity*self.n_sx))]:
+            mask[:, self.weight_layout.neuron_outgoing_columns(k)] = 0.
+        last_layer.set_mask(mask)
+
+    def compact(self):
+        """
+        physically remove what is pruned by the masks, returns an equivalent but smaller dense `NIFCompact`.
+
+        - parameter_net: a unit without any unpruned outgoing weight is removed, a unit without any
+          unpruned incoming weight outputs a constant, which is folded into the bias of the next layer.
+        - shapenet: a neuron whose outgoing weights are all pruned is removed from every layer,
+          so `n_sx` and `po_dim` shrink.
+        - last layer: only the unpruned columns are computed, the pruned weights are zeros.
+        """
+        activation = tf.keras.activations.get(self.cfg_parameter_net['activation'])
+        w_list, b_list = zip(*[l.effective_weights() for l in self.pnet_list])
+        w_list, b_list = list(w_list), list(b_list)
+        act_list = [activation]*(len(self.pnet_list) - 2) + [None, None]
+
+        # 1. shapenet neurons and the active columns of the last layer
+        col_active = np.any(w_list[-1] != 0, axis=0) | (b_list[-1] != 0)
+        keep = [k for k in range(self.n_sx)
+                if np.any(col_active[self.weight_layout.neuron_outgoing_columns(k)])]
+        keep = keep if len(keep) > 0 else [0]
+        columns = self.weight_layout.compact_columns(keep)
+        active = np.flatnonzero(col_active[columns])
+        index = np.full(columns.shape, active.size, dtype=np.int32)
+        index[active] = np.arange(active.size)
+        w_list[-1] = w_list[-1][:, columns[active]]
+        b_list[-1] = b_list[-1][columns[active]]
+
+        # 2. parameter_net units without outgoing weights, from the last hidden layer backward
+        for i in reversed(range(len(w_list) - 1)):
+            alive = np.flatnonzero(np.any(w_list[i + 1] != 0, axis=1))
+            alive = alive if alive.size > 0 else np.arange(1)
+            w_list[i], b_list[i] = w_list[i][:, alive], b_list[i][alive]
+            w_list[i + 1] = w_list[i + 1][alive]
+
+        # 3. parameter_net units without incoming weights are constant, folded into the next layer
+        for i in range(len(w_list) - 1):
+            constant = np.flatnonzero(np.all(w_list[i] == 0, axis=0))
+            alive = np.setdiff1d(np.arange(w_list[i].shape[1]), constant)
+            if constant.size == 0 or alive.size == 0:
+                continue
+            c = b_list[i][constant]
+            if act_list[i] is not None:
+                c = act_list[i](tf.constant(c)).numpy()
+            b_list[i + 1] = b_list[i + 1] + c @ w_list[i + 1][constant]
+            w_list[i], b_list[i] = w_list[i][:, alive], b_list[i][alive]
+            w_list[i + 1] = w_list[i + 1][alive]
+
+        cfg_shape_net = dict(self.cfg_shape_net, units=len(keep))
+        cfg_parameter_net = dict(self.cfg_parameter_net,
+                                 units=[w.shape[1] for w in w_list[:-2]],
+                                 latent_dim=w_list[-2].shape[1],
+                                 last_layer_units=active.size)
+        model = NIFCompact(cfg_shape_net, cfg_parameter_net, self.mixed_policy.name)
+        model(tf.zeros((1, self.pi_dim + self.si_dim), self.variable_Dtype))
+        for l, w, b in zip(model.pnet_list, w_list, b_list):
+            l.set_weights([w, b] + ([index] if isinstance(l, ActiveColumnDense) else []))
+        return model
+
+
+class NIFCompact(NIF):
+    """
+    NIF with a plain MLP parameter net of arbitrary widths, as produced by `PNIF.compact`.
+
+    `cfg_parameter_net['units']` is the list of widths of the first and hidden layers and
+    `cfg_parameter_net['last_layer_units']` the number of computed columns of the last layer,
+    the other columns of `pnet_output` are zero.
+    """
+    def _initialize_pnet(self, cfg_parameter_net, cfg_shape_net):
+        self.weight_layout = ShapeNetWeightLayout(self.si_dim, self.so_dim, self.n_sx, self.l_sx)
+        self.po_dim = self.weight_layout.po_dim
+
+        pnet_layers_list = []
+        # 1. first and hidden layers
+        for width in cfg_parameter_net['units']:
+            pnet_layers_list.append(Dense(width, cfg_parameter_net['activation'], dtype=self.mixed_policy))
+
+        # 2. bottleneck layer
+        pnet_layers_list.append(Dense(self.pi_hidden, dtype=self.mixed_policy))
+
+        # 3. last layer
+        n_active = cfg_parameter_net.get('last_layer_units', self.po_dim)
+        if n_active == self.po_dim:
+            pnet_layers_list.append(Dense(self.po_dim, dtype=self.mixed_policy))
+        else:
+            pnet_layers_list.append(ActiveColumnDense(self.pi_hidden, n_active, self.po_dim, self.mixed_policy))
+        return pnet_layers_list
+
+class NIFMultiScale(NIF):
+    def __init__(self, cfg_shape_net, cfg_parameter_net, mixed_policy='float32', group_by_parameter=False):
+        super(NIFMultiScale, self).__init__(cfg_shape_net, cfg_parameter_net, mixed_policy, group_by_parameter)
 
     def _initialize_pnet(self, cfg_parameter_net, cfg_shape_net):
         """
@@ -328,12 +623,12 @@ class NIFMultiScale(NIF):
         pnet_layers_list = []
         if cfg_shape_net['connectivity'] == 'full':
             # very first, determine the output dimension of parameter_net
-            if cfg_shape_net['use_resblock']:
-                self.po_dim = (2*self.l_sx)*self.n_sx**2 + (self.si_dim + self.so_dim + 1 + 2*self.l_sx)*self.n_sx + self.so_dim
-            else:
-                self.po_dim = (self.l_sx)*self.n_sx**2 + (self.si_dim + self.so_dim + 1 + self.l_sx)*self.n_sx + self.so_dim
+            self.weight_layout = ShapeNetWeightLayout(self.si_dim, self.so_dim, self.n_sx, self.l_sx,
+                                                      resblock=cfg_shape_net['use_resblock'])
+            self.po_dim = self.weight_layout.po_dim
         elif cfg_shape_net['connectivity'] == 'last_layer':
             # only parameterize the last layer
+            self.weight_layout = None
             self.po_dim = self.pi_hidden
         else:
             raise ValueError("cfg_shape_net missing correct `connectivity`")
@@ -373,10 +668,7 @@ class NIFMultiScale(NIF):
             pnet_layers_list.append(bottleneck_layer)
 
             # 4. last layer
-            last_layer = HyperLinearForSIREN(self.pi_hidden, self.po_dim,
-                                             cfg_shape_net,
-                                             self.mixed_policy,
-                                             connectivity=cfg_shape_net['connectivity'])
+            last_layer = self._initialize_hyper_linear(cfg_parameter_net, cfg_shape_net)
             # last_layer = SIREN(self.pi_hidden, self.po_dim, 'last',
             #                    cfg_parameter_net['omega_0'],
             #                    cfg_shape_net['omega_0'], cfg_shape_net,
@@ -420,140 +712,80 @@ class NIFMultiScale(NIF):
             pnet_layers_list.append(bottleneck_layer)
 
             # 4. last layer
-            last_layer = HyperLinearForSIREN(self.pi_hidden, self.po_dim,
-                                             cfg_shape_net,
-                                             self.mixed_policy,
-                                             connectivity=cfg_shape_net['connectivity'])
+            last_layer = self._initialize_hyper_linear(cfg_parameter_net, cfg_shape_net)
             pnet_layers_list.append(last_layer)
 
         return pnet_layers_list
 
+    def _initialize_hyper_linear(self, cfg_parameter_net, cfg_shape_net):
+        """
+        the last layer of parameter_net, with `cfg_parameter_net['head_devices']` (e.g., `['/GPU:0', '/GPU:1']`)
+        its kernel is sharded over these devices by shapenet layers, see `ShardedHyperLinearForSIREN`.
+        """
+        devices = cfg_parameter_net.get('head_devices')
+        if devices is not None and len(devices) > 1 and cfg_shape_net['connectivity'] == 'full':
+            return ShardedHyperLinearForSIREN(self.pi_hidden, cfg_shape_net, self.mixed_policy, devices,
+                                              self.weight_layout)
+        return HyperLinearForSIREN(self.pi_hidden, self.po_dim,
+                                   cfg_shape_net,
+                                   self.mixed_policy,
+                                   connectivity=cfg_shape_net['connectivity'])
+
     @staticmethod
-    def _call_shape_net_mres(input_s, pnet_output, flag_resblock, omega_0, si_dim, so_dim, n_sx, l_sx, variable_dtype):
-        """
-        distribute `pnet_output` into weight and bias, it depends on the type of shapenet.
-
-        For now, we only support shapenet having the following structure,
-            - resnet-block
-            - plain fnn
-        """
-        if flag_resblock:
-            # distribute weights
-            w_1 = tf.reshape(pnet_output[:, :si_dim*n_sx],
-                             [-1, si_dim, n_sx])
-            w_hidden_list = []
-            for i in range(l_sx):
-                w1_tmp = tf.reshape(pnet_output[:,
-                                    si_dim*n_sx + 2*i*n_sx**2:
-                                    si_dim*n_sx + (2*i + 1)*n_sx**2],
-                                    [-1, n_sx, n_sx])
-                w2_tmp = tf.reshape(pnet_output[:,
-                                    si_dim*n_sx + (2*i + 1)*n_sx**2:
-                                    si_dim*n_sx + (2*i + 2)*n_sx**2],
-                                    [-1, n_sx, n_sx])
-                w_hidden_list.append([w1_tmp, w2_tmp])
-            w_l = tf.reshape(pnet_output[:,
-                             si_dim*n_sx + (2*l_sx)*n_sx**2:
-                             si_dim*n_sx + (2*l_sx)*n_sx**2 + so_dim*n_sx],
-                             [-1, n_sx, so_dim])
-
-            n_weights = si_dim*n_sx + (2*l_sx)*n_sx**2 + so_dim*n_sx
-
-            # distribute bias
-            b_1 = tf.reshape(pnet_output[:, n_weights: n_weights + n_sx],
-                             [-1, n_sx])
-            b_hidden_list = []
-            for i in range(l_sx):
-                b1_tmp = tf.reshape(pnet_output[:,
-                                    n_weights + n_sx + 2*i*n_sx:
-                                    n_weights + n_sx + (2*i + 1)*n_sx],
-                                    [-1, n_sx])
-                b2_tmp = tf.reshape(pnet_output[:,
-                                    n_weights + n_sx + (2*i + 1)*n_sx:
-                                    n_weights + n_sx + (2*i + 2)*n_sx],
-                                    [-1, n_sx])
-                b_hidden_list.append([b1_tmp, b2_tmp])
-            b_l = tf.reshape(pnet_output[:, n_weights + (2*l_sx + 1)*n_sx:], [-1, so_dim])
-
-            # construct shape net
-            u = tf.math.sin(omega_0*tf.einsum('ai,aij->aj', input_s, w_1) + b_1)
-            for i in range(l_sx):
-                h = tf.math.sin(omega_0*tf.einsum('ai,aij->aj', u, w_hidden_list[i][0]) + b_hidden_list[i][0])
-                u = 0.5*(u + tf.math.sin(omega_0*tf.einsum('ai,aij->aj', h, w_hidden_list[i][1]) + b_hidden_list[i][1]))
-            u = tf.einsum('ai,aij->aj', u, w_l) + b_l
+    def _call_shape_net_mres(input_s, pnet_output, layout, omega_0, variable_dtype):
+        """
+        `input_s` is either point-wise, `[batch, si_dim]`, or snapshot-major,
+        `[n_snapshots, n_points, si_dim]` with one row of `pnet_output` per snapshot.
+        `layout` is the `ShapeNetWeightLayout` of `pnet_output`, with or without resblock.
+        """
+        w_1, w_hidden_list, w_l, b_1, b_hidden_list, b_l = layout.unpack(pnet_output,
+                                                                         snapshot_major=input_s.shape.rank == 3)
 
+        # construct shape net
+        u = tf.math.sin(omega_0*_apply_generated_weight(input_s, w_1) + b_1)
+        if layout.resblock:
+            for (w1_tmp, w2_tmp), (b1_tmp, b2_tmp) in zip(w_hidden_list, b_hidden_list):
+                h = tf.math.sin(omega_0*_apply_generated_weight(u, w1_tmp) + b1_tmp)
+                u = 0.5*(u + tf.math.sin(omega_0*_apply_generated_weight(h, w2_tmp) + b2_tmp))
         else:
-            # distribute weights
-            w_1 = tf.reshape(pnet_output[:, :si_dim*n_sx],
-                             [-1, si_dim, n_sx])
-            w_hidden_list = []
-            for i in range(l_sx):
-                w_tmp = tf.reshape(pnet_output[:,
-                                   si_dim*n_sx + i*n_sx**2:
-                                   si_dim*n_sx + (i + 1)*n_sx**2],
-                                   [-1, n_sx, n_sx])
-                w_hidden_list.append(w_tmp)
-            w_l = tf.reshape(pnet_output[:,
-                             si_dim*n_sx + l_sx*n_sx**2:
-                             si_dim*n_sx + l_sx*n_sx**2 + so_dim*n_sx],
-                             [-1, n_sx, so_dim])
-            n_weights = si_dim*n_sx + l_sx*n_sx**2 + so_dim*n_sx
-
-            # distribute bias
-            b_1 = tf.reshape(pnet_output[:, n_weights: n_weights + n_sx],
-                             [-1, n_sx])
-            b_hidden_list = []
-            for i in range(l_sx):
-                b_tmp = tf.reshape(pnet_output[:, n_weights + n_sx + i*n_sx:
-                                                  n_weights + n_sx + (i + 1)*n_sx], [-1, n_sx])
-                b_hidden_list.append(b_tmp)
-            b_l = tf.reshape(pnet_output[:,
-                             n_weights + (l_sx + 1)*n_sx:],
-                             [-1, so_dim])
-
-            # construct shape net
-            u = tf.math.sin(omega_0*tf.einsum('ai,aij->aj', input_s, w_1) + b_1)
-            for i in range(l_sx):
-                u = tf.math.sin(omega_0*tf.einsum('ai,aij->aj', u, w_hidden_list[i]) + b_hidden_list[i])
-            u = tf.einsum('ai,aij->aj', u, w_l) + b_l
+            for w_tmp, b_tmp in zip(w_hidden_list, b_hidden_list):
+                u = tf.math.sin(omega_0*_apply_generated_weight(u, w_tmp) + b_tmp)
+        u = _apply_generated_weight(u, w_l) + b_l
 
         return tf.cast(u, variable_dtype)
 
-    def model_x_to_u_given_w(self):
-        input_s = tf.keras.layers.Input(shape=(self.si_dim))
+    def model_x_to_u_given_w(self, snapshot_major=False):
+        # snapshot_major: x is [n_snapshots, n_points, si_dim], with one row of w per snapshot
+        input_s = tf.keras.layers.Input(shape=(None, self.si_dim) if snapshot_major else (self.si_dim))
         input_pnet = tf.keras.layers.Input(shape=(self.pnet_list[-1].output_shape[1]))
         return Model(inputs=[input_s, input_pnet],
                      outputs=[self._call_shape_net_mres(tf.cast(input_s, self.compute_Dtype),
                                                         tf.cast(input_pnet, self.compute_Dtype),
-                                                        flag_resblock=self.cfg_shape_net['use_resblock'],
+                                                        layout=self.weight_layout,
                                                         omega_0=tf.cast(self.cfg_shape_net['omega_0'],
                                                                         self.compute_Dtype),
-                                                        si_dim=self.si_dim,
-                                                        so_dim=self.so_dim,
-                                                        n_sx=self.n_sx,
-                                                        l_sx=self.l_sx,
-                                                        variable_dtype=self.variable_dtype
+                                                        variable_dtype=self.variable_Dtype
                                                         )])
 
+    def _call_shape_net_given_w(self, input_s, pnet_output):
+        return self._call_shape_net_mres(tf.cast(input_s, self.compute_Dtype),
+                                         tf.cast(pnet_output, self.compute_Dtype),
+                                         layout=self.weight_layout,
+                                         omega_0=tf.cast(self.cfg_shape_net['omega_0'], self.compute_Dtype),
+                                         variable_dtype=self.variable_Dtype)
 
 class NIFMultiScaleLastLayerParameterized(NIFMultiScale):
-    def __init__(self, cfg_shape_net, cfg_parameter_net, mixed_policy='float32'):
-        super(NIFMultiScaleLastLayerParameterized, self).__init__(cfg_shape_net, cfg_parameter_net, mixed_policy)
+    def __init__(self, cfg_shape_net, cfg_parameter_net, mixed_policy='float32', group_by_parameter=False):
+        super(NIFMultiScaleLastLayerParameterized, self).__init__(cfg_shape_net, cfg_parameter_net, mixed_policy,
+                                                                  group_by_parameter)
         assert cfg_shape_net['connectivity'] == 'last_layer'
         self.snet_list, self.last_layer_bias = self._initialize_snet(cfg_shape_net, cfg_parameter_net)
-
-    def call(self, inputs, training=None, mask=None):
-        input_p = inputs[:, 0:self.pi_dim]
-        input_s = inputs[:, self.pi_dim:self.pi_dim+self.si_dim]
-        # get parameter from parameter_net
-        self.pnet_output = self._call_parameter_net(input_p, self.pnet_list)[0]
-        return self._call_shape_net_mres_only_para_last_layer(tf.cast(input_s, self.compute_Dtype),
-                                                              self.snet_list,
-                                                              tf.cast(self.last_layer_bias, self.compute_Dtype),
-                                                              self.pnet_output,
-                                                              self.so_dim,
-                                                              self.pi_hidden,
-                                                              self.variable_dtype)
+        # spatial basis on a fixed mesh, see `cache_spatial_basis`
+        self.phi_x_cache = None
+        self.n_points_cached = None
+        # traced once for any number of points
+        self._phi_x_chunk = tf.function(self._call_phi_x_chunk, input_signature=[
+            tf.TensorSpec([None, self.si_dim], self.variable_Dtype)])
 
     def model_p_to_lr(self):
         input_p = tf.keras.layers.Input(shape=(self.pi_dim))
@@ -569,8 +801,9 @@ class NIFMultiScaleLastLayerParameterized(NIFMultiScale):
     def model_lr_to_w(self):
         raise ValueError("In this class: NIFMultiScaleLastLayerParameterization, `w` is the same as `lr`")
 
-    def model_x_to_u_given_w(self):
-        input_s = tf.keras.layers.Input(shape=(self.si_dim))
+    def model_x_to_u_given_w(self, snapshot_major=False):
+        # snapshot_major: x is [n_snapshots, n_points, si_dim], with one row of w per snapshot
+        input_s = tf.keras.layers.Input(shape=(None, self.si_dim) if snapshot_major else (self.si_dim))
         input_pnet = tf.keras.layers.Input(shape=(self.pnet_list[-1].output_shape[1]))
         return Model(inputs=[input_s, input_pnet],
                      outputs=[self._call_shape_net_mres_only_para_last_layer(tf.cast(input_s, self.compute_Dtype),
@@ -579,9 +812,77 @@ class NIFMultiScaleLastLayerParameterized(NIFMultiScale):
                                                                              tf.cast(input_pnet, self.compute_Dtype),
                                                                              self.so_dim,
                                                                              self.pi_hidden,
-                                                                             self.variable_dtype)])
+                                                                             self.variable_Dtype)])
 
+    def _call_shape_net_given_w(self, input_s, pnet_output):
+        return self._call_shape_net_mres_only_para_last_layer(tf.cast(input_s, self.compute_Dtype),
+                                                              self.snet_list,
+                                                              tf.cast(self.last_layer_bias, self.compute_Dtype),
+                                                              tf.cast(pnet_output, self.compute_Dtype),
+                                                              self.so_dim,
+                                                              self.pi_hidden,
+                                                              self.variable_Dtype)
+
+    def _call_phi_x_chunk(self, input_s):
+        return self._call_shape_net_get_phi_x(tf.cast(input_s, self.compute_Dtype), self.snet_list,
+                                              self.so_dim, self.pi_hidden)
+
+    def _call_predict_field_chunk(self, x_points, pnet_output):
+        # the mesh is shared by all snapshots, so phi_x is computed once per chunk,
+        # [n_points*so_dim, pi_hidden] x [pi_hidden, n_snapshots]
+        phi_x = tf.reshape(self._call_phi_x_chunk(x_points), [-1, self.pi_hidden])
+        u = tf.matmul(phi_x, tf.cast(pnet_output, self.compute_Dtype), transpose_b=True)
+        u = tf.reshape(tf.transpose(u), [tf.shape(pnet_output)[0], -1, self.so_dim])
+        return tf.cast(u + tf.cast(self.last_layer_bias, self.compute_Dtype), self.variable_Dtype)
+
+    def cache_spatial_basis(self, x_points, dtype=None, chunk_size=65536):
+        """
+        compute the spatial basis `phi_x` once for a fixed mesh `x_points` `[n_points, si_dim]`.
+
+        `phi_x` only depends on `x`, it is stored as a `[n_points*so_dim, pi_hidden]` matrix in
+        `dtype` (e.g., 'float16' to halve the memory, default: variable dtype), so that any number
+        of snapshots can be reconstructed with one GEMM by `reconstruct_from_spatial_basis`, which is
+        fastest with the cache in the compute dtype.
+        """
+        dtype = self.variable_Dtype if dtype is None else dtype
+        n_points = x_points.shape[0]
+        phi_x = np.empty((n_points*self.so_dim, self.pi_hidden), dtype=dtype)
+        for i in range(0, n_points, chunk_size):
+            x = np.asarray(x_points[i:i + chunk_size], dtype=self.variable_Dtype)
+            phi_x_chunk = self._phi_x_chunk(tf.constant(x)).numpy()
+            phi_x[i*self.so_dim:(i + x.shape[0])*self.so_dim] = phi_x_chunk.reshape(-1, self.pi_hidden)
+        self.n_points_cached = n_points
+        self.phi_x_cache = tf.constant(phi_x)
+        return self.phi_x_cache
+
+    def reconstruct_from_spatial_basis(self, p=None, lr=None, chunk_size=65536):
+        """
+        reconstruct snapshots on the mesh given to `cache_spatial_basis`.
 
+        either the parameters `p` `[n_snapshots, pi_dim]` or directly the latent
+        representation `lr` `[n_snapshots, pi_hidden]` (e.g., from a ROM time-stepper) is given.
+        `[n_points*so_dim, pi_hidden] x [pi_hidden, n_snapshots]` is a single GEMM if the cache is
+        in the compute dtype. A compact cache (e.g., float16) is cast `chunk_size` points at a time,
+        so it is never copied whole into the compute dtype.
+
+        Returns:
+            `[n_snapshots, n_points, so_dim]`
+        """
+        if self.phi_x_cache is None:
+            raise RuntimeError("there is no spatial basis, call `cache_spatial_basis` with the mesh first")
+        if lr is None:
+            p = tf.reshape(tf.cast(p, self.variable_Dtype), [-1, self.pi_dim])
+            lr = self._call_parameter_net(p, self.pnet_list)[0]
+        lr = tf.reshape(tf.cast(lr, self.compute_Dtype), [-1, self.pi_hidden])
+        if self.phi_x_cache.dtype == lr.dtype:
+            u = tf.matmul(self.phi_x_cache, lr, transpose_b=True)
+        else:
+            n_rows, chunk_rows = self.phi_x_cache.shape[0], chunk_size*self.so_dim
+            u = tf.concat([tf.matmul(tf.cast(self.phi_x_cache[i:i + chunk_rows], self.compute_Dtype), lr,
+                                     transpose_b=True) for i in range(0, n_rows, chunk_rows)], axis=0)
+        u = tf.reshape(tf.transpose(u), [-1, self.n_points_cached, self.so_dim])
+        u = u + tf.cast(self.last_layer_bias, self.compute_Dtype)
+        return tf.cast(u, self.variable_Dtype)
 
     def _initialize_snet(self, cfg_shape_net, cfg_parameter_net):
         # create a simple feedfowrard, with resblock or not, that maps self.si_dim to
@@ -634,7 +935,17 @@ class NIFMultiScaleLastLayerParameterized(NIFMultiScale):
 
     def _call_shape_net_mres_only_para_last_layer(self, input_s, snet_layers_list, last_layer_bias, pnet_output,
                                                   so_dim, pi_hidden, variable_dtype):
+        if input_s.shape.rank == 3:
+            # snapshot-major: [n_snapshots, n_points*so_dim, pi_hidden] x [n_snapshots, pi_hidden, 1],
+            # phi_x of a mesh shared by all snapshots is computed once by `predict_field` instead
+            n_snapshots, n_points = tf.shape(input_s)[0], tf.shape(input_s)[1]
+            phi_x_matrix = self._call_shape_net_get_phi_x(tf.reshape(input_s, [-1, input_s.shape[-1]]),
+                                                          snet_layers_list, so_dim, pi_hidden)
+            phi_x_matrix = tf.reshape(phi_x_matrix, [n_snapshots, -1, pi_hidden])
+            u = tf.matmul(phi_x_matrix, tf.expand_dims(pnet_output, -1))
+            u = tf.reshape(u, [n_snapshots, n_points, so_dim]) + last_layer_bias
+            return tf.cast(u, variable_dtype)
         phi_x_matrix = self._call_shape_net_get_phi_x(input_s, snet_layers_list, so_dim, pi_hidden)
-        u = tf.keras.layers.Dot(axes=(2, 1))([phi_x_matrix, pnet_output]) + last_layer_bias
+        u = tf.linalg.matvec(phi_x_matrix, pnet_output) + last_layer_bias
         return tf.cast(u, variable_dtype)  #, tf.cast(phi_x, variable_dtype)
 
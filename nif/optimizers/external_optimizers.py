@@ -15,29 +15,50 @@ from tensorflow.python.keras.optimizer_v2 import utils as optimizer_utils
 from tensorflow.python.distribute import distribution_strategy_context as distribute_ctx
 from tensorflow.python.distribute import parameter_server_strategy
 from tensorflow.python.distribute import values as ds_values
+from tensorflow.python.distribute import reduce_util
 from tensorflow.python.keras.utils import tf_utils
 
 @keras_export('keras.optimizers.L4Adam')
 class L4Adam(tf.keras.optimizers.Optimizer):
-    # _HAS_AGGREGATE_GRAD = True
+    """
+    L4 (Rolinek and Martius, 2018) applied to Adam: the step size is chosen at every step such that
+    the linearized loss would drop by a fraction `learning_rate` of its gap to `gamma*l_min`,
+    where `l_min` is the minimal loss seen so far (`gamma_0*loss` at the first step), slowly
+    increased by a factor `1 + 1/tau` every step. The direction is Adam's, with time constants
+    `tau_m` and `tau_s` for the first and second moments.
+
+    The components of the Adam direction are about +-1, so the step size is about how far each
+    variable moves. Where `g^T nu` is tiny the linearization asks for a huge step, the step size is
+    then clipped to `max_step_size`. Where `g^T nu` is not positive, i.e., the Adam direction is not
+    a descent direction (the momentum still points the other way), no step is taken, only the
+    moments are updated.
+
+    The step size needs the loss, `minimize` passes it, `apply_gradients` has to be called with it.
+    """
+    # `NIF.train_step` passes the loss to `apply_gradients`
+    requires_loss = True
+
     def __init__(self, learning_rate=0.15, tau_m=10., tau_s=1000., tau=1000., gamma_0=0.75,
-                 gamma=0.9, epsilon=1e-7, name="L4Adam", **kwargs):
+                 gamma=0.9, epsilon=1e-7, max_step_size=0.1, name="L4Adam", **kwargs):
         super().__init__(name, **kwargs)
         self._set_hyper("learning_rate", kwargs.get("learning_rate", learning_rate))
         self._set_hyper("tau_m", kwargs.get("tau_m", tau_m))
         self._set_hyper("tau_s", kwargs.get("tau_s", tau_s))
         self._set_hyper("tau", kwargs.get("tau", tau))
         self._set_hyper("gamma", kwargs.get("gamma", gamma))
+        self._set_hyper("max_step_size", kwargs.get("max_step_size", max_step_size))
         self.epsilon = epsilon or backend_config.epsilon()
-        self.l_min = 1e6
         self.gamma_0 = kwargs.get("gamma_0", gamma_0)
-        self._is_first = True
+        self.l_min = None
 
     def _create_slots(self, var_list):
         for var in var_list:
             self.add_slot(var, 'g')
         for var in var_list:
             self.add_slot(var, 'g2')
+        if self.l_min is None:
+            self.l_min = self.add_weight("l_min", shape=[], dtype=dtypes.float32, trainable=False,
+                                         initializer="zeros")
 
     def _prepare_local(self, var_device, var_dtype, apply_state):
         super(L4Adam, self)._prepare_local(var_device, var_dtype, apply_state)
@@ -70,48 +91,45 @@ class L4Adam(tf.keras.optimizers.Optimizer):
             one_minus_one_over_tau_m=1. - one_over_tau_m
         ))
 
-    def _momentum_add(self, m, x, one_minus_one_over_tau, one_over_tau, factor):
-        return (one_minus_one_over_tau*m + one_over_tau*x)/factor
+    def _momentum_add(self, m, x, one_minus_one_over_tau, one_over_tau):
+        return one_minus_one_over_tau*m + one_over_tau*x
 
-    def _resource_apply_dense(self, grad, var, apply_state=None, loss=None):
-        """Update the slots and perform one optimization step for one model variable
+    def _l4_directions(self, grads_and_vars, apply_state):
         """
-        var_device, var_dtype = var.device, var.dtype.base_dtype
-        coefficients = ((apply_state or {}).get((var_device, var_dtype))
-                        or self._fallback_apply_state(var_device, var_dtype))
-
-        # t = math_ops.cast(self.iterations + 1, var_dtype)
-        # tau_m = self._get_hyper('tau_m', var_dtype)
-        # tau_s = self._get_hyper('tau_s', var_dtype)
-        #
-        # epsilon = self._get_hyper('epsilon', var_dtype)
-
-        g = self.get_slot(var, "g")
-        g2 = self.get_slot(var, "g2")
-        g_new = self._momentum_add(g, grad,
-                                   coefficients['one_minus_one_over_tau_m'],
-                                   coefficients['one_over_tau_m'],
-                                   coefficients['normal_factor_m'])
-        g2_new = self._momentum_add(g2, grad*grad,
-                                    coefficients['one_minus_one_over_tau_s'],
-                                    coefficients['one_over_tau_s'],
-                                    coefficients['normal_factor_s'])
-        nu_new = g_new / (math_ops.sqrt(g2_new) + coefficients['epsilon'])
-
-        new_var = None
-        #TODO(shaowu: it seems that implementing L4 can be quite troublesome in tensorflow 2)..
-        # mostly because of the g^T * nu term, maybe it is easier in pytorch
-        # new_var = var - coefficients['lr'] * nu_new * (loss - coefficients["gamma"]*self.l_min)\
-        #           /(coefficients["epsilon"] + )
-
-        # create the ops for updating
-        g_update = state_ops.assign(g, g_new, use_locking=self._use_locking)
-        g2_update = state_ops.assign(g2, g2_new, use_locking=self._use_locking)
-        var_update = state_ops.assign(var, new_var, use_locking=self._use_locking)
-
-        return control_flow_ops.group(*[var_update, g_update, g2_update])
+        the updated moments `g`, `g2` and the Adam direction `nu` of each variable, and the
+        global `g^T nu` over all variables, reduced with a single `add_n`
+        """
+        directions = []
+        g_dot_nu = []
+        for grad, var in grads_and_vars:
+            var_device, var_dtype = var.device, var.dtype.base_dtype
+            coefficients = ((apply_state or {}).get((var_device, var_dtype))
+                            or self._fallback_apply_state(var_device, var_dtype))
+            g_new = self._momentum_add(self.get_slot(var, "g"), grad,
+                                       coefficients['one_minus_one_over_tau_m'],
+                                       coefficients['one_over_tau_m'])
+            g2_new = self._momentum_add(self.get_slot(var, "g2"), grad*grad,
+                                        coefficients['one_minus_one_over_tau_s'],
+                                        coefficients['one_over_tau_s'])
+            # the slots keep the biased moments, only the direction is bias corrected
+            nu_new = (g_new/coefficients['normal_factor_m']) / (
+                math_ops.sqrt(g2_new/coefficients['normal_factor_s']) + coefficients['epsilon'])
+            directions.append((g_new, g2_new, nu_new))
+            g_dot_nu.append(math_ops.cast(math_ops.reduce_sum(grad*nu_new), dtypes.float32))
+        return directions, math_ops.add_n(g_dot_nu)
+
+    def _resource_apply_dense(self, grad, var, apply_state=None):
+        raise NotImplementedError("the step size of L4Adam depends on all variables, use `apply_gradients` "
+                                  "with the loss")
 
     def minimize(self, loss, var_list, grad_loss=None, name=None, tape=None):
+        if callable(loss):
+            # the value of the loss is needed for the step size, not only its gradients
+            tape = tape if tape is not None else backprop.GradientTape()
+            with tape:
+                if not callable(var_list):
+                    tape.watch(var_list)
+                loss = loss()
         grads_and_vars = self._compute_gradients(
             loss, var_list=var_list, grad_loss=grad_loss, tape=tape)
         return self.apply_gradients(grads_and_vars, name=name, loss=loss)
@@ -121,11 +139,13 @@ class L4Adam(tf.keras.optimizers.Optimizer):
                         name=None,
                         experimental_aggregate_gradients=True,
                         loss=None):
-        # update l_min
-        if self.iterations == 0:
-            self.l_min = ops.convert_to_tensor(self.gamma_0) * loss
-        else:
-            self.l_min = math_ops.minimum(self.l_min, loss)
+        """
+        one L4 step: `var -= lr*(loss - gamma*l_min)/(g^T nu)*nu` with the Adam direction `nu`
+        of each variable and `g^T nu` over all variables, so `loss` has to be given. The step size
+        is clipped to `max_step_size`, and is zero if `g^T nu <= epsilon`.
+        """
+        if loss is None:
+            raise ValueError("L4Adam needs the loss of the step, pass it to `apply_gradients` or use `minimize`")
 
         grads_and_vars = optimizer_utils.filter_empty_gradients(grads_and_vars)
         var_list = [v for (_, v) in grads_and_vars]
@@ -160,35 +180,42 @@ class L4Adam(tf.keras.optimizers.Optimizer):
                 grads_and_vars = self._aggregate_gradients(grads_and_vars)
             grads_and_vars = self._transform_gradients(grads_and_vars)
 
+            # the loss of each replica is scaled by the number of replicas, like the gradients
+            loss = math_ops.cast(loss, dtypes.float32)
+            if strategy.num_replicas_in_sync > 1:
+                loss = distribute_ctx.get_replica_context().all_reduce(reduce_util.ReduceOp.SUM, loss)
+
+            # the gradients are aggregated, so every replica computes the same step size
+            directions, g_dot_nu = self._l4_directions(grads_and_vars, apply_state)
+            l_min = array_ops.where(self.iterations == 0, self.gamma_0*loss, math_ops.minimum(self.l_min, loss))
+            lr = self._decayed_lr(dtypes.float32)
+            gamma = self._get_hyper('gamma', dtypes.float32)
+            max_step_size = self._get_hyper('max_step_size', dtypes.float32)
+            step_size = math_ops.minimum(lr*(loss - gamma*l_min)/g_dot_nu, max_step_size)
+            step_size = array_ops.where(g_dot_nu > self.epsilon, step_size, array_ops.zeros_like(step_size))
+
             return distribute_ctx.get_replica_context().merge_call(
-                functools.partial(self._distributed_apply, apply_state=apply_state, loss=loss),
-                args=(grads_and_vars,),
+                functools.partial(self._distributed_apply, apply_state=apply_state),
+                args=(grads_and_vars, directions, step_size, l_min),
                 kwargs={
                     "name": name,
                 })
 
-    def _distributed_apply(self, distribution, grads_and_vars, name, apply_state, loss=None):
+    def _distributed_apply(self, distribution, grads_and_vars, directions, step_size, l_min, name, apply_state):
         """`apply_gradients` using a `DistributionStrategy`."""
 
-        def apply_grad_to_update_var(var, grad):
+        def apply_grad_to_update_var(var, grad, g_new, g2_new, nu_new, step_size):
             """Apply gradient to variable."""
             if isinstance(var, ops.Tensor):
                 raise NotImplementedError("Trying to update a Tensor ", var)
-
-            apply_kwargs = {}
             if isinstance(grad, ops.IndexedSlices):
-                if var.constraint is not None:
-                    raise RuntimeError(
-                        "Cannot use a constraint function on a sparse variable.")
-                if "apply_state" in self._sparse_apply_args:
-                    apply_kwargs["apply_state"] = apply_state
-                return self._resource_apply_sparse_duplicate_indices(
-                    grad.values, var, grad.indices, **apply_kwargs)
-
-            if "apply_state" in self._dense_apply_args:
-                apply_kwargs["apply_state"] = apply_state
-            apply_kwargs["loss"] = loss
-            update_op = self._resource_apply_dense(grad, var, **apply_kwargs)
+                raise NotImplementedError("L4Adam does not support sparse gradients")
+
+            g_update = state_ops.assign(self.get_slot(var, "g"), g_new, use_locking=self._use_locking)
+            g2_update = state_ops.assign(self.get_slot(var, "g2"), g2_new, use_locking=self._use_locking)
+            var_update = state_ops.assign_sub(var, math_ops.cast(step_size, var.dtype.base_dtype)*nu_new,
+                                              use_locking=self._use_locking)
+            update_op = control_flow_ops.group(*[var_update, g_update, g2_update])
             if var.constraint is not None:
                 with ops.control_dependencies([update_op]):
                     return var.assign(var.constraint(var))
@@ -198,22 +225,29 @@ class L4Adam(tf.keras.optimizers.Optimizer):
         eagerly_outside_functions = ops.executing_eagerly_outside_functions()
         update_ops = []
         with ops.name_scope(name or self._name, skip_on_eager=True):
-            for grad, var in grads_and_vars:
-                # TODO(crccw): It's not allowed to assign PerReplica value to
-                # MirroredVariable.  Remove this after we relax this restriction.
-                def _assume_mirrored(grad):
-                    if isinstance(grad, ds_values.PerReplica):
-                        return ds_values.Mirrored(grad.values)
-                    return grad
-
-                grad = nest.map_structure(_assume_mirrored, grad)
+            # TODO(crccw): It's not allowed to assign PerReplica value to
+            # MirroredVariable.  Remove this after we relax this restriction.
+            def _assume_mirrored(grad):
+                if isinstance(grad, ds_values.PerReplica):
+                    return ds_values.Mirrored(grad.values)
+                return grad
+
+            step_size = nest.map_structure(_assume_mirrored, step_size)
+            for (grad, var), (g_new, g2_new, nu_new) in zip(grads_and_vars, directions):
+                grad, g_new, g2_new, nu_new = nest.map_structure(_assume_mirrored, (grad, g_new, g2_new, nu_new))
                 # Colocate the update with variables to avoid unnecessary communication
                 # delays. See b/136304694.
                 with distribution.extended.colocate_vars_with(var):
                     with ops.name_scope("update" if eagerly_outside_functions else
                                         "update_" + var.op.name, skip_on_eager=True):
                         update_ops.extend(distribution.extended.update(
-                            var, apply_grad_to_update_var, args=(grad,), group=False))
+                            var, apply_grad_to_update_var, args=(grad, g_new, g2_new, nu_new, step_size),
+                            group=False))
+
+            # the minimal loss slowly increases, so the target follows the loss
+            l_min = nest.map_structure(_assume_mirrored, l_min)
+            update_ops.extend(distribution.extended.update(
+                self.l_min, lambda v, l: v.assign(l*self._one_plus_one_over_tau()), args=(l_min,), group=False))
 
             any_symbolic = any(isinstance(i, ops.Operation) or
                                tf_utils.is_symbolic_tensor(i) for i in update_ops)
@@ -227,6 +261,8 @@ class L4Adam(tf.keras.optimizers.Optimizer):
 
             return self._iterations.assign_add(1)
 
+    def _one_plus_one_over_tau(self):
+        return 1. + 1./self._get_hyper('tau', dtypes.float32)
 
     def _resource_apply_sparse(self, grad, var, indices, apply_state=None):
         raise NotImplementedError
@@ -236,9 +272,13 @@ class L4Adam(tf.keras.optimizers.Optimizer):
         return {
             **base_config,
             "learning_rate": self._serialize_hyperparameter("learning_rate"),
-            "beta_1": self._serialize_hyperparameter("beta_1"),
-            "beta_2": self._serialize_hyperparameter("beta_2"),
-            "epsilon": self._serialize_hyperparameter("epsilon"),
+            "tau_m": self._serialize_hyperparameter("tau_m"),
+            "tau_s": self._serialize_hyperparameter("tau_s"),
+            "tau": self._serialize_hyperparameter("tau"),
+            "gamma": self._serialize_hyperparameter("gamma"),
+            "max_step_size": self._serialize_hyperparameter("max_step_size"),
+            "gamma_0": self.gamma_0,
+            "epsilon": self.epsilon,
         }
 
 @keras_export('keras.optimizers.AdaBelief')
@@ -309,6 +349,10 @@ class AdaBeliefOptimizer(tf.keras.optimizers.Optimizer):
             warmup_proportion: A floating point value.
                 The proportion of increasing steps.
             min_lr: A floating point value. Minimum learning rate after warmup.
+            fused: boolean. Whether to update all the (dense) variables at once,
+                flattened into a few contiguous buffers, instead of variable by
+                variable. The result is the same, the step runs far fewer ops,
+                which is faster with many small variables.
             name: Optional name for the operations created when applying
                 gradients. Defaults to "AdaBeliefOptimizer".
             **kwargs: keyword arguments. Allowed to be {`clipnorm`,
@@ -332,6 +376,7 @@ class AdaBeliefOptimizer(tf.keras.optimizers.Optimizer):
             total_steps=0,
             warmup_proportion=0.1,
             min_lr=0.0,
+            fused=False,
             name="AdaBeliefOptimizer",
             print_change_log = True,
             **kwargs):
@@ -351,6 +396,7 @@ class AdaBeliefOptimizer(tf.keras.optimizers.Optimizer):
         self.rectify = rectify
         self._has_weight_decay = weight_decay != 0.0
         self._initial_total_steps = total_steps
+        self.fused = fused
 
     def _create_slots(self, var_list):
         for var in var_list:
@@ -374,12 +420,9 @@ class AdaBeliefOptimizer(tf.keras.optimizers.Optimizer):
             wd_t = tf.cast(wd_t(self.iterations), var_dtype)
         return wd_t
 
-    def _resource_apply_dense(self, grad, var, apply_state=None):
-        var_dtype = var.dtype.base_dtype
+    def _dense_coefficients(self, var_dtype):
         lr_t = self._decayed_lr(var_dtype)
         wd_t = self._decayed_wd(var_dtype)
-        m = self.get_slot(var, "m")
-        v = self.get_slot(var, "v")
         beta_1_t = self._get_hyper("beta_1", var_dtype)
         beta_2_t = self._get_hyper("beta_2", var_dtype)
         epsilon_t = tf.convert_to_tensor(self.epsilon, var_dtype)
@@ -402,24 +445,6 @@ class AdaBeliefOptimizer(tf.keras.optimizers.Optimizer):
         sma_inf = 2.0 / (1.0 - beta_2_t) - 1.0
         sma_t = sma_inf - 2.0 * local_step * beta_2_power / (1.0 - beta_2_power)
 
-        m_t = m.assign(
-            beta_1_t * m + (1.0 - beta_1_t) * grad, use_locking=self._use_locking
-        )
-        m_corr_t = m_t / (1.0 - beta_1_power)
-
-        v_t = v.assign(
-            beta_2_t * v + (1.0 - beta_2_t) * tf.math.square(grad - m_t) + epsilon_t,
-            use_locking=self._use_locking,
-            )
-
-        if self.amsgrad:
-            vhat = self.get_slot(var, "vhat")
-            vhat_t = vhat.assign(tf.maximum(vhat, v_t), use_locking=self._use_locking)
-            v_corr_t = tf.math.sqrt(vhat_t / (1.0 - beta_2_power))
-        else:
-            vhat_t = None
-            v_corr_t = tf.math.sqrt(v_t / (1.0 - beta_2_power))
-
         r_t = tf.math.sqrt(
             (sma_t - 4.0)
             / (sma_inf - 4.0)
@@ -428,27 +453,201 @@ class AdaBeliefOptimizer(tf.keras.optimizers.Optimizer):
             * sma_inf
             / sma_t
         )
+        return dict(lr_t=lr_t, wd_t=wd_t, beta_1_t=beta_1_t, beta_2_t=beta_2_t, epsilon_t=epsilon_t,
+                    beta_1_power=beta_1_power, beta_2_power=beta_2_power, sma_t=sma_t, r_t=r_t,
+                    sma_threshold=self._get_hyper("sma_threshold", var_dtype))
+
+    def _dense_update(self, grad, var, m, v, vhat, coefficients):
+        """
+        the new values of `var`, `m`, `v` and `vhat` (None without amsgrad), elementwise, so `var`,
+        `m`, ... can be single variables or all of them flattened into one buffer
+        """
+        c = coefficients
+        m_t = c['beta_1_t'] * m + (1.0 - c['beta_1_t']) * grad
+        m_corr_t = m_t / (1.0 - c['beta_1_power'])
+
+        v_t = c['beta_2_t'] * v + (1.0 - c['beta_2_t']) * tf.math.square(grad - m_t) + c['epsilon_t']
+
+        if self.amsgrad:
+            vhat_t = tf.maximum(vhat, v_t)
+            v_corr_t = tf.math.sqrt(vhat_t / (1.0 - c['beta_2_power']))
+        else:
+            vhat_t = None
+            v_corr_t = tf.math.sqrt(v_t / (1.0 - c['beta_2_power']))
 
         if self.rectify:
-            sma_threshold = self._get_hyper("sma_threshold", var_dtype)
             var_t = tf.where(
-                sma_t >= sma_threshold,
-                r_t * m_corr_t / (v_corr_t + epsilon_t),
+                c['sma_t'] >= c['sma_threshold'],
+                c['r_t'] * m_corr_t / (v_corr_t + c['epsilon_t']),
                 m_corr_t,
                 )
         else:
-            var_t = m_corr_t / (v_corr_t + epsilon_t)
+            var_t = m_corr_t / (v_corr_t + c['epsilon_t'])
 
         if self._has_weight_decay:
-            var_t += wd_t * var
+            var_t += c['wd_t'] * var
 
-        var_update = var.assign_sub(lr_t * var_t, use_locking=self._use_locking)
+        return var - c['lr_t'] * var_t, m_t, v_t, vhat_t
 
-        updates = [var_update, m_t, v_t]
+    def _resource_apply_dense(self, grad, var, apply_state=None):
+        m = self.get_slot(var, "m")
+        v = self.get_slot(var, "v")
+        vhat = self.get_slot(var, "vhat") if self.amsgrad else None
+        var_new, m_t, v_t, vhat_t = self._dense_update(grad, var, m, v, vhat,
+                                                       self._dense_coefficients(var.dtype.base_dtype))
+        updates = [var.assign(var_new, use_locking=self._use_locking),
+                   m.assign(m_t, use_locking=self._use_locking),
+                   v.assign(v_t, use_locking=self._use_locking)]
         if self.amsgrad:
-            updates.append(vhat_t)
+            updates.append(vhat.assign(vhat_t, use_locking=self._use_locking))
         return tf.group(*updates)
 
+    def _fused_dense_updates(self, grads_and_vars):
+        """
+        `_dense_update` of all the variables at once: the variables, gradients and slots on the
+        same device and of the same dtype are flattened into one buffer each, updated with a single
+        chain of vectorized ops and split back.
+
+        Returns:
+            a list of `(var, var_new, m_t, v_t, vhat_t)`
+        """
+        groups = {}
+        for grad, var in grads_and_vars:
+            groups.setdefault((var.device, var.dtype.base_dtype), []).append((grad, var))
+
+        def flatten(tensors):
+            return tf.concat([tf.reshape(t, [-1]) for t in tensors], axis=0)
+
+        updates = []
+        for (device, var_dtype), group in groups.items():
+            grads = [g for g, _ in group]
+            var_list = [v for _, v in group]
+            with tf.device(device):
+                slots = [flatten([self.get_slot(var, name) for var in var_list]) if self.amsgrad or name != "vhat"
+                         else None for name in ["m", "v", "vhat"]]
+                new_values = self._dense_update(flatten(grads), flatten(var_list), *slots,
+                                                self._dense_coefficients(var_dtype))
+                sizes = [var.shape.num_elements() for var in var_list]
+                new_values = [None if t is None else tf.split(t, sizes) for t in new_values]
+            for i, var in enumerate(var_list):
+                updates.append((var,) + tuple(None if t is None else tf.reshape(t[i], var.shape)
+                                              for t in new_values))
+        return updates
+
+    def apply_gradients(self,
+                        grads_and_vars,
+                        name=None,
+                        experimental_aggregate_gradients=True):
+        if not self.fused:
+            return super().apply_gradients(grads_and_vars, name=name,
+                                           experimental_aggregate_gradients=experimental_aggregate_gradients)
+
+        grads_and_vars = optimizer_utils.filter_empty_gradients(grads_and_vars)
+        var_list = [v for (_, v) in grads_and_vars]
+
+        with ops.name_scope_v2(self._name):
+            # Create iteration if necessary.
+            with ops.init_scope():
+                self._create_all_weights(var_list)
+
+            if not grads_and_vars:
+                # Distribution strategy does not support reducing an empty list of
+                # gradients
+                return control_flow_ops.no_op()
+
+            if distribute_ctx.in_cross_replica_context():
+                raise RuntimeError(
+                    "`apply_gradients() cannot be called in cross-replica context. "
+                    "Use `tf.distribute.Strategy.run` to enter replica "
+                    "context.")
+
+            strategy = distribute_ctx.get_strategy()
+            if (not experimental_aggregate_gradients and strategy and isinstance(
+                    strategy.extended,
+                    parameter_server_strategy.ParameterServerStrategyExtended)):
+                raise NotImplementedError(
+                    "`experimental_aggregate_gradients=False is not supported for "
+                    "ParameterServerStrategy and CentralStorageStrategy")
+
+            if experimental_aggregate_gradients:
+                grads_and_vars = self._transform_unaggregated_gradients(grads_and_vars)
+                grads_and_vars = self._aggregate_gradients(grads_and_vars)
+            grads_and_vars = self._transform_gradients(grads_and_vars)
+
+            # the gradients are aggregated, so every replica computes the same new values.
+            # Sparse gradients only update some rows, they keep the per-variable update.
+            dense = [(g, v) for g, v in grads_and_vars if not isinstance(g, ops.IndexedSlices)]
+            sparse = [(g, v) for g, v in grads_and_vars if isinstance(g, ops.IndexedSlices)]
+            updates = self._fused_dense_updates(dense) if dense else []
+
+            return distribute_ctx.get_replica_context().merge_call(
+                self._distributed_apply_fused,
+                args=(updates, sparse),
+                kwargs={
+                    "name": name,
+                })
+
+    def _distributed_apply_fused(self, distribution, updates, sparse_grads_and_vars, name):
+        """assign the new values of the fused update and apply the sparse gradients"""
+
+        def assign_new_values(var, var_new, m_t, v_t, vhat_t):
+            update_ops = [var.assign(var_new, use_locking=self._use_locking),
+                          self.get_slot(var, "m").assign(m_t, use_locking=self._use_locking),
+                          self.get_slot(var, "v").assign(v_t, use_locking=self._use_locking)]
+            if self.amsgrad:
+                update_ops.append(self.get_slot(var, "vhat").assign(vhat_t, use_locking=self._use_locking))
+            update_op = control_flow_ops.group(*update_ops)
+            if var.constraint is not None:
+                with ops.control_dependencies([update_op]):
+                    return var.assign(var.constraint(var))
+            else:
+                return update_op
+
+        def apply_sparse_grad(var, grad):
+            update_op = self._resource_apply_sparse_duplicate_indices(grad.values, var, grad.indices)
+            if var.constraint is not None:
+                with ops.control_dependencies([update_op]):
+                    return var.assign(var.constraint(var))
+            else:
+                return update_op
+
+        # TODO(crccw): It's not allowed to assign PerReplica value to
+        # MirroredVariable.  Remove this after we relax this restriction.
+        def _assume_mirrored(grad):
+            if isinstance(grad, ds_values.PerReplica):
+                return ds_values.Mirrored(grad.values)
+            return grad
+
+        eagerly_outside_functions = ops.executing_eagerly_outside_functions()
+        update_ops = []
+        with ops.name_scope(name or self._name, skip_on_eager=True):
+            for var, *new_values in updates:
+                new_values = nest.map_structure(_assume_mirrored, new_values)
+                with distribution.extended.colocate_vars_with(var):
+                    with ops.name_scope("update" if eagerly_outside_functions else
+                                        "update_" + var.op.name, skip_on_eager=True):
+                        update_ops.extend(distribution.extended.update(
+                            var, assign_new_values, args=tuple(new_values), group=False))
+            for grad, var in sparse_grads_and_vars:
+                grad = nest.map_structure(_assume_mirrored, grad)
+                with distribution.extended.colocate_vars_with(var):
+                    with ops.name_scope("update" if eagerly_outside_functions else
+                                        "update_" + var.op.name, skip_on_eager=True):
+                        update_ops.extend(distribution.extended.update(
+                            var, apply_sparse_grad, args=(grad,), group=False))
+
+            any_symbolic = any(isinstance(i, ops.Operation) or
+                               tf_utils.is_symbolic_tensor(i) for i in update_ops)
+            if not context.executing_eagerly() or any_symbolic:
+                # If the current context is graph mode or any of the update ops are
+                # symbolic then the step update should be carried out under a graph
+                # context. (eager updates execute immediately)
+                with ops._get_graph_from_inputs(update_ops).as_default():  # pylint: disable=protected-access
+                    with ops.control_dependencies([control_flow_ops.group(update_ops)]):
+                        return self._iterations.assign_add(1, read_value=False)
+
+            return self._iterations.assign_add(1)
+
     def _resource_apply_sparse(self, grad, var, indices, apply_state=None):
         var_dtype = var.dtype.base_dtype
         lr_t = self._decayed_lr(var_dtype)
@@ -544,6 +743,7 @@ class AdaBeliefOptimizer(tf.keras.optimizers.Optimizer):
                     "warmup_proportion"
                 ),
                 "min_lr": self._serialize_hyperparameter("min_lr"),
+                "fused": self.fused,
             }
         )
         return config
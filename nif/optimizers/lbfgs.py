@@ -3,8 +3,10 @@
 import numpy as np
 import tensorflow as tf
 from tensorflow_probability.python.optimizer import lbfgs_minimize
+from tensorflow_probability.python.optimizer.lbfgs import LBfgsOptimizerResults
 
-def function_factory(model, loss, train_x, train_y, display_epoch):
+def function_factory(model, loss, train_x, train_y, display_epoch, dataset=None, history_capacity=100000,
+                     dtype=None):
     """A factory to create a function required by tfp.optimizer.lbfgs_minimize.
 
     Args:
@@ -12,29 +14,35 @@ def function_factory(model, loss, train_x, train_y, display_epoch):
         loss [in]: a function with signature loss_value = loss(pred_y, true_y).
         train_x [in]: the input part of training demo.
         train_y [in]: the output part of training demo.
+        dataset [in]: a `tf.data.Dataset` of `(x, y)` chunks, used instead of `train_x`
+            and `train_y`. The loss and gradients are accumulated over the chunks, weighted
+            by their number of points, so `loss` must be a mean over points.
+        history_capacity [in]: size of the on-device ring buffer of loss values, see `f.read_history`.
+        dtype [in]: dtype of `model_parameters`, the loss and the gradients, i.e., of the L-BFGS
+            arithmetic, the model parameters are cast to (from) their own dtype. Default is
+            the dtype of the model variables.
 
     Returns:
         A function that has a signature of:
             loss_value, gradients = f(model_parameters).
     """
 
-    # obtain the shapes of all trainable parameters in the model
-    shapes = tf.shape_n(model.trainable_variables)
-    n_tensors = len(shapes)
+    # obtain the shapes of all trainable parameters in the model, the 1D parameters are
+    # their flattened concatenation
+    variables = model.trainable_variables
+    shapes = [v.shape for v in variables]
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    count = sum(sizes)
+    dtype = variables[0].dtype if dtype is None else tf.as_dtype(dtype)
 
-    # we'll use tf.dynamic_stitch and tf.dynamic_partition later, so we need to
-    # prepare required information first
-    count = 0
-    idx = [] # stitch indices
-    part = [] # partition indices
+    if dataset is None:
+        # keep the demo in variables, so it is not baked into the traced graph as constants
+        train_x = tf.Variable(train_x, trainable=False)
+        train_y = tf.Variable(train_y, trainable=False)
 
-    for i, shape in enumerate(shapes):
-        n = np.product(shape)
-        idx.append(tf.reshape(tf.range(count, count+n, dtype=tf.int32), shape))
-        part.extend([i]*n)
-        count += n
-
-    part = tf.constant(part)
+    def pack(tensors):
+        """flatten and concatenate `tensors` shaped as the model's trainable parameters"""
+        return tf.concat([tf.reshape(tf.cast(t, dtype), [-1]) for t in tensors], axis=0)
 
     @tf.function
     def assign_new_model_parameters(params_1d):
@@ -44,9 +52,16 @@ def function_factory(model, loss, train_x, train_y, display_epoch):
             params_1d [in]: a 1D tf.Tensor representing the model's trainable parameters.
         """
 
-        params = tf.dynamic_partition(params_1d, part, n_tensors)
-        for i, (shape, param) in enumerate(zip(shapes, params)):
-            model.trainable_variables[i].assign(tf.reshape(param, shape))
+        params = tf.split(params_1d, sizes)
+        for v, shape, param in zip(variables, shapes, params):
+            v.assign(tf.reshape(tf.cast(param, v.dtype), shape))
+
+    def loss_and_gradients(x, y):
+        with tf.GradientTape() as tape:
+            loss_value = tf.cast(loss(model(x, training=True), y), dtype)
+        # calculate gradients and convert to 1D tf.Tensor
+        grads = tape.gradient(loss_value, variables)
+        return loss_value, pack(grads)
 
     # now create a function that will be returned by this factory
     @tf.function
@@ -62,63 +77,246 @@ def function_factory(model, loss, train_x, train_y, display_epoch):
             A scalar loss and the gradients w.r.t. the `params_1d`.
         """
 
-        # use GradientTape so that we can calculate the gradient of loss w.r.t. parameters
-        with tf.GradientTape() as tape:
-            # update the parameters in the model
-            assign_new_model_parameters(params_1d)
-            # calculate the loss
-            loss_value = loss(model(train_x, training=True), train_y)
+        # update the parameters in the model
+        assign_new_model_parameters(params_1d)
 
-        # calculate gradients and convert to 1D tf.Tensor
-        grads = tape.gradient(loss_value, model.trainable_variables)
-        grads = tf.dynamic_stitch(idx, grads)
+        if dataset is None:
+            loss_value, grads = loss_and_gradients(train_x, train_y)
+        else:
+            # only one chunk lives on the device at a time
+            loss_value = tf.zeros([], dtype)
+            grads = tf.zeros([count], dtype)
+            n_points = tf.zeros([], dtype)
+            for x, y in dataset:
+                loss_chunk, grads_chunk = loss_and_gradients(x, y)
+                n_chunk = tf.cast(tf.shape(x)[0], dtype)
+                loss_value += n_chunk*loss_chunk
+                grads += n_chunk*grads_chunk
+                n_points += n_chunk
+            loss_value = loss_value/n_points
+            grads = grads/n_points
 
-        # print out iteration & loss
+        # store loss value on the device, it is read back by `f.read_history` between rounds
+        f.history_buffer.scatter_nd_update([[f.iter % history_capacity]], [loss_value])
         f.iter.assign_add(1)
 
-        if f.iter % display_epoch == 0:
-            tf.print("Epoch:", f.iter, "loss:", loss_value)
-
-        # store loss value so we can retrieve later
-        tf.py_function(f.history.append, inp=[loss_value], Tout=[])
-
         return loss_value, grads
 
+    def read_history():
+        """
+        the iterations and loss values recorded since the last call, with a single read of the device
+        buffer. Only the last `history_capacity` of them are kept.
+        """
+        n_iter = int(f.iter.numpy())
+        start = max(f.n_read, n_iter - history_capacity)
+        iteration = np.arange(start + 1, n_iter + 1)
+        losses = f.history_buffer.numpy()[np.arange(start, n_iter) % history_capacity]
+        f.n_read = n_iter
+        return iteration, losses
+
     # store these information as members so we can use them outside the scope
     f.iter = tf.Variable(0)
-    f.idx = idx
-    f.part = part
+    f.dtype = dtype
+    f.pack = pack
+    f.history_buffer = tf.Variable(tf.zeros([history_capacity], dtype), trainable=False)
+    f.n_read = 0
+    f.read_history = read_history
+    f.display_epoch = display_epoch
     f.shapes = shapes
+    f.sizes = sizes
     f.assign_new_model_parameters = assign_new_model_parameters
-    f.history = []
 
     return f
 
+
+def print_loss(display_epoch=1):
+    """the default `TFPLBFGS` callback, prints the loss of every `display_epoch`-th function evaluation"""
+    def callback(round, iteration, loss):
+        for i, l in zip(iteration, loss):
+            if i % display_epoch == 0:
+                print("Epoch:", i, "loss:", l)
+    return callback
+
+
+def _dataset_from_chunks(chunks):
+    """a `tf.data.Dataset` over the `(x, y)` chunks yielded by the callable `chunks`, read on the host"""
+    x, y = next(iter(chunks()))
+    output_signature = (tf.TensorSpec((None,) + np.shape(x)[1:], tf.as_dtype(np.asarray(x).dtype)),
+                        tf.TensorSpec((None,) + np.shape(y)[1:], tf.as_dtype(np.asarray(y).dtype)))
+    return tf.data.Dataset.from_generator(chunks, output_signature=output_signature).prefetch(1)
+
+
+def _array_chunks(inps, outs, chunk_size):
+    # arrays or memmaps, only a chunk is read into memory at a time
+    def chunks():
+        for i in range(0, inps.shape[0], chunk_size):
+            yield np.asarray(inps[i:i + chunk_size]), np.asarray(outs[i:i + chunk_size])
+    return chunks
+
+
+def _fixed_subsample(chunks, n_samples, seed=None):
+    """
+    uniform sample without replacement of `n_samples` points out of the `(x, y)` chunks,
+    by keeping the points with the largest random keys, so only `n_samples` points are held at a time
+    """
+    rng = np.random.default_rng(seed)
+    keys, x_sample, y_sample = np.zeros(0), None, None
+    for x, y in chunks:
+        x, y = np.asarray(x), np.asarray(y)
+        keys = np.concatenate([keys, rng.random(x.shape[0])])
+        x_sample = x if x_sample is None else np.concatenate([x_sample, x])
+        y_sample = y if y_sample is None else np.concatenate([y_sample, y])
+        if keys.shape[0] > n_samples:
+            keep = np.sort(np.argpartition(keys, -n_samples)[-n_samples:])
+            keys, x_sample, y_sample = keys[keep], x_sample[keep], y_sample[keep]
+    return x_sample, y_sample
+
+
 class TFPLBFGS(object):
-    def __init__(self, model, loss_fun, inps, outs, display_epoch=1):
+    """
+    full-batch L-BFGS fine-tuning of a keras model.
+
+    the training demo is given either as arrays `inps` and `outs`, or as `dataset`, which is a
+    `tf.data.Dataset` of `(x, y)` chunks or a callable returning an iterator of `(x, y)` numpy chunks,
+    e.g., read from a memmap. With a dataset (or `chunk_size` for arrays), the loss and gradients
+    are accumulated chunk by chunk, so the demo does not need to fit on the device.
+
+    The optimizer state (position and correction pairs) persists across rounds of `minimize` and
+    across calls, each round continues the same L-BFGS run for `max_iter` more iterations. The state
+    can be saved with `save_state` and restored with `load_state`.
+
+    Args:
+        chunk_size: split `inps` and `outs` (arrays or memmaps) into chunks of `chunk_size` points.
+        subsample: if given, fine-tune on a fixed uniform subsample of `subsample` points
+            (drawn once with `seed`), kept on the device.
+        callback: called as `callback(round, iteration, loss)` after each round of `minimize` with
+            the arrays of function evaluations and loss values of the round, by default `print_loss(display_epoch)`.
+            Nothing is sent back to the host during a round.
+        history_capacity: number of loss values the device can hold during a round.
+        dtype: 'float32' or 'float64', dtype of the L-BFGS state and arithmetic for this run, by default
+            the dtype of the model variables. It does not change `tf.keras.backend.floatx()`.
+    """
+    def __init__(self, model, loss_fun, inps=None, outs=None, display_epoch=1, dataset=None, chunk_size=None,
+                 subsample=None, seed=None, callback=None, history_capacity=100000, dtype=None,
+                 num_correction_pairs=20, tolerance=1e-15):
+        if dataset is None and inps is None:
+            raise ValueError("either inps and outs, or dataset, should be given")
+
+        if subsample is not None:
+            if dataset is None:
+                n = inps.shape[0]
+                keep = np.sort(np.random.default_rng(seed).choice(n, min(subsample, n), replace=False))
+                inps, outs = np.asarray(inps[keep]), np.asarray(outs[keep])
+            else:
+                chunks = dataset.as_numpy_iterator() if isinstance(dataset, tf.data.Dataset) else dataset()
+                inps, outs = _fixed_subsample(chunks, subsample, seed)
+            dataset = None
+        elif dataset is None and chunk_size is not None:
+            dataset = _dataset_from_chunks(_array_chunks(inps, outs, chunk_size))
+        elif dataset is not None and not isinstance(dataset, tf.data.Dataset):
+            dataset = _dataset_from_chunks(dataset)
+
         # demo + keras model -> function for l-bfgs
-        self.func = function_factory(model, loss_fun, inps, outs, display_epoch)
+        self.func = function_factory(model, loss_fun, inps, outs, display_epoch, dataset, history_capacity, dtype)
         self.model = model
+        self.callback = print_loss(display_epoch) if callback is None else callback
+        self.num_correction_pairs = num_correction_pairs
+        self.tolerance = tolerance
+        self.results = None
+        self.num_restarts = 0
+        self._iteration = []
+        self._loss = []
+        self._round_objective = []
+
+        options = dict(value_and_gradients_function=self.func,
+                       num_correction_pairs=num_correction_pairs,
+                       tolerance=tolerance,
+                       x_tolerance=tolerance,
+                       f_relative_tolerance=tolerance,
+                       parallel_iterations=1,
+                       max_line_search_iterations=100)
+
+        # traced once each, the number of iterations is a tensor
+        @tf.function
+        def start(initial_position, max_iterations):
+            return lbfgs_minimize(initial_position=initial_position, max_iterations=max_iterations, **options)
+
+        @tf.function
+        def resume(previous_optimizer_results, max_iterations):
+            return lbfgs_minimize(initial_position=None, previous_optimizer_results=previous_optimizer_results,
+                                  max_iterations=max_iterations, **options)
+
+        self._start = start
+        self._resume = resume
 
     def minimize(self, rounds=50, max_iter=50):
-        for _ in range(rounds):
-            results = lbfgs_minimize(
-                value_and_gradients_function=self.func,
-                initial_position=tf.dynamic_stitch(self.func.idx, self.model.trainable_variables),
-                num_correction_pairs=20,
-                tolerance=1e-15,
-                x_tolerance=1e-15,
-                f_relative_tolerance=1e-15,
-                parallel_iterations=1,
-                max_iterations=max_iter,
-                max_line_search_iterations=100,
-            )
-            self.func.assign_new_model_parameters(results.position)
-        # print("loss = %8.5f" % results.objective_value)
+        """
+        run `rounds` rounds of `max_iter` L-BFGS iterations, stops early once converged.
+        A round that fails (the line search cannot make progress) restarts the curvature estimate
+        from the current position in the next round.
+        """
+        for i in range(rounds):
+            if self.results is None:
+                self.results = self._start(self.func.pack(self.model.trainable_variables), tf.constant(max_iter))
+            else:
+                self.results = self._resume(self.results, self.results.num_iterations + max_iter)
+            self.func.assign_new_model_parameters(self.results.position)
+            self._round_objective.append(float(self.results.objective_value.numpy()))
+
+            iteration, loss = self.func.read_history()
+            self._iteration.append(iteration)
+            self._loss.append(loss)
+            self.callback(i, iteration, loss)
+
+            if bool(self.results.converged.numpy()):
+                break
+            if bool(self.results.failed.numpy()):
+                self.results = None
+                self.num_restarts += 1
+        return self.results
 
     @property
-    def history(self):
-        history = list(map(lambda x: x.numpy(), self.func.history))
-        iteration = np.arange(1, len(history)+1)
-        return {'iteration': iteration, 'loss':history}
+    def metrics(self):
+        """convergence metrics of the current L-BFGS run"""
+        if self.results is None and len(self._round_objective) == 0:
+            return {}
+        r = self.results
+        metrics = {'num_restarts': self.num_restarts,
+                   'num_function_evaluations': int(self.func.iter.numpy())}
+        if len(self._round_objective) > 0:
+            metrics['objective_value'] = self._round_objective[-1]
+        if len(self._round_objective) > 1:
+            previous = self._round_objective[-2]
+            metrics['relative_objective_change'] = abs(previous - metrics['objective_value'])/max(abs(previous), 1e-300)
+        if r is not None:
+            metrics.update({'objective_value': float(r.objective_value.numpy()),
+                            'num_iterations': int(r.num_iterations.numpy()),
+                            'num_objective_evaluations': int(r.num_objective_evaluations.numpy()),
+                            'gradient_norm': float(tf.norm(r.objective_gradient, ord=np.inf).numpy()),
+                            'converged': bool(r.converged.numpy()),
+                            'failed': bool(r.failed.numpy())})
+        return metrics
+
+    def save_state(self, path):
+        """save the L-BFGS state, i.e., the position, the correction pairs and counters, as a `.npz` file"""
+        if self.results is None:
+            raise ValueError("there is no L-BFGS state to save, call minimize first")
+        arrays = {name: value.numpy() for name, value in zip(self.results._fields, self.results)}
+        arrays['num_restarts'] = np.array(self.num_restarts)
+        np.savez(path, **arrays)
+
+    def load_state(self, path):
+        """resume from a state of `save_state`, the model parameters are set to its position"""
+        state = np.load(path)
+        self.results = LBfgsOptimizerResults(*[tf.constant(state[name]) for name in LBfgsOptimizerResults._fields])
+        if self.results.position.dtype != self.func.dtype:
+            raise ValueError("the state is {}, but this run is {}".format(self.results.position.dtype.name,
+                                                                         self.func.dtype.name))
+        self.num_restarts = int(state['num_restarts'])
+        self.func.assign_new_model_parameters(self.results.position)
 
+    @property
+    def history(self):
+        if len(self._loss) == 0:
+            return {'iteration': np.zeros(0, dtype=int), 'loss': np.zeros(0)}
+        return {'iteration': np.concatenate(self._iteration), 'loss': np.concatenate(self._loss)}
@@ -1,83 +1,37 @@
-# code comes from: https://github.com/GPflow/GPflow/issues/1604
+import numpy as np
 
-from typing import Sequence, Union, List
-import tensorflow as tf
-import tensorflow_probability as tfp
+from .lbfgs import TFPLBFGS
 
-def pack_tensors(tensors: Sequence[Union[tf.Tensor, tf.Variable]]) -> tf.Tensor:
-    flats = [tf.reshape(tensor, (-1,)) for tensor in tensors]
-    tensors_vector = tf.concat(flats, axis=0)
-    return tensors_vector
 
+class _LossClosureModel(object):
+    """adapts a loss closure and its variables to the `model(x)` calls of `TFPLBFGS`"""
+    def __init__(self, loss_closure, trainable_variables):
+        self.loss_closure = loss_closure
+        self.trainable_variables = list(trainable_variables)
 
-def unpack_tensors(to_tensors: Sequence[Union[tf.Tensor, tf.Variable]], from_vector: tf.Tensor) -> List[tf.Tensor]:
-    s = 0
-    values = []
-    for target_tensor in to_tensors:
-        shape = tf.shape(target_tensor)
-        dtype = target_tensor.dtype
-        tensor_size = tf.reduce_prod(shape)
-        tensor_vector = from_vector[s : s + tensor_size]
-        tensor = tf.reshape(tf.cast(tensor_vector, dtype), shape)
-        values.append(tensor)
-        s += tensor_size
-    return values
+    def __call__(self, x, training=None):
+        return self.loss_closure()
 
 
-def assign_tensors(to_tensors: Sequence[tf.Variable], values: Sequence[tf.Tensor]) -> None:
-    if len(to_tensors) != len(values):
-        raise ValueError("to_tensors and values should have same length")
-    for target, value in zip(to_tensors, values):
-        target.assign(value)
-
+class LBFGSOptimizer(TFPLBFGS):
+    """
+    L-BFGS on a loss closure instead of a keras model and its training demo, e.g., for a loss
+    that is not a mean over points. It is a `TFPLBFGS`, so the state persists across calls of
+    `minimize` (each call runs `steps` more iterations), a failed run restarts, and the loss of
+    every function evaluation is kept on the device and passed to `callback` (see `TFPLBFGS`).
 
-def create_value_and_gradient_function(loss_closure, trainable_variables, verbose=1):
-    """A factory to create a function required by tfp.optimizer.lbfgs_minimize.
     Args:
-        loss_closure:
-        trainable_variables:
-    Returns:
-        A function that has a signature of:
-            loss_value, gradients = f(model_parameters).
+        loss_closure: callable returning the scalar loss.
+        trainable_variables: the variables `loss_closure` is minimized over.
+        steps: number of L-BFGS iterations of a call of `minimize`.
+        dtype: dtype of the L-BFGS state and arithmetic, it does not change `tf.keras.backend.floatx()`.
     """
-    i = tf.Variable(0)
-
-    def assign_param_values_to_variables(x):
-        values = unpack_tensors(trainable_variables, x)
-        assign_tensors(trainable_variables, values)
-
-    @tf.function
-    def f_value_and_gradients(x):
-        """A function that can be used by tfp.optimizer.lbfgs_minimize"""
-        # update params
-        assign_param_values_to_variables(x)
-        # compute loss value and gradients w.r.t. trainable variables
-        with tf.GradientTape(watch_accessed_variables=False) as tape:
-            tape.watch(trainable_variables)
-            loss_value = loss_closure()
-        grads = tape.gradient(loss_value, trainable_variables)
-
-        i.assign_add(1)
-        if verbose > 0:
-            tf.print("Iter:", i, "loss:", loss_value)
-
-        # return loss and flattened gradients
-        return loss_value, pack_tensors(grads)
-
-    return f_value_and_gradients, assign_param_values_to_variables
-
-
-class LBFGSOptimizer(object):
-    def __init__(self, loss_closure, trainable_variables, steps=1):
-        tf.keras.backend.set_floatx("float64")
-        self.initial_position = pack_tensors(trainable_variables)
-        self.results = None
-        func, assign = create_value_and_gradient_function(
-            loss_closure=loss_closure,
-            trainable_variables=trainable_variables
-        )
-        self.func = func
-        self.assign = assign
+    def __init__(self, loss_closure, trainable_variables, steps=1, dtype="float64", display_epoch=1,
+                 callback=None, **kwargs):
+        # the demo is not used, the closure computes the whole loss
+        super(LBFGSOptimizer, self).__init__(_LossClosureModel(loss_closure, trainable_variables),
+                                             lambda loss, y: loss, inps=np.zeros((1, 1)), outs=np.zeros((1, 1)),
+                                             display_epoch=display_epoch, callback=callback, dtype=dtype, **kwargs)
         self.steps = steps
 
     @property
@@ -92,15 +46,5 @@ class LBFGSOptimizer(object):
             return None
         return float(self.results.objective_value.numpy())
 
-    def minimize(self):
-        if self.results is None:
-            initial_poisition = self.initial_position
-        else:
-            initial_poisition = None
-        self.results = tfp.optimizer.lbfgs_minimize(
-            value_and_gradients_function=self.func,
-            initial_position=initial_poisition,
-            previous_optimizer_results=self.results,
-            max_iterations=tf.cast(self.epoch + self.steps, dtype=tf.int32)
-        )
-        self.assign(self.results.position)
\ No newline at end of file
+    def minimize(self, rounds=1, max_iter=None):
+        return super(LBFGSOptimizer, self).minimize(rounds, self.steps if max_iter is None else max_iter)
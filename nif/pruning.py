@@ -0,0 +1,168 @@
+__all__ = ["PruningScheduler", "polynomial_sparsity", "measure_latency"]
+
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def polynomial_sparsity(epoch, initial_sparsity, final_sparsity, begin_epoch, end_epoch, power=3):
+    """
+    sparsity at `epoch`, going from `initial_sparsity` at `begin_epoch` to `final_sparsity` at
+    `end_epoch` as `s_f + (s_i - s_f)*(1 - t)**power` (Zhu & Gupta, 2017), `power=3` is the cubic schedule.
+    """
+    t = np.clip((epoch - begin_epoch)/max(end_epoch - begin_epoch, 1), 0., 1.)
+    return final_sparsity + (initial_sparsity - final_sparsity)*(1. - t)**power
+
+
+def measure_latency(model, inputs, n_iters=20):
+    """mean time in seconds of a compiled forward pass of `model` on `inputs`"""
+    inputs = tf.constant(inputs)
+    forward = tf.function(lambda x: model(x, training=False))
+    forward(inputs).numpy()
+    t0 = time.perf_counter()
+    for _ in range(n_iters):
+        y = forward(inputs)
+    y.numpy()
+    return (time.perf_counter() - t0)/n_iters
+
+
+class PruningScheduler(tf.keras.callbacks.Callback):
+    """
+    iterative pruning and finetuning of a `PNIF` during `fit`.
+
+    every `frequency` epochs from `begin_epoch` to `end_epoch`, the masks are updated to the
+    sparsity given by the schedule, the epochs in between finetune the pruned model. At the end
+    of each stage (i.e., before the next pruning step and at the end of training), the model is
+    compacted with `PNIF.compact` and the stage is logged in `history`: sparsity, loss, number of
+    nonzero and compacted parameters and the measured latency of the compacted model on
+    `latency_inputs`. `best_stage` then picks the fastest stage within an error budget.
+
+    Args:
+        final_sparsity: sparsity reached at `end_epoch`.
+        begin_epoch, end_epoch, frequency: pruning steps are at `begin_epoch + i*frequency <= end_epoch`.
+        initial_sparsity: sparsity of the schedule at `begin_epoch`.
+        schedule: 'cubic' or 'polynomial' (with `power`).
+        ranking: 'layer' or 'global', see `PNIF.update_masks`.
+        shape_net: 'columns' or 'neurons', see `PNIF.update_masks`.
+        rewind_epoch: if not `None`, the weights at the beginning of this epoch are saved and the
+            unpruned weights are rewound to them after each pruning step (lottery ticket rewinding).
+            The optimizer slots (e.g., the Adam moments) are reset to zero at each rewind, they were
+            accumulated for the weights before rewinding. The iteration count and the learning rate
+            schedule are not rewound.
+        validation_data: `(x, y)` used for the loss of each stage, the training loss is used if `None`.
+        latency_inputs: inputs on which the latency is measured, no latency is logged if `None`.
+        verbose: print each stage.
+
+    Example:
+    ```python
+    pruning = PruningScheduler(0.9, begin_epoch=100, end_epoch=1000, frequency=100,
+                               ranking='global', latency_inputs=train_data[:4096, :2])
+    model_ori.fit(train_dataset, epochs=1200, callbacks=[pruning])
+    stage = pruning.best_stage(error_budget=1e-3)
+    model_fast = stage['model']
+    ```
+    """
+    def __init__(self, final_sparsity, begin_epoch=0, end_epoch=1000, frequency=100, initial_sparsity=0.,
+                 schedule='cubic', power=3, ranking='layer', shape_net='columns', rewind_epoch=None,
+                 validation_data=None, latency_inputs=None, verbose=True):
+        super(PruningScheduler, self).__init__()
+        if schedule not in ['cubic', 'polynomial']:
+            raise ValueError("schedule can only be 'cubic' or 'polynomial'")
+        self.final_sparsity = final_sparsity
+        self.begin_epoch = begin_epoch
+        self.end_epoch = end_epoch
+        self.frequency = frequency
+        self.initial_sparsity = initial_sparsity
+        self.power = 3 if schedule == 'cubic' else power
+        self.ranking = ranking
+        self.shape_net = shape_net
+        self.rewind_epoch = rewind_epoch
+        self.validation_data = validation_data
+        self.latency_inputs = latency_inputs
+        self.verbose = verbose
+
+        self.rewind_weights = None
+        self.sparsity = 0.
+        self.history = []
+
+    def sparsity_at(self, epoch):
+        return polynomial_sparsity(epoch, self.initial_sparsity, self.final_sparsity,
+                                   self.begin_epoch, self.end_epoch, self.power)
+
+    def is_pruning_epoch(self, epoch):
+        return self.begin_epoch <= epoch <= self.end_epoch and (epoch - self.begin_epoch) % self.frequency == 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if epoch == self.rewind_epoch:
+            self.rewind_weights = [v.numpy() for v in self.model.trainable_variables]
+        if not self.is_pruning_epoch(epoch):
+            return
+        if epoch > self.begin_epoch:
+            self._log_stage(epoch)
+
+        self.sparsity = self.sparsity_at(epoch)
+        self.model.update_masks(self.sparsity, ranking=self.ranking, shape_net=self.shape_net)
+        if self.rewind_weights is not None:
+            # pruned weights are multiplied by a zero mask, so the whole variables can be rewound
+            for v, w in zip(self.model.trainable_variables, self.rewind_weights):
+                v.assign(w)
+            self._reset_optimizer_slots()
+
+    def _reset_optimizer_slots(self):
+        optimizer = getattr(self.model.optimizer, 'inner_optimizer', self.model.optimizer)
+        if optimizer is None:
+            return
+        if hasattr(optimizer, 'get_slot_names'):
+            slots = []
+            for name in optimizer.get_slot_names():
+                for v in self.model.trainable_variables:
+                    try:
+                        slots.append(optimizer.get_slot(v, name))
+                    except KeyError:
+                        # OptimizerV2 creates the slots of a variable at its first update
+                        pass
+        else:
+            slots = [v for v in optimizer.variables if v is not optimizer.iterations]
+        for slot in slots:
+            slot.assign(tf.zeros_like(slot))
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.last_logs = logs
+
+    def on_train_end(self, logs=None):
+        self._log_stage(None)
+
+    def _log_stage(self, epoch):
+        if self.validation_data is not None:
+            loss = self.model.evaluate(*self.validation_data, verbose=0)
+            loss = loss[0] if isinstance(loss, list) else loss
+        else:
+            loss = getattr(self, 'last_logs', None) or {}
+            loss = loss.get('loss', np.nan)
+
+        model_compact = self.model.compact()
+        stage = {'epoch': epoch,
+                 'sparsity': float(self.sparsity),
+                 'loss': float(loss),
+                 'n_params': int(sum(np.prod(v.shape) for v in self.model.trainable_variables)),
+                 'n_params_nonzero': int(sum(np.count_nonzero(w) for l in self.model.pnet_list
+                                             for w in l.effective_weights())),
+                 'n_params_compact': int(sum(np.prod(v.shape) for v in model_compact.trainable_variables)),
+                 'latency': None,
+                 'model': model_compact}
+        if self.latency_inputs is not None:
+            stage['latency'] = measure_latency(model_compact, self.latency_inputs)
+        self.history.append(stage)
+        if self.verbose:
+            print("pruning stage: sparsity = {:.3f}, loss = {:4.3e}, parameters = {:d} (compact: {:d}), "
+                  "latency = {}".format(stage['sparsity'], stage['loss'], stage['n_params_nonzero'],
+                                        stage['n_params_compact'],
+                                        'n/a' if stage['latency'] is None else '{:.3e} s'.format(stage['latency'])))
+
+    def best_stage(self, error_budget):
+        """the stage with the smallest latency (or number of compacted parameters) whose loss is within `error_budget`"""
+        stages = [s for s in self.history if s['loss'] <= error_budget]
+        if len(stages) == 0:
+            return None
+        key = 'latency' if self.latency_inputs is not None else 'n_params_compact'
+        return min(stages, key=lambda s: s[key])
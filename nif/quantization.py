@@ -0,0 +1,207 @@
+__all__ = ["quantize_per_row", "dequantize", "QuantizedDense", "quantize_head", "save_quantized",
+           "load_quantized", "quantization_report"]
+
+import numpy as np
+import tensorflow as tf
+
+from .layers import MaskLayer, ActiveColumnDense, ShardedHyperLinearForSIREN
+
+
+def quantize_per_row(w, dtype='int8', group_sizes=None):
+    """
+    quantize a `[n_in, n_out]` kernel with one scale per row and group of columns.
+
+    each column of the hypernetwork head generates one shapenet weight or bias, whose magnitude
+    differs by orders between layers, so the columns are split in groups of `group_sizes` (e.g.,
+    the segments of `ShapeNetWeightLayout`), by default a single group, i.e., one scale per row.
+    The scales are `[n_in, n_groups]`, negligible next to the int8 kernel.
+
+    Returns:
+        `(q, scale)`, `scale` is `None` for 'float16'
+    """
+    w = np.asarray(w, dtype=np.float32)
+    if dtype == 'float16':
+        return w.astype(np.float16), None
+    if dtype != 'int8':
+        raise ValueError("dtype can only be 'int8' or 'float16'")
+    group_sizes = [w.shape[1]] if group_sizes is None else group_sizes
+    starts = np.cumsum([0] + list(group_sizes[:-1]))
+    scale = np.maximum.reduceat(np.abs(w), starts, axis=1)/127.
+    scale[scale == 0] = 1.
+    q = np.clip(np.rint(w/np.repeat(scale, group_sizes, axis=1)), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def dequantize(q, scale, group_sizes=None):
+    if scale is None:
+        return q.astype(np.float32)
+    group_sizes = [q.shape[1]] if group_sizes is None else group_sizes
+    return q.astype(np.float32)*np.repeat(scale, group_sizes, axis=1)
+
+
+class QuantizedDense(tf.keras.layers.Layer):
+    """
+    linear layer with an int8 (per row and group scale) or float16 kernel and a float16 bias, dequantized on the fly.
+
+    with `block_size`, the kernel is dequantized `block_size` columns at a time, so a float copy
+    of the whole kernel never exists. With `index`, only the active columns are stored and computed,
+    as in `ActiveColumnDense`.
+    """
+    def __init__(self, q, scale, q_b, scale_b, mixed_policy, group_sizes=None, block_size=None, index=None):
+        super(QuantizedDense, self).__init__(dtype=mixed_policy)
+        self.mixed_policy = mixed_policy
+        self.compute_Dtype = self.mixed_policy.compute_dtype
+        self.variable_Dtype = self.mixed_policy.variable_dtype
+        self.block_size = block_size
+        self.q = tf.Variable(q, trainable=False)
+        self.scale = None if scale is None else tf.Variable(scale, trainable=False)
+        # group of each column
+        group_sizes = [q.shape[1]] if group_sizes is None else group_sizes
+        self.group_index = tf.constant(np.repeat(np.arange(len(group_sizes), dtype=np.int32), group_sizes))
+        self.q_b = tf.Variable(q_b, trainable=False)
+        self.scale_b = None if scale_b is None else tf.Variable(scale_b, trainable=False)
+        self.index = None if index is None else tf.Variable(index, trainable=False)
+
+    def _dequantize(self, q, scale, start, stop):
+        w = tf.cast(q[:, start:stop], self.compute_Dtype)
+        if scale is not None:
+            w = w*tf.cast(tf.gather(scale, self.group_index[start:stop], axis=1), self.compute_Dtype)
+        return w
+
+    def call(self, x, **kwargs):
+        n_out = self.q.shape[1]
+        block_size = n_out if self.block_size is None else self.block_size
+        y = [tf.matmul(x, self._dequantize(self.q, self.scale, i, i + block_size)) for i in range(0, n_out, block_size)]
+        y = y[0] if len(y) == 1 else tf.concat(y, axis=-1)
+        y = y + self._dequantize(self.q_b, self.scale_b, 0, n_out)[0]
+        if self.index is not None:
+            y = tf.gather(tf.concat([y, tf.zeros_like(y[:, :1])], axis=-1), self.index, axis=-1)
+        return y
+
+
+def _head_kernel_and_bias(model):
+    head = model.pnet_list[-1]
+    kernel = [v for v in head.trainable_variables if v.shape.rank == 2]
+    bias = [v for v in head.trainable_variables if v.shape.rank == 1]
+    if len(kernel) != 1 or len(bias) != 1:
+        raise ValueError("the last layer of parameter_net must have exactly one kernel and one bias")
+    return kernel[0], bias[0]
+
+
+def _head_values(model):
+    """
+    the kernel and bias the last layer of parameter_net computes, as numpy arrays, and the column
+    `index` of an `ActiveColumnDense` (`None` otherwise). The mask of a `MaskLayer` is applied.
+    """
+    head = model.pnet_list[-1]
+    if isinstance(head, QuantizedDense):
+        raise ValueError("the last layer of parameter_net is already quantized")
+    if isinstance(head, MaskLayer):
+        return head.effective_weights() + (None,)
+    if isinstance(head, ShardedHyperLinearForSIREN):
+        return head.full_weights() + (None,)
+    kernel, bias = _head_kernel_and_bias(model)
+    index = head.index.numpy() if isinstance(head, ActiveColumnDense) else None
+    return kernel.numpy(), bias.numpy(), index
+
+
+def _head_value(model, v):
+    # a pruned weight of a `MaskLayer` head is quantized as zero, so it stays pruned and does not widen the scales
+    head = model.pnet_list[-1]
+    if isinstance(head, MaskLayer) and v is head.w:
+        return head.effective_weights()[0]
+    return v.numpy()
+
+
+def _head_group_sizes(model, kernel):
+    # one group per segment of the shapenet weight layout, if the head generates it
+    layout = getattr(model, 'weight_layout', None)
+    if layout is None or kernel.shape[1] != layout.po_dim:
+        return None
+    return layout.sizes
+
+
+def quantize_head(model, dtype='int8', block_size=None):
+    """
+    replace the last layer of parameter_net of a trained `model` by a `QuantizedDense`, for inference.
+    the model should not be trained afterward.
+
+    what the head computes is quantized: the pruned weights of a `MaskLayer` (PNIF) are zeros, an
+    `ActiveColumnDense` (NIFCompact) keeps its column index, a `ShardedHyperLinearForSIREN` is gathered
+    on one device.
+    """
+    kernel, bias, index = _head_values(model)
+    group_sizes = _head_group_sizes(model, kernel)
+    q, scale = quantize_per_row(kernel, dtype, group_sizes)
+    q_b, scale_b = quantize_per_row(bias[np.newaxis], 'float16')
+    model.pnet_list[-1] = QuantizedDense(q, scale, q_b, scale_b, model.mixed_policy, group_sizes, block_size, index)
+    return model
+
+
+def save_quantized(model, path, dtype='int8'):
+    """
+    save the weights of `model` as a `.npz` bundle, the kernel of the last layer of parameter_net
+    (the bulk of the model) is stored as int8 with per row scales or as float16, its bias as float16
+    (the generated shapenet weights are mostly the bias, int8 is too coarse for it), the rest as is.
+    """
+    head = _head_kernel_and_bias(model)
+    group_sizes = _head_group_sizes(model, head[0])
+    arrays = {}
+    for i, v in enumerate(model.weights):
+        name = 'w_{}'.format(i)
+        if any(v is h for h in head):
+            q, scale = quantize_per_row(np.reshape(_head_value(model, v), (-1, v.shape[-1])),
+                                        dtype if v is head[0] else 'float16', group_sizes)
+            arrays[name + '_q'] = q
+            if scale is not None:
+                arrays[name + '_scale'] = scale
+        else:
+            arrays[name] = v.numpy()
+    if group_sizes is not None:
+        arrays['head_group_sizes'] = np.array(group_sizes)
+    np.savez(path, **arrays)
+
+
+def load_quantized(model, path):
+    """load a bundle of `save_quantized` into a built `model` of the same configuration, the head is dequantized"""
+    bundle = np.load(path)
+    group_sizes = bundle['head_group_sizes'] if 'head_group_sizes' in bundle else None
+    for i, v in enumerate(model.weights):
+        name = 'w_{}'.format(i)
+        if name + '_q' in bundle:
+            scale = bundle[name + '_scale'] if name + '_scale' in bundle else None
+            v.assign(np.reshape(dequantize(bundle[name + '_q'], scale, group_sizes), v.shape))
+        else:
+            v.assign(bundle[name])
+    return model
+
+
+def quantization_report(model, inputs, dtype='int8'):
+    """
+    size and accuracy delta of quantizing the head of `model`, evaluated on `inputs`.
+    the weights of `model` are restored afterward.
+    """
+    head = _head_kernel_and_bias(model)
+    group_sizes = _head_group_sizes(model, head[0])
+    u = model(inputs).numpy()
+    head_values = [v.numpy() for v in head]
+    n_bytes_q = 0
+    for v, w in zip(head, head_values):
+        q, scale = quantize_per_row(np.reshape(_head_value(model, v), (-1, w.shape[-1])),
+                                    dtype if v is head[0] else 'float16', group_sizes)
+        n_bytes_q += q.nbytes + (0 if scale is None else scale.nbytes)
+        v.assign(np.reshape(dequantize(q, scale, group_sizes), w.shape))
+    u_q = model(inputs).numpy()
+    for v, w in zip(head, head_values):
+        v.assign(w)
+
+    n_bytes_head = sum(w.nbytes for w in head_values)
+    n_bytes = sum(v.numpy().nbytes for v in model.weights)
+    return {'dtype': dtype,
+            'head_bytes': int(n_bytes_head),
+            'head_bytes_quantized': int(n_bytes_q),
+            'model_bytes': int(n_bytes),
+            'model_bytes_quantized': int(n_bytes - n_bytes_head + n_bytes_q),
+            'compression': n_bytes/(n_bytes - n_bytes_head + n_bytes_q),
+            'max_abs_error': float(np.abs(u_q - u).max()),
+            'relative_l2_error': float(np.linalg.norm(u_q - u)/np.linalg.norm(u))}
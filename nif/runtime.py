@@ -0,0 +1,173 @@
+"""
+numpy runtime for models exported by `nif.export.export_frozen`, it does not need tensorflow.
+
+```python
+from nif.runtime import FrozenNIF
+model = FrozenNIF('model.nifz')
+u = model(inputs)  # [batch, pi_dim + si_dim] -> [batch, so_dim]
+```
+"""
+__all__ = ["FrozenNIF", "read_frozen"]
+
+import json
+import numpy as np
+
+MAGIC = b'NIFFROZEN\x01'
+ALIGNMENT = 64
+
+
+def _sigmoid(x):
+    return 0.5*(np.tanh(0.5*x) + 1.)
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'swish': lambda x: x*_sigmoid(x),
+    'relu': lambda x: np.maximum(x, 0.),
+    'tanh': np.tanh,
+    'sigmoid': _sigmoid,
+    'elu': lambda x: np.where(x > 0, x, np.expm1(np.minimum(x, 0.))),
+    'softplus': lambda x: np.logaddexp(x, 0.),
+    'sine': np.sin,
+}
+
+
+def read_frozen(path):
+    """returns `(header, arrays)`, the arrays are read-only views of a memory map of the file"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a frozen NIF model".format(path))
+        n_header = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(n_header).decode('utf-8'))
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, a in header['arrays'].items():
+        n_bytes = int(np.prod(a['shape']))*np.dtype(a['dtype']).itemsize
+        start = header['data_offset'] + a['offset']
+        arrays[name] = buffer[start:start + n_bytes].view(a['dtype']).reshape(a['shape'])
+    return header, arrays
+
+
+class FrozenNIF(object):
+    """
+    evaluate an exported NIF model with numpy.
+
+    the exported submodels are available as `p_to_lr`, `lr_to_w` and `x_to_u_given_w`,
+    `w` is `pnet_output` (or the latent representation for `NIFMultiScaleLastLayerParameterized`).
+    """
+    def __init__(self, path):
+        self.header, self.arrays = read_frozen(path)
+        self.pi_dim = self.header['pi_dim']
+        self.si_dim = self.header['si_dim']
+        self.so_dim = self.header['so_dim']
+        self.pnet = self.header['parameter_net']
+        self.shape_net = self.header['shape_net']
+
+    def _a(self, name):
+        return self.arrays[name]
+
+    def _call_layer(self, layer, x):
+        kind = layer['type']
+        act = ACTIVATIONS[layer.get('activation', 'linear')]
+        if kind == 'dense':
+            return act(x @ self._a(layer['w']) + self._a(layer['b']))
+        if kind == 'shortcut':
+            return x + act(x @ self._a(layer['w']) + self._a(layer['b']))
+        if kind == 'resnet':
+            h = act(x @ self._a(layer['w']) + self._a(layer['b']))
+            return act(x + h @ self._a(layer['w2']) + self._a(layer['b2']))
+        if kind == 'siren':
+            if layer['linear']:
+                return x @ self._a(layer['w']) + self._a(layer['b'])
+            return np.sin(layer['omega_0']*(x @ self._a(layer['w'])) + self._a(layer['b']))
+        if kind == 'siren_resnet':
+            h = np.sin(layer['omega_0']*(x @ self._a(layer['w'])) + self._a(layer['b']))
+            return 0.5*(x + np.sin(layer['omega_0']*(h @ self._a(layer['w2'])) + self._a(layer['b2'])))
+        if kind == 'active_columns':
+            y = x @ self._a(layer['w']) + self._a(layer['b'])
+            y = np.concatenate([y, np.zeros_like(y[:, :1])], axis=-1)
+            return y[:, self._a(layer['index'])]
+        raise ValueError("unknown layer type {}".format(kind))
+
+    def p_to_lr(self, p):
+        lr = np.asarray(p, dtype=self.header['dtype']).reshape(-1, self.pi_dim)
+        for layer in self.pnet[:-1]:
+            lr = self._call_layer(layer, lr)
+        return lr
+
+    def lr_to_w(self, lr):
+        return self._call_layer(self.pnet[-1], lr)
+
+    def p_to_w(self, p):
+        return self.lr_to_w(self.p_to_lr(p))
+
+    def _unpack(self, w):
+        out = {}
+        for s in self.shape_net['layout']:
+            out[s['name']] = w[:, s['offset']:s['offset'] + s['size']].reshape([w.shape[0]] + s['shape'])
+        return out
+
+    def x_to_u_given_w(self, x, w):
+        """
+        `x` is `[n_snapshots, n_points, si_dim]` with `w` `[n_snapshots, po_dim]`, i.e., one GEMM per
+        snapshot, or point-wise, `[batch, si_dim]` with one row of `w` per point.
+        """
+        x = np.asarray(x, dtype=self.header['dtype'])
+        point_wise = x.ndim == 2
+        if point_wise:
+            x = x[:, np.newaxis]
+        u = getattr(self, '_shape_net_' + self.shape_net['type'])(x, np.asarray(w))
+        return u[:, 0] if point_wise else u
+
+    def _shape_net_nif(self, x, w):
+        t = self._unpack(w)
+        act = ACTIVATIONS[self.shape_net['activation']]
+        bias = lambda b: b[:, np.newaxis]
+        u = act(x @ t['w_1'] + bias(t['b_1']))
+        for name in self.shape_net['hidden_names']:
+            u = act(u @ t['w_' + name] + bias(t['b_' + name])) + u
+        return u @ t['w_l'] + bias(t['b_l'])
+
+    def _shape_net_siren(self, x, w):
+        t = self._unpack(w)
+        omega_0 = self.shape_net['omega_0']
+        bias = lambda b: b[:, np.newaxis]
+        u = np.sin(omega_0*(x @ t['w_1']) + bias(t['b_1']))
+        names = self.shape_net['hidden_names']
+        if self.shape_net['resblock']:
+            for name_0, name_1 in zip(names[::2], names[1::2]):
+                h = np.sin(omega_0*(u @ t['w_' + name_0]) + bias(t['b_' + name_0]))
+                u = 0.5*(u + np.sin(omega_0*(h @ t['w_' + name_1]) + bias(t['b_' + name_1])))
+        else:
+            for name in names:
+                u = np.sin(omega_0*(u @ t['w_' + name]) + bias(t['b_' + name]))
+        return u @ t['w_l'] + bias(t['b_l'])
+
+    def _shape_net_last_layer(self, x, w):
+        n_snapshots, n_points = x.shape[:2]
+        phi_x = x.reshape(-1, self.si_dim)
+        for layer in self.shape_net['layers']:
+            phi_x = self._call_layer(layer, phi_x)
+        phi_x = phi_x.reshape(n_snapshots, n_points*self.so_dim, -1)
+        u = (phi_x @ w[:, :, np.newaxis]).reshape(n_snapshots, n_points, self.so_dim)
+        return u + self._a(self.shape_net['bias'])
+
+    def predict(self, p, x):
+        """
+        evaluate the field at points `x` `[n_points, si_dim]` for each parameter in `p`.
+        Returns `[n_points, so_dim]` for a single parameter vector, `[n_snapshots, n_points, so_dim]` otherwise.
+        """
+        single = np.ndim(p) == 1
+        w = self.p_to_w(p)
+        x = np.broadcast_to(np.asarray(x, dtype=self.header['dtype']), (w.shape[0],) + np.shape(x))
+        u = self.x_to_u_given_w(x, w)
+        return u[0] if single else u
+
+    def __call__(self, inputs):
+        """same as calling the original model on point-wise `[batch, pi_dim + si_dim]` inputs"""
+        inputs = np.asarray(inputs, dtype=self.header['dtype'])
+        p, x = inputs[:, :self.pi_dim], inputs[:, self.pi_dim:self.pi_dim + self.si_dim]
+        # the parameter net only runs once per unique parameter
+        p_unique, idx = np.unique(p, axis=0, return_inverse=True)
+        w = self.p_to_w(p_unique)
+        return self.x_to_u_given_w(x, w[idx.ravel()])
@@ -0,0 +1,8 @@
+import nif
+
+# logical CPU devices for the sharded layers, it has to be done before tensorflow creates any tensor
+N_CPU_DEVICES = 3
+
+
+def pytest_configure(config):
+    nif.configure_devices(verbose=False, n_cpu_devices=N_CPU_DEVICES)
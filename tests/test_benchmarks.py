@@ -0,0 +1,18 @@
+import pytest
+
+from nif.benchmarks import benchmark_case_isolated, run_grid
+
+
+def test_run_grid_measures_memory_per_case():
+    small, large = run_grid(['nif'], ['traveling_wave'], [8, 128], [2], [1024], [64], n_iters=1,
+                            phases=['forward'], verbose=False)
+    for result in [small, large]:
+        assert result['forward']['points_per_sec'] > 0
+        assert 0 <= result['case_rss_mb'] <= result['peak_rss_mb']
+    # each case runs in a new process, so the smaller model does not report the peak of the larger one
+    assert small['case_rss_mb'] < large['case_rss_mb']
+
+
+def test_benchmark_case_isolated_raises_the_error_of_the_case():
+    with pytest.raises(RuntimeError, match='unknown variant'):
+        benchmark_case_isolated('no_such_variant', 'traveling_wave', 8, 2, 64, 8, 1, ['forward'])
@@ -0,0 +1,240 @@
+import os
+
+import numpy as np
+import pytest
+
+from nif.demo import PointWiseData, write_columnar, convert_npz_to_columnar, load_columnar
+from nif.demo.columnar import iter_row_chunks, _open_npz_member
+
+
+def point_wise_arrays(n_rows=600, n_snapshots=7, seed=0):
+    rng = np.random.default_rng(seed)
+    p = rng.integers(0, n_snapshots, (n_rows, 1)).astype(np.float64)
+    x = rng.standard_normal((n_rows, 2))
+    u = rng.standard_normal((n_rows, 2))
+    w = rng.uniform(0.5, 1.5, n_rows)
+    return p, x, u, w
+
+
+def write_columnar_data(tmp_path, area_weighted=False):
+    p, x, u, w = point_wise_arrays()
+    write_columnar(str(tmp_path), p, x, u, w if area_weighted else None, chunk_size=128)
+    reference = PointWiseData(p, x, u, w[:, None] if area_weighted else None)
+    reference.normalize('minmax', n_target=1, area_weighted=area_weighted)
+    return reference
+
+
+def load_columnar_data(tmp_path, area_weighted=False, **kwargs):
+    data = PointWiseData.__new__(PointWiseData)
+    data.load_columnar(str(tmp_path), 'minmax', n_target=1, area_weighted=area_weighted, chunk_size=100, **kwargs)
+    return data
+
+
+@pytest.mark.parametrize('area_weighted', [False, True])
+def test_load_columnar_normalizes_like_normalize(tmp_path, area_weighted):
+    reference = write_columnar_data(tmp_path, area_weighted)
+    files = sorted(os.listdir(tmp_path))
+    os.chmod(tmp_path, 0o555)
+    try:
+        # nothing is written next to the data, so read-only directories work
+        data = load_columnar_data(tmp_path, area_weighted)
+    finally:
+        os.chmod(tmp_path, 0o755)
+    assert sorted(os.listdir(tmp_path)) == files
+
+    order = reference.snapshot_order
+    assert data.data.shape == reference.data.shape
+    assert data.data.dtype == reference.data.dtype
+    np.testing.assert_allclose(np.asarray(data.data), reference.data[order], atol=1e-12)
+    np.testing.assert_allclose(np.asarray(data.x), reference.x[order], atol=1e-12)
+    np.testing.assert_allclose(data.data[np.array([[3, 1], [5, 4]])], reference.data[order][[[3, 1], [5, 4]]],
+                               atol=1e-12)
+    if area_weighted:
+        np.testing.assert_allclose(np.asarray(data.sample_weight), reference.sample_weight[order], atol=1e-12)
+
+
+class RecordReads(object):
+    """a raw column that counts how often it is read"""
+    def __init__(self, column):
+        self.column, self.shape, self.n_reads = column, column.shape, 0
+
+    def __getitem__(self, index):
+        self.n_reads += 1
+        return self.column[index]
+
+
+def test_normalized_rows_read_each_column_once(tmp_path):
+    reference = write_columnar_data(tmp_path, area_weighted=True)
+    data = load_columnar_data(tmp_path, area_weighted=True)
+    raw_columns = data.data.raw_columns
+    assert raw_columns is data.sample_weight.raw_columns
+    raw_columns[:] = [RecordReads(c) for c in raw_columns]
+
+    rows = np.sort(np.random.default_rng(0).choice(600, (3, 5), replace=False), axis=-1)
+    order = reference.snapshot_order
+    np.testing.assert_allclose(data.data[rows], reference.data[order][rows], atol=1e-12)
+    assert [c.n_reads for c in raw_columns] == [1, 1, 1, 0]
+    np.testing.assert_allclose(data.sample_weight[rows], reference.sample_weight[order][rows], atol=1e-12)
+    assert [c.n_reads for c in raw_columns] == [1, 1, 1, 1]
+    np.testing.assert_allclose(data.u[rows], reference.u[order][rows], atol=1e-12)
+    assert [c.n_reads for c in raw_columns] == [1, 1, 2, 1]
+
+
+def test_load_columnar_cache_path(tmp_path):
+    reference = write_columnar_data(tmp_path)
+    cache_path = str(tmp_path/'normalized.npy')
+    data = load_columnar_data(tmp_path, cache_path=cache_path)
+    assert isinstance(data.data, np.memmap)
+    mtime = os.path.getmtime(cache_path)
+    # an existing cache is reused
+    data = load_columnar_data(tmp_path, cache_path=cache_path)
+    assert os.path.getmtime(cache_path) == mtime
+    np.testing.assert_allclose(data.data, reference.data[reference.snapshot_order], atol=1e-12)
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('area_weighted', [False, True])
+def test_columnar_round_trip(tmp_path, area_weighted, compressed):
+    p, x, u, w = point_wise_arrays()
+    columns = [p, x, u] + ([w[:, None]] if area_weighted else [])
+    npz_path = str(tmp_path/'data.npz')
+    (np.savez_compressed if compressed else np.savez)(npz_path, data=np.hstack(columns))
+    meta = convert_npz_to_columnar(npz_path, str(tmp_path/'columnar'), 1, 2, 2, sample_weight=area_weighted,
+                                   chunk_size=128)
+    loaded_meta, loaded, offsets = load_columnar(str(tmp_path/'columnar'))
+    assert loaded_meta == meta
+    # the decompressed copy of a compressed `.npz` is removed
+    assert sorted(os.listdir(tmp_path/'columnar')) == sorted([name + '.npy' for name in meta['columns']] +
+                                                             ['meta.json', 'snapshot_offsets.npy'])
+    assert (meta['n_rows'], meta['n_p'], meta['n_x'], meta['n_o']) == (len(p), 1, 2, 2)
+
+    # rows are grouped by snapshot, in a stable order within each snapshot
+    order = np.argsort(p[:, 0], kind='stable')
+    for name, column in zip(meta['columns'], columns):
+        assert isinstance(loaded[name], np.memmap)
+        np.testing.assert_array_equal(loaded[name], column[order])
+    np.testing.assert_array_equal(offsets, np.concatenate([[0], np.cumsum(np.bincount(p[:, 0].astype(int)))]))
+    for i in range(len(offsets) - 1):
+        assert np.all(loaded['parameter'][offsets[i]:offsets[i + 1]] == loaded['parameter'][offsets[i]])
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+@pytest.mark.parametrize('fortran_order', [False, True])
+def test_open_npz_member(tmp_path, compressed, fortran_order):
+    data = np.arange(60, dtype=np.float32).reshape(12, 5)
+    data = np.asfortranarray(data) if fortran_order else data
+    npz_path = str(tmp_path/'data.npz')
+    (np.savez_compressed if compressed else np.savez)(npz_path, other=np.ones(3), data=data)
+    member = _open_npz_member(npz_path, 'data', str(tmp_path/'scratch'), chunk_size=7)
+    assert isinstance(member, np.memmap)
+    assert os.path.exists(tmp_path/'scratch') == compressed
+    np.testing.assert_array_equal(member, data)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 600])
+def test_write_columnar_orders_snapshots_like_unique(tmp_path, chunk_size):
+    rng = np.random.default_rng(0)
+    # two parameter columns with negative values, snapshots interleaved across chunks
+    p = rng.choice(np.array([[0.5, -1.], [-0.5, 2.], [-0.5, -2.], [0., 0.]]), 40)
+    x = np.arange(40, dtype=np.float64)[:, None]
+    meta = write_columnar(str(tmp_path), p, x, x, chunk_size=chunk_size)
+    _, loaded, offsets = load_columnar(str(tmp_path))
+    unique, inverse, counts = np.unique(p, axis=0, return_inverse=True, return_counts=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    assert meta['n_rows'] == 40
+    np.testing.assert_array_equal(offsets, np.concatenate([[0], np.cumsum(counts)]))
+    np.testing.assert_array_equal(loaded['parameter'], p[order])
+    np.testing.assert_array_equal(loaded['x'], x[order])
+
+
+@pytest.mark.parametrize('chunk_size', [1, 128, 150, 600, 1000])
+def test_iter_row_chunks(chunk_size):
+    p, x, u, w = point_wise_arrays()
+    chunks = list(iter_row_chunks([p, x, u], chunk_size))
+    assert [len(c) for c in chunks] == [min(chunk_size, len(p) - i) for i in range(0, len(p), chunk_size)]
+    assert all(c.dtype == np.float64 for c in chunks)
+    np.testing.assert_array_equal(np.concatenate(chunks), np.hstack([p, x, u]))
+
+
+def snapshot_data(tmp_path, columnar, n_snapshots=8, n_points=12):
+    # x[:, 0] identifies the row
+    rng = np.random.default_rng(0)
+    p = np.repeat(np.arange(n_snapshots, dtype=np.float64)[:, None], n_points, axis=0)
+    perm = rng.permutation(len(p))
+    p = p[perm]
+    x = np.stack([np.arange(len(p), dtype=np.float64), rng.standard_normal(len(p))], axis=-1)
+    u = rng.standard_normal((len(p), 2))
+    if columnar:
+        write_columnar(str(tmp_path), p, x, u)
+        data = PointWiseData.__new__(PointWiseData)
+        data.load_columnar(str(tmp_path))
+    else:
+        data = PointWiseData(p, x, u)
+        data.normalize()
+    return data
+
+
+def seen_rows(data, dataset, n_batches):
+    rows = []
+    for x, u in dataset.take(n_batches):
+        x = data.scaler.inverse_transform(x.numpy(), columns=slice(0, data.n_p + data.n_x))
+        # the points of one snapshot in a batch share the parameter
+        assert np.all(x[:, :, 0] == x[:, :1, 0])
+        rows.append(np.rint(x[..., data.n_p]).astype(int).ravel())
+    return np.concatenate(rows)
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+@pytest.mark.parametrize('shuffle_points', [False, True])
+def test_snapshot_dataset_visits_each_row_once(tmp_path, columnar, shuffle_points):
+    data = snapshot_data(tmp_path, columnar)
+    n_rows = 8*12
+    # K=2 snapshots of M=4 points, 12 points per snapshot: 3 chunks per snapshot, 12 batches per epoch
+    dataset = data.snapshot_dataset(2, 4, shuffle_points=shuffle_points, seed=0)
+    batches = list(dataset)
+    assert len(batches) == n_rows//8
+    assert batches[0][0].shape == (2, 4, 3)
+    assert sorted(seen_rows(data, dataset, len(batches))) == list(range(n_rows))
+
+
+def sort_points(batch):
+    """the tensors of a batch with the points of each snapshot sorted by x, their order does not matter"""
+    order = np.argsort(batch[0].numpy()[..., 1], axis=-1)
+    return [np.take_along_axis(t.numpy(), order.reshape(order.shape + (1,)*(t.ndim - 2)), axis=1) for t in batch]
+
+
+def test_snapshot_dataset_in_memory_matches_columnar(tmp_path):
+    p, x, u, w = point_wise_arrays(n_rows=96, n_snapshots=6)
+    write_columnar(str(tmp_path), p, x, u, w)
+    columnar = PointWiseData.__new__(PointWiseData)
+    columnar.load_columnar(str(tmp_path), 'minmax', n_target=1, area_weighted=True)
+    in_memory = PointWiseData(p, x, u, w[:, None])
+    in_memory.normalize('minmax', n_target=1, area_weighted=True)
+
+    datasets = [data.snapshot_dataset(2, 5, seed=3) for data in [in_memory, columnar]]
+    # in-memory rows are gathered with tensorflow ops, which do not hold the GIL, columnar rows with numpy
+    graphs = [d._as_serialized_graph().numpy() for d in datasets]
+    assert b'PyFunc' not in graphs[0] and b'PyFunc' in graphs[1]
+    n_batches = 0
+    for a, b in zip(*datasets):
+        n_batches += 1
+        assert len(a) == len(b) == 3
+        for a_i, b_i in zip(sort_points(a), sort_points(b)):
+            np.testing.assert_allclose(a_i, b_i, rtol=1e-6)
+    assert n_batches == 11
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_snapshot_dataset_shards_and_repeat(tmp_path, columnar):
+    data = snapshot_data(tmp_path, columnar)
+    n_rows = 8*12
+    shard_rows = []
+    for shard_index in range(2):
+        dataset = data.snapshot_dataset(2, 4, seed=shard_index, num_shards=2, shard_index=shard_index, repeat=True)
+        # two epochs of the shard: 4 snapshots, 3 batches of 2 snapshots each per epoch
+        rows = seen_rows(data, dataset, 2*6)
+        counts = np.bincount(rows, minlength=n_rows)
+        assert set(counts[counts > 0]) == {2}
+        shard_rows.append(set(np.flatnonzero(counts)))
+    assert shard_rows[0].isdisjoint(shard_rows[1])
+    assert shard_rows[0] | shard_rows[1] == set(range(n_rows))
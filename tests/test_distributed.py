@@ -0,0 +1,33 @@
+import numpy as np
+
+from nif.distributed import run_local_workers
+
+
+def train_worker(strategy, worker_index, n_workers, snapshots_per_batch, points_per_snapshot):
+    import tensorflow as tf
+    from nif.benchmarks.scaling import synthetic_point_wise_data
+    from nif.benchmarks.throughput import make_model
+    data = synthetic_point_wise_data('traveling_wave', 8, 32)
+    dataset = data.snapshot_dataset(n_workers*snapshots_per_batch, points_per_snapshot, seed=worker_index,
+                                    num_shards=n_workers, shard_index=worker_index, repeat=True)
+    with strategy.scope():
+        model = make_model('nif', 'traveling_wave', 8, 1)
+        model.compile(tf.keras.optimizers.SGD(1e-2), 'mse')
+        model(next(iter(dataset))[0])
+    # the points of the batch of each replica, i.e., what a worker trains on per step
+    replica_batch = next(iter(strategy.experimental_distribute_dataset(dataset)))[0]
+    n_points = [int(np.prod(x.shape[:2])) for x in strategy.experimental_local_results(replica_batch)]
+    initial_weights = model.get_weights()
+    history = model.fit(dataset, epochs=1, steps_per_epoch=4, verbose=0)
+    return n_points, initial_weights, model.get_weights(), history.history['loss']
+
+
+def test_two_workers_train_in_sync():
+    results = run_local_workers(train_worker, 2, args=(2, 16), threads_per_worker=1, timeout=600)
+    for n_points, initial_weights, weights, loss in results:
+        assert n_points == [2*16]
+        assert np.all(np.isfinite(loss))
+        assert any(not np.allclose(w0, w) for w0, w in zip(initial_weights, weights))
+    # the replicas start from and stay at the same weights
+    for a, b in zip(results[0][1] + results[0][2], results[1][1] + results[1][2]):
+        np.testing.assert_allclose(a, b, rtol=1e-6, atol=1e-7)
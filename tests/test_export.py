@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import nif
+from nif.export import export_frozen
+from nif.quantization import quantize_head
+from nif.runtime import FrozenNIF
+
+from .test_model import cfg_shape_net, cfg_parameter_net, snapshot_batch
+
+cfg_siren_shape_net = dict(cfg_shape_net, use_resblock=False, omega_0=30., weight_init_factor=0.01)
+cfg_siren_parameter_net = dict(cfg_parameter_net, activation='sine', omega_0=30., use_resblock=False)
+
+
+def pruned_pnif():
+    model = nif.PNIF(cfg_shape_net, cfg_parameter_net)
+    model(snapshot_batch()[0])
+    model.update_masks(0.5)
+    return model
+
+
+def quantized(model, dtype='int8'):
+    model(snapshot_batch()[0])
+    quantize_head(model, dtype)
+    return model
+
+
+def sharded():
+    devices = [device.name for device in tf.config.list_logical_devices('CPU')]
+    return nif.NIFMultiScale(cfg_siren_shape_net, dict(cfg_parameter_net, use_resblock=False, head_devices=devices))
+
+
+# model and the layer types its frozen parameter net (and last-layer shapenet) is made of
+models = {
+    'shortcut': (lambda: nif.NIF(cfg_shape_net, cfg_parameter_net), {'dense', 'shortcut'}),
+    'resnet': (lambda: nif.NIFMultiScale(cfg_siren_shape_net, dict(cfg_parameter_net, use_resblock=True)),
+               {'dense', 'resnet'}),
+    'siren': (lambda: nif.NIFMultiScale(cfg_siren_shape_net, cfg_siren_parameter_net), {'dense', 'siren'}),
+    'siren_resnet': (lambda: nif.NIFMultiScale(dict(cfg_siren_shape_net, use_resblock=True),
+                                               dict(cfg_siren_parameter_net, use_resblock=True)),
+                     {'dense', 'siren', 'siren_resnet'}),
+    'last_layer': (lambda: nif.NIFMultiScaleLastLayerParameterized(
+        dict(cfg_siren_shape_net, connectivity='last_layer'),
+        dict(cfg_parameter_net, latent_dim=3, use_resblock=False)), {'dense', 'shortcut', 'siren'}),
+    'last_layer_resnet': (lambda: nif.NIFMultiScaleLastLayerParameterized(
+        dict(cfg_siren_shape_net, connectivity='last_layer', use_resblock=True),
+        dict(cfg_parameter_net, latent_dim=3, use_resblock=False)), {'dense', 'shortcut', 'siren', 'siren_resnet'}),
+    'masked': (pruned_pnif, {'dense'}),
+    'active_columns': (lambda: pruned_pnif().compact(), {'dense', 'active_columns'}),
+    'sharded': (sharded, {'dense', 'shortcut'}),
+    'quantized': (lambda: quantized(nif.NIF(cfg_shape_net, cfg_parameter_net)), {'dense', 'shortcut'}),
+    'quantized_float16': (lambda: quantized(nif.NIFMultiScale(cfg_siren_shape_net, cfg_siren_parameter_net),
+                                            'float16'), {'dense', 'siren'}),
+    'quantized_active_columns': (lambda: quantized(pruned_pnif().compact()), {'dense', 'active_columns'}),
+}
+
+
+@pytest.mark.parametrize('name', list(models))
+def test_frozen_model_matches_tensorflow(tmp_path, name):
+    build, layer_types = models[name]
+    model = build()
+    data, _ = snapshot_batch()
+    u = model(data).numpy()
+
+    path = str(tmp_path/'model.nifz')
+    header = export_frozen(model, path)
+    frozen = FrozenNIF(path)
+    layers = header['parameter_net'] + header['shape_net'].get('layers', [])
+    assert {layer['type'] for layer in layers} == layer_types
+    assert frozen.header == header
+
+    np.testing.assert_allclose(frozen(data), u, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(frozen.p_to_w(data[:, :1]), model._call_parameter_net(data[:, :1], model.pnet_list)[0],
+                               rtol=1e-4, atol=1e-5)
+    p = np.array([[0.1], [-0.4]], dtype='float32')
+    x = np.linspace(-1, 1, 20, dtype='float32')[:, None]
+    np.testing.assert_allclose(frozen.predict(p, x), model.predict_field(p, x), rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(frozen.predict(p[0], x), frozen.predict(p, x)[0], rtol=1e-5, atol=1e-6)
+
+
+def test_read_frozen_rejects_other_files(tmp_path):
+    path = tmp_path/'model.nifz'
+    path.write_bytes(b'not a frozen model')
+    with pytest.raises(ValueError):
+        FrozenNIF(str(path))
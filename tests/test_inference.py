@@ -0,0 +1,31 @@
+import numpy as np
+
+import nif
+from nif.inference import NIFInference
+
+from .test_model import cfg_shape_net, cfg_parameter_net
+
+
+def test_inference_traces_once():
+    model = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    engine = NIFInference(model)
+    rng = np.random.default_rng(0)
+    for n_snapshots, n_points in [(1, 10), (2, 10), (3, 25), (5, 7)]:
+        p = rng.uniform(-1, 1, (n_snapshots, 1))
+        x = rng.uniform(-1, 1, (n_points, 1))
+        u = engine.predict(p, x)
+        np.testing.assert_allclose(u, model.predict_field(p, x), atol=1e-6)
+    assert engine._p_to_w.experimental_get_tracing_count() == 1
+    assert engine._x_to_u.experimental_get_tracing_count() == 1
+
+
+def test_inference_cache_owns_its_entries():
+    model = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    engine = NIFInference(model, max_entries=2)
+    w = engine.weights(np.array([[0.1], [0.2], [0.3]]))
+    # each entry is its own buffer, so `nbytes` is the memory held and an eviction frees it
+    for w_row in engine._cache.values():
+        assert w_row.base is None
+    assert engine.nbytes == 2*w.shape[1]*w.itemsize
+    assert engine.cache_info()['evictions'] == 1
+    np.testing.assert_array_equal(engine.weights(np.array([[0.3]]))[0], w[2])
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import nif
+from nif.layers import HyperLinearForSIREN, ShardedHyperLinearForSIREN
+
+from .conftest import N_CPU_DEVICES
+from .test_model import cfg_shape_net, cfg_parameter_net
+
+
+def same_device(a, b):
+    a, b = tf.DeviceSpec.from_string(a), tf.DeviceSpec.from_string(b)
+    return (a.device_type, a.device_index) == (b.device_type, b.device_index)
+
+
+@pytest.mark.parametrize('use_resblock', [False, True])
+def test_sharded_hyper_linear_matches_unsharded(use_resblock):
+    devices = [device.name for device in tf.config.list_logical_devices('CPU')]
+    assert len(devices) == N_CPU_DEVICES
+    cfg_s = dict(cfg_shape_net, use_resblock=use_resblock, omega_0=30., weight_init_factor=0.01)
+    cfg_p = dict(cfg_parameter_net, use_resblock=False, head_devices=devices)
+    model = nif.NIFMultiScale(cfg_s, cfg_p)
+    sharded = model.pnet_list[-1]
+    assert isinstance(sharded, ShardedHyperLinearForSIREN)
+    for device, w, b in zip(devices, sharded.w_list, sharded.b_list):
+        assert same_device(w.device, device) and same_device(b.device, device)
+
+    unsharded = HyperLinearForSIREN(model.pi_hidden, model.po_dim, cfg_s, model.mixed_policy)
+    w, b = sharded.full_weights()
+    unsharded.w.assign(w)
+    unsharded.b.assign(b)
+
+    x = tf.constant(np.random.default_rng(0).normal(size=(5, model.pi_hidden)).astype('float32'))
+    # a different weight on each column of pnet_output, so that a misplaced column changes the gradients
+    v = tf.constant(np.random.default_rng(1).normal(size=(model.po_dim,)).astype('float32'))
+    outputs, gradients = [], []
+    for layer, variables in [(sharded, sharded.w_list + sharded.b_list), (unsharded, [unsharded.w, unsharded.b])]:
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            y = layer(x)
+            loss = tf.reduce_sum(tf.sin(y)*v)
+        dx, *dvariables = tape.gradient(loss, [x] + variables)
+        outputs.append(y.numpy())
+        gradients.append((dx.numpy(), dvariables))
+
+    np.testing.assert_allclose(outputs[0], outputs[1], rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(gradients[0][0], gradients[1][0], rtol=1e-5, atol=1e-6)
+    # gather the shard gradients back into the columns of the unsharded kernel and bias
+    dw, db = np.zeros_like(w), np.zeros_like(b)
+    n_shards = len(sharded.w_list)
+    for segments, dw_shard, db_shard in zip(sharded.shard_segments, gradients[0][1][:n_shards],
+                                            gradients[0][1][n_shards:]):
+        columns = np.concatenate([np.arange(s.offset, s.offset + s.size) for s in segments])
+        dw[:, columns] = dw_shard.numpy()
+        db[columns] = db_shard.numpy()
+    np.testing.assert_allclose(dw, gradients[1][1][0].numpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(db, gradients[1][1][1].numpy(), rtol=1e-5, atol=1e-6)
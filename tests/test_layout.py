@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from nif.layout import ShapeNetWeightLayout
+
+# (si_dim, so_dim, n_sx, l_sx)
+dims = [(1, 1, 8, 2), (2, 3, 4, 3), (3, 2, 5, 0)]
+
+
+def baseline_slices(si_dim, so_dim, n_sx, l_sx, resblock):
+    """the hand-written slicing of `pnet_output` the models used before the layout, as numpy index ranges"""
+    n_hidden = 2*l_sx if resblock else l_sx
+    w_1 = (0, si_dim*n_sx, (si_dim, n_sx))
+    w_hidden = [(si_dim*n_sx + i*n_sx**2, si_dim*n_sx + (i + 1)*n_sx**2, (n_sx, n_sx)) for i in range(n_hidden)]
+    w_l = (si_dim*n_sx + n_hidden*n_sx**2, si_dim*n_sx + n_hidden*n_sx**2 + so_dim*n_sx, (n_sx, so_dim))
+    n_weights = si_dim*n_sx + n_hidden*n_sx**2 + so_dim*n_sx
+    b_1 = (n_weights, n_weights + n_sx, (n_sx,))
+    b_hidden = [(n_weights + n_sx + i*n_sx, n_weights + n_sx + (i + 1)*n_sx, (n_sx,)) for i in range(n_hidden)]
+    b_l = (n_weights + (n_hidden + 1)*n_sx, n_weights + (n_hidden + 1)*n_sx + so_dim, (so_dim,))
+    return [w_1] + w_hidden + [w_l, b_1] + b_hidden + [b_l]
+
+
+def flatten(tensors, resblock):
+    w_1, w_hidden_list, w_l, b_1, b_hidden_list, b_l = tensors
+    if resblock:
+        w_hidden_list = [w for pair in w_hidden_list for w in pair]
+        b_hidden_list = [b for pair in b_hidden_list for b in pair]
+    return [w_1] + list(w_hidden_list) + [w_l, b_1] + list(b_hidden_list) + [b_l]
+
+
+@pytest.mark.parametrize('resblock', [False, True])
+@pytest.mark.parametrize('dim', dims)
+def test_sizes_match_baseline_slicing(dim, resblock):
+    layout = ShapeNetWeightLayout(*dim, resblock=resblock)
+    slices = baseline_slices(*dim, resblock)
+    assert layout.sizes == [stop - start for start, stop, _ in slices]
+    assert layout.offsets == [start for start, _, _ in slices]
+    assert [s.shape for s in layout.segments] == [shape for _, _, shape in slices]
+    assert layout.po_dim == slices[-1][1] == sum(layout.sizes)
+    assert layout.n_weights == layout.segment('b_1').offset
+
+
+@pytest.mark.parametrize('snapshot_major', [False, True])
+@pytest.mark.parametrize('resblock', [False, True])
+@pytest.mark.parametrize('dim', dims)
+def test_unpack_matches_baseline_slicing(dim, resblock, snapshot_major):
+    layout = ShapeNetWeightLayout(*dim, resblock=resblock)
+    pnet_output = np.random.RandomState(0).randn(5, layout.po_dim).astype('float32')
+    tensors = layout.unpack(pnet_output, snapshot_major=snapshot_major)
+    w_hidden_list, b_hidden_list = tensors[1], tensors[4]
+    assert len(w_hidden_list) == len(b_hidden_list) == dim[3]
+    if resblock:
+        assert all(len(pair) == 2 for pair in w_hidden_list + b_hidden_list)
+
+    for tensor, (start, stop, shape) in zip(flatten(tensors, resblock), baseline_slices(*dim, resblock)):
+        expected = pnet_output[:, start:stop].reshape([-1] + list(shape))
+        if len(shape) == 1 and snapshot_major:
+            expected = expected[:, None, :]
+        np.testing.assert_array_equal(tensor.numpy(), expected)
+
+
+@pytest.mark.parametrize('resblock', [False, True])
+@pytest.mark.parametrize('dim', dims)
+def test_layer_segments(dim, resblock):
+    layout = ShapeNetWeightLayout(*dim, resblock=resblock)
+    names = layout.layer_names
+    assert len(names) == 2 + len(layout.hidden_names)
+    for name in names:
+        segments = layout.layer_segments([name])
+        assert [s.name for s in segments] == ['w_' + name, 'b_' + name]
+    # all layers cover each column of pnet_output once, in order
+    segments = layout.layer_segments(names)
+    assert segments == layout.segments
+    columns = np.concatenate([layout.columns(s.name).ravel() for s in segments])
+    np.testing.assert_array_equal(columns, np.arange(layout.po_dim))
+
+
+@pytest.mark.parametrize('resblock', [False, True])
+@pytest.mark.parametrize('dim', dims)
+def test_shard_layers(dim, resblock):
+    layout = ShapeNetWeightLayout(*dim, resblock=resblock)
+    names = layout.layer_names
+    for n_shards in range(1, len(names) + 1):
+        shards = layout.shard_layers(n_shards)
+        assert len(shards) == n_shards
+        assert all(len(shard) > 0 for shard in shards)
+        # contiguous groups of layers, in order
+        assert sum(shards, []) == names
+        columns = np.sort(np.concatenate([layout.columns(s.name).ravel()
+                                          for shard in shards for s in layout.layer_segments(shard)]))
+        np.testing.assert_array_equal(columns, np.arange(layout.po_dim))
+    assert layout.shard_layers(1) == [names]
+    assert layout.shard_layers(len(names)) == [[name] for name in names]
+    for n_shards in [0, len(names) + 1]:
+        with pytest.raises(ValueError):
+            layout.shard_layers(n_shards)
+
+
+def test_shard_layers_balances_columns():
+    # 1 -> 64 -> 64 -> 64 -> 1: the two hidden layers hold almost all columns
+    layout = ShapeNetWeightLayout(1, 1, 64, 2)
+    assert layout.shard_layers(2) == [['1', 'hidden_0'], ['hidden_1', 'l']]
+    assert layout.shard_layers(3) == [['1', 'hidden_0'], ['hidden_1'], ['l']]
+
+
+def test_import_does_not_import_tensorflow():
+    code = ("import sys; import nif, nif.demo, nif.runtime; nif.ShapeNetWeightLayout(1, 1, 4, 1).po_dim; "
+            "assert 'tensorflow' not in sys.modules")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    result = subprocess.run([sys.executable, '-c', code], env=env, cwd=root, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from nif.optimizers import LBFGSOptimizer, TFPLBFGS
+from nif.optimizers.lbfgs import _fixed_subsample
+
+
+def test_lbfgs_optimizer_on_closure():
+    v = tf.Variable([3., -2.])
+    opt = LBFGSOptimizer(lambda: tf.reduce_sum((v - [1., 2.])**2) + tf.reduce_sum(v**4)/10., [v], steps=5,
+                         callback=lambda *args: None)
+    assert isinstance(opt, TFPLBFGS)
+    opt.minimize()
+    assert 0 < opt.epoch <= 5
+    loss_5 = opt.loss
+    # the next call continues the same run
+    opt.minimize()
+    assert opt.epoch > 5 or opt.results.converged.numpy()
+    assert opt.loss <= loss_5
+    assert opt.results.position.dtype == tf.float64
+    np.testing.assert_allclose(v.numpy(), opt.results.position.numpy(), rtol=1e-6)
+    assert len(opt.history['loss']) > 0
+
+
+def regression_problem(n=50, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(-1, 1, (n, 2))
+    y = np.sin(3*x[:, :1]) + x[:, 1:]**2
+    tf.random.set_seed(seed)
+    model = tf.keras.Sequential([tf.keras.layers.Dense(8, 'tanh', dtype='float64'),
+                                 tf.keras.layers.Dense(1, dtype='float64')])
+    model(x[:1])
+    return model, x, y
+
+
+def mse(y_pred, y):
+    return tf.reduce_mean(tf.square(y_pred - y))
+
+
+def quiet(*args):
+    pass
+
+
+@pytest.mark.parametrize('chunked', ['chunk_size', 'dataset', 'callable'])
+def test_chunked_objective_matches_full_batch(chunked):
+    model, x, y = regression_problem()
+    full = TFPLBFGS(model, mse, x, y, callback=quiet)
+    if chunked == 'chunk_size':
+        # 50 points in uneven chunks of 7
+        opt = TFPLBFGS(model, mse, x, y, chunk_size=7, callback=quiet)
+    elif chunked == 'dataset':
+        opt = TFPLBFGS(model, mse, dataset=tf.data.Dataset.from_tensor_slices((x, y)).batch(7), callback=quiet)
+    else:
+        opt = TFPLBFGS(model, mse, dataset=lambda: ((x[i:i + 7], y[i:i + 7]) for i in range(0, 50, 7)),
+                       callback=quiet)
+    params = full.func.pack(model.trainable_variables)
+    for position in [params, params + 0.1]:
+        loss_full, grads_full = full.func(position)
+        loss, grads = opt.func(position)
+        np.testing.assert_allclose(loss.numpy(), loss_full.numpy(), rtol=1e-7)
+        np.testing.assert_allclose(grads.numpy(), grads_full.numpy(), rtol=1e-7, atol=1e-12)
+
+
+@pytest.mark.parametrize('from_dataset', [False, True])
+def test_subsample(from_dataset):
+    model, x, y = regression_problem()
+    if from_dataset:
+        opt = TFPLBFGS(model, mse, dataset=tf.data.Dataset.from_tensor_slices((x, y)).batch(7), subsample=12,
+                       seed=1, callback=quiet)
+        x_sample, y_sample = _fixed_subsample(tf.data.Dataset.from_tensor_slices((x, y)).batch(7).as_numpy_iterator(),
+                                              12, seed=1)
+    else:
+        opt = TFPLBFGS(model, mse, x, y, subsample=12, seed=1, callback=quiet)
+        keep = np.sort(np.random.default_rng(1).choice(50, 12, replace=False))
+        x_sample, y_sample = x[keep], y[keep]
+    assert x_sample.shape == (12, 2)
+    # the sample are distinct points of the data
+    assert len({tuple(row) for row in x_sample}) == 12
+    assert all(np.any(np.all(x == row, axis=1)) for row in x_sample)
+
+    # the objective is the loss on the subsample, not on all points
+    loss, _ = opt.func(opt.func.pack(model.trainable_variables))
+    np.testing.assert_allclose(loss.numpy(), mse(model(x_sample), y_sample).numpy(), rtol=1e-12)
+    assert abs(loss.numpy() - mse(model(x), y).numpy()) > 1e-6
+
+
+def test_fixed_subsample_is_uniform():
+    x = np.arange(50)[:, None]
+    chunks = [(x[i:i + 7], x[i:i + 7]) for i in range(0, 50, 7)]
+    counts = np.zeros(50)
+    for seed in range(2000):
+        x_sample, y_sample = _fixed_subsample(chunks, 10, seed)
+        np.testing.assert_array_equal(x_sample, y_sample)
+        # kept in the order of the data
+        assert np.all(np.diff(x_sample[:, 0]) > 0)
+        counts[x_sample[:, 0]] += 1
+    np.testing.assert_allclose(counts/2000, 10/50, atol=0.05)
+
+
+def test_read_history_wraps_around_the_ring_buffer():
+    model, x, y = regression_problem()
+    opt = TFPLBFGS(model, mse, x, y, history_capacity=5, callback=quiet)
+    params = opt.func.pack(model.trainable_variables)
+    positions = [params + 0.01*i for i in range(10)]
+    losses = [opt.func(p)[0].numpy() for p in positions[:3]]
+    iteration, loss = opt.func.read_history()
+    np.testing.assert_array_equal(iteration, [1, 2, 3])
+    np.testing.assert_array_equal(loss, losses)
+
+    # 7 more evaluations overwrite the buffer, only the last 5 are kept
+    losses = [opt.func(p)[0].numpy() for p in positions[3:]]
+    iteration, loss = opt.func.read_history()
+    np.testing.assert_array_equal(iteration, [6, 7, 8, 9, 10])
+    np.testing.assert_array_equal(loss, losses[-5:])
+
+    # nothing new since the last read
+    iteration, loss = opt.func.read_history()
+    assert iteration.shape == loss.shape == (0,)
+    np.testing.assert_array_equal(opt.func(positions[0])[0].numpy(), opt.func.read_history()[1][0])
+
+
+@pytest.mark.parametrize('history_capacity', [4, 100000])
+def test_callback_gets_the_history_of_each_round(history_capacity):
+    model, x, y = regression_problem()
+    calls = []
+
+    def callback(round, iteration, loss):
+        calls.append((round, iteration, loss, int(opt.func.iter.numpy())))
+
+    opt = TFPLBFGS(model, mse, x, y, callback=callback, history_capacity=history_capacity)
+    opt.minimize(rounds=3, max_iter=5)
+    assert [c[0] for c in calls] == list(range(len(calls))) and len(calls) > 1
+    n_previous = 0
+    for _, iteration, loss, n_iter in calls:
+        # the evaluations of the round, at most the last `history_capacity` of them
+        n_round = min(n_iter - n_previous, history_capacity)
+        np.testing.assert_array_equal(iteration, np.arange(n_iter - n_round + 1, n_iter + 1))
+        assert loss.shape == iteration.shape and np.all(np.isfinite(loss))
+        n_previous = n_iter
+    np.testing.assert_array_equal(opt.history['iteration'], np.concatenate([c[1] for c in calls]))
+    np.testing.assert_array_equal(opt.history['loss'], np.concatenate([c[2] for c in calls]))
+    if history_capacity > n_previous:
+        np.testing.assert_array_equal(opt.history['iteration'], np.arange(1, n_previous + 1))
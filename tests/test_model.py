@@ -0,0 +1,259 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import nif
+
+cfg_shape_net = {
+    "connectivity": 'full',
+    "input_dim": 1,
+    "output_dim": 1,
+    "units": 8,
+    "nlayers": 2,
+    "activation": 'swish'
+}
+cfg_parameter_net = {
+    "input_dim": 1,
+    "latent_dim": 1,
+    "units": 8,
+    "nlayers": 2,
+    "activation": 'swish'
+}
+
+
+def snapshot_batch(n_snapshots=4, n_points=16, seed=0):
+    rng = np.random.default_rng(seed)
+    p = np.repeat(rng.uniform(-1, 1, (n_snapshots, 1)), n_points, axis=0)
+    x = rng.uniform(-1, 1, (n_snapshots*n_points, 1))
+    u = np.sin(3*x + p)
+    return np.hstack([p, x]).astype('float32'), u.astype('float32')
+
+
+def test_group_by_parameter_with_jit_compile_train_step():
+    data, u = snapshot_batch()
+    grouped = nif.NIF(cfg_shape_net, cfg_parameter_net, group_by_parameter=True)
+    reference = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    grouped(data[:2])
+    reference(data[:2])
+    reference.set_weights(grouped.get_weights())
+
+    grouped.compile(tf.keras.optimizers.SGD(1e-2), 'mse', jit_compile_train_step=True)
+    reference.compile(tf.keras.optimizers.SGD(1e-2), 'mse')
+    h_grouped = grouped.fit(data, u, batch_size=32, epochs=2, shuffle=False, verbose=0)
+    h_reference = reference.fit(data, u, batch_size=32, epochs=2, shuffle=False, verbose=0)
+
+    np.testing.assert_allclose(h_grouped.history['loss'], h_reference.history['loss'], rtol=1e-5)
+    for a, b in zip(grouped.get_weights(), reference.get_weights()):
+        np.testing.assert_allclose(a, b, atol=1e-5)
+
+
+def test_group_by_parameter_matches_ungrouped():
+    rng = np.random.default_rng(1)
+    # two parameter columns, some snapshots share the first one, and the groups have different sizes
+    p = np.repeat(np.array([[0.1, 0.2], [0.1, 0.3], [0.4, 0.2], [0.4, 0.3]]), [3, 8, 13, 8], axis=0)
+    x = rng.uniform(-1, 1, (32, 1))
+    data = tf.constant(np.hstack([p, x])[rng.permutation(32)].astype('float32'))
+    cfg_p = dict(cfg_parameter_net, input_dim=2, use_resblock=False)
+    cfg_s = dict(cfg_shape_net, use_resblock=False, omega_0=30., weight_init_factor=0.01)
+    cfg_ll = dict(cfg_s, connectivity='last_layer')
+    for model_class, cfg_s, cfg_p in [(nif.NIF, cfg_s, cfg_p), (nif.NIFMultiScale, cfg_s, cfg_p),
+                                      (nif.NIFMultiScaleLastLayerParameterized, cfg_ll, dict(cfg_p, latent_dim=3))]:
+        grouped = model_class(cfg_s, cfg_p, group_by_parameter=True)
+        reference = model_class(cfg_s, cfg_p)
+        grouped(data[:2])
+        reference(data[:2])
+        reference.set_weights(grouped.get_weights())
+        with tf.GradientTape(persistent=True) as tape:
+            u_grouped, u_reference = grouped(data), reference(data)
+            loss_grouped, loss_reference = tf.reduce_sum(u_grouped**2), tf.reduce_sum(u_reference**2)
+        # the generated weights are kept per unique parameter, not per point
+        assert grouped.pnet_output.shape[0] == 4
+        assert reference.pnet_output.shape[0] == 32
+        np.testing.assert_allclose(u_grouped.numpy(), u_reference.numpy(), atol=1e-6)
+        for g, r in zip(tape.gradient(loss_grouped, grouped.trainable_variables),
+                        tape.gradient(loss_reference, reference.trainable_variables)):
+            np.testing.assert_allclose(tf.convert_to_tensor(g).numpy(), tf.convert_to_tensor(r).numpy(),
+                                       rtol=1e-4, atol=1e-5)
+
+
+def test_group_by_parameter_buckets_the_compiled_step():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-1, 1, (64, 1))
+    u = tf.constant(np.sin(3*x), tf.float32)
+    grouped = nif.NIF(cfg_shape_net, cfg_parameter_net, group_by_parameter=True)
+    reference = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    grouped.compile(tf.keras.optimizers.SGD(1e-2), 'mse', jit_compile_train_step=True)
+    tracing_counts = []
+    for n_snapshots in [5, 6, 7, 3]:
+        # 5 to 7 snapshots have at most 10 to 13 points, i.e., groups of [8, 16] slots, 3 snapshots [4, 32]
+        data = tf.constant(np.hstack([np.arange(64)[:, None] % n_snapshots, x]), tf.float32)
+        grouped.train_step((data, u))
+        tracing_counts.append(grouped._compiled_loss_and_gradients.experimental_get_tracing_count())
+
+        groups = grouped._group_parameter_rows(data[:, :1], bucket=True)
+        assert groups[1].shape == ((8, 16) if n_snapshots > 4 else (4, 32))
+        reference(data)
+        reference.set_weights(grouped.get_weights())
+        np.testing.assert_allclose(grouped(data, groups=groups).numpy(), reference(data).numpy(), atol=1e-6)
+    # (the first call also traces the creation of the metric and optimizer variables)
+    assert np.diff(tracing_counts).tolist() == [0, 0, 1]
+
+
+@pytest.mark.parametrize('mixed_policy', ['mixed_float16', 'mixed_bfloat16'])
+@pytest.mark.parametrize('model_class', [nif.NIF, nif.NIFMultiScale, nif.PNIF])
+def test_mixed_precision_fit(model_class, mixed_policy):
+    data, u = snapshot_batch()
+    cfg_s, cfg_p = cfg_shape_net, cfg_parameter_net
+    if model_class is nif.NIFMultiScale:
+        cfg_s = dict(cfg_s, use_resblock=False, omega_0=30., weight_init_factor=0.01)
+        cfg_p = dict(cfg_p, use_resblock=False)
+    model = model_class(cfg_s, cfg_p, mixed_policy=mixed_policy)
+    compute_dtype = mixed_policy[len('mixed_'):]
+    model.compile(tf.keras.optimizers.Adam(1e-3), 'mse')
+    # only float16 needs loss scaling
+    loss_scale_optimizer = tf.keras.mixed_precision.LossScaleOptimizer
+    assert isinstance(model.optimizer, loss_scale_optimizer) == (compute_dtype == 'float16')
+    model(data)
+    weights = [v.numpy() for v in model.trainable_variables]
+
+    history = model.fit(data, u, batch_size=16, epochs=2, verbose=0)
+    assert np.all(np.isfinite(history.history['loss']))
+    assert all(np.any(w != v.numpy()) for w, v in zip(weights, model.trainable_variables))
+    assert {v.dtype for v in model.variables if v.trainable} == {tf.float32}
+    assert {l.compute_dtype for l in model.pnet_list} == {compute_dtype}
+    assert model.pnet_output.dtype == compute_dtype
+    assert model(data).dtype == tf.float32
+    if compute_dtype == 'float16':
+        assert model.optimizer.loss_scale > 1
+
+
+def test_predict_field_traces_once():
+    model = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    rng = np.random.default_rng(0)
+    for n_snapshots, n_points, chunk_size in [(1, 50, 16), (3, 50, 16), (2, 70, 32), (4, 9, 100)]:
+        p = rng.uniform(-1, 1, (n_snapshots, 1))
+        x = rng.uniform(-1, 1, (n_points, 1)).astype('float32')
+        u = model.predict_field(p, x, chunk_size=chunk_size)
+        inputs = np.concatenate([np.repeat(p[:, None], n_points, axis=1), np.broadcast_to(x, (n_snapshots,) + x.shape)],
+                                axis=-1).astype('float32')
+        np.testing.assert_allclose(u, np.stack([model(i).numpy() for i in inputs]), atol=1e-6)
+    assert model._predict_field_chunk.experimental_get_tracing_count() == 1
+
+
+def test_predict_field_out(tmp_path):
+    model = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    p = np.array([[0.1], [0.5]])
+    x = np.linspace(-1, 1, 30, dtype='float32')[:, None]
+    expected = model.predict_field(p, x, chunk_size=7)
+
+    out = np.zeros((2, 30, 1), dtype='float64')
+    assert model.predict_field(p, x, chunk_size=7, out=out) is out
+    np.testing.assert_allclose(out, expected)
+    u_single = model.predict_field(p[1], x, out=np.empty((30, 1), dtype='float32'))
+    np.testing.assert_allclose(u_single, expected[1])
+    u_memmap = model.predict_field(p, x, chunk_size=7, out=str(tmp_path/'u.npy'))
+    np.testing.assert_allclose(np.load(tmp_path/'u.npy'), expected)
+    assert isinstance(u_memmap, np.memmap)
+
+    with pytest.raises(ValueError, match='shape'):
+        model.predict_field(p, x, out=np.empty((2, 31, 1), dtype='float32'))
+    with pytest.raises(ValueError, match='C-contiguous'):
+        model.predict_field(p, x, out=np.empty((30, 2, 1), dtype='float32').transpose(1, 0, 2))
+    with pytest.raises(ValueError, match='dtype'):
+        model.predict_field(p, x, out=np.empty((2, 30, 1), dtype='float16'))
+
+
+def last_layer_model():
+    cfg_s = dict(cfg_shape_net, connectivity='last_layer', use_resblock=False, omega_0=30., weight_init_factor=0.01)
+    cfg_p = dict(cfg_parameter_net, latent_dim=3, use_resblock=False)
+    return nif.NIFMultiScaleLastLayerParameterized(cfg_s, cfg_p)
+
+
+def snapshot_major_inputs(p, x):
+    """`[n_snapshots, n_points, pi_dim + si_dim]` of the parameters `p` on the points `x` (shared or per snapshot)"""
+    x = np.broadcast_to(x, (p.shape[0],) + x.shape[-2:])
+    return np.concatenate([np.repeat(p[:, None], x.shape[1], axis=1), x], axis=-1).astype('float32')
+
+
+def test_reconstruct_from_spatial_basis():
+    model = last_layer_model()
+    p = np.array([[0.1], [0.5], [-0.3]], dtype='float32')
+    x = np.linspace(-1, 1, 50, dtype='float32')[:, None]
+    with pytest.raises(RuntimeError):
+        model.reconstruct_from_spatial_basis(p)
+
+    expected = np.stack([model(i).numpy() for i in snapshot_major_inputs(p, x)])
+    model.cache_spatial_basis(x)
+    np.testing.assert_allclose(model.reconstruct_from_spatial_basis(p).numpy(), expected, atol=1e-5)
+    lr = model.model_p_to_lr()(p)
+    np.testing.assert_allclose(model.reconstruct_from_spatial_basis(lr=lr).numpy(), expected, atol=1e-5)
+    # a compact cache is cast chunk by chunk
+    model.cache_spatial_basis(x, dtype='float16', chunk_size=16)
+    u_chunked = model.reconstruct_from_spatial_basis(p, chunk_size=7).numpy()
+    np.testing.assert_allclose(u_chunked, model.reconstruct_from_spatial_basis(p).numpy(), atol=1e-6)
+    np.testing.assert_allclose(u_chunked, expected, atol=1e-2)
+    assert model._phi_x_chunk.experimental_get_tracing_count() == 1
+
+
+def test_last_layer_predict_field_shares_the_basis():
+    model = last_layer_model()
+    p = np.array([[0.1], [0.5], [-0.3]], dtype='float32')
+    x = np.linspace(-1, 1, 50, dtype='float32')[:, None]
+    expected = np.stack([model(i).numpy() for i in snapshot_major_inputs(p, x)])
+    np.testing.assert_allclose(model.predict_field(p, x, chunk_size=16), expected, atol=1e-5)
+
+    phi_x_points = []
+    get_phi_x = model._call_shape_net_get_phi_x
+
+    def counted_get_phi_x(input_s, *args):
+        phi_x_points.append(int(tf.shape(input_s)[0]))
+        return get_phi_x(input_s, *args)
+
+    # eagerly, so every evaluation of phi_x is recorded
+    model._call_shape_net_get_phi_x = counted_get_phi_x
+    lr = model._call_parameter_net(tf.constant(p), model.pnet_list)[0]
+    u = model._call_predict_field_chunk(tf.constant(x), lr)
+    del model._call_shape_net_get_phi_x
+    np.testing.assert_allclose(u.numpy(), expected, atol=1e-5)
+    assert phi_x_points == [50]
+
+
+def test_last_layer_snapshot_major():
+    model = last_layer_model()
+    p = np.array([[0.1], [0.5], [-0.3]], dtype='float32')
+    x = np.random.default_rng(0).uniform(-1, 1, (3, 20, 1)).astype('float32')
+    inputs = snapshot_major_inputs(p, x)
+    expected = np.stack([model(i).numpy() for i in inputs])
+    with tf.GradientTape() as tape:
+        u = model(tf.constant(inputs))
+        loss = tf.reduce_sum(u**2)
+    np.testing.assert_allclose(u.numpy(), expected, atol=1e-5)
+
+    with tf.GradientTape() as tape_point_wise:
+        loss_point_wise = tf.reduce_sum(model(tf.constant(inputs.reshape(-1, 2)))**2)
+    grads = tape.gradient(loss, model.trainable_variables)
+    for a, b in zip(grads, tape_point_wise.gradient(loss_point_wise, model.trainable_variables)):
+        np.testing.assert_allclose(a.numpy(), b.numpy(), rtol=1e-4, atol=1e-5)
+
+    # same in the functional snapshot-major model
+    lr = model.model_p_to_lr()(p)
+    x_to_u = model.model_x_to_u_given_w(snapshot_major=True)
+    np.testing.assert_allclose(x_to_u([x, lr]).numpy(), expected, atol=1e-5)
+
+
+def test_check_snapshot_parameters():
+    model = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    p = np.array([[0.1], [0.5]], dtype='float32')
+    x = np.linspace(-1, 1, 8, dtype='float32')[:, None]
+    inputs = snapshot_major_inputs(p, x)
+    inputs[1, 3, 0] = 0.2
+    # by default the parameter of the first point of each snapshot is used
+    u = model(inputs).numpy()
+    np.testing.assert_allclose(u[1], model(snapshot_major_inputs(p, x))[1].numpy(), atol=1e-6)
+
+    model.check_snapshot_parameters = True
+    with pytest.raises(tf.errors.InvalidArgumentError):
+        model(inputs)
+    with pytest.raises(tf.errors.InvalidArgumentError):
+        tf.function(model)(tf.constant(inputs))
+    np.testing.assert_allclose(model(snapshot_major_inputs(p, x)).numpy()[0], u[0], atol=1e-6)
@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import nif
+from nif.optimizers import L4Adam, AdaBeliefOptimizer
+
+from .test_model import cfg_shape_net, cfg_parameter_net, snapshot_batch
+
+
+def test_l4adam_step_on_quadratic():
+    v = tf.Variable([3., -2.])
+    opt = L4Adam(learning_rate=0.15, gamma_0=0.75, gamma=0.9, tau=1000.)
+    loss = lambda: tf.reduce_sum(v**2) + 1.
+    opt.minimize(loss, [v])
+
+    # first step: the bias corrected moments are g and g**2, so nu = sign(g) and g.nu = |g|_1,
+    # l_min = gamma_0*loss
+    g = np.array([6., -4.])
+    loss_0 = 14.
+    l_min = 0.75*loss_0
+    step_size = 0.15*(loss_0 - 0.9*l_min)/np.abs(g).sum()
+    np.testing.assert_allclose(v.numpy(), [3., -2.] - step_size*np.sign(g), rtol=1e-6)
+    np.testing.assert_allclose(opt.l_min.numpy(), l_min*(1. + 1./1000.), rtol=1e-6)
+    assert int(opt.iterations) == 1
+
+    # second step: l_min is the smaller of the new loss and the (increased) previous l_min
+    loss_1 = float(loss())
+    opt.minimize(loss, [v])
+    np.testing.assert_allclose(opt.l_min.numpy(), min(loss_1, l_min*(1. + 1./1000.))*(1. + 1./1000.), rtol=1e-6)
+
+
+def test_l4adam_clips_the_step_near_a_stationary_point():
+    # the gradient vanishes at the minimum but the loss does not, so g.nu -> 0 and the L4 step blows up
+    def run(max_step_size, n_steps=50):
+        v = tf.Variable([1e-4, -1e-4])
+        opt = L4Adam(max_step_size=max_step_size)
+        loss = lambda: tf.reduce_sum(v**2) + 1.
+        losses = []
+        for _ in range(n_steps):
+            opt.minimize(loss, [v])
+            losses.append(float(loss()))
+        return np.array(losses)
+
+    losses = run(0.1)
+    assert np.all(np.isfinite(losses)) and losses.max() < 2.
+    assert run(1e30)[0] > 1e3
+
+
+def test_l4adam_no_step_against_the_momentum():
+    v = tf.Variable([1., 2.])
+    opt = L4Adam(tau_m=2.)
+    opt.apply_gradients([(tf.ones(2), v)], loss=1.)
+    v_1 = v.numpy()
+    assert np.all(v_1 < [1., 2.])
+    # the momentum still points along the previous gradient, so g.nu < 0
+    opt.apply_gradients([(-0.25*tf.ones(2), v)], loss=1.)
+    np.testing.assert_array_equal(v.numpy(), v_1)
+    np.testing.assert_allclose(opt.get_slot(v, 'g').numpy(), [0.125, 0.125])
+    assert int(opt.iterations) == 2
+
+
+def test_l4adam_requires_loss():
+    v = tf.Variable([1., 2.])
+    with pytest.raises(ValueError):
+        L4Adam().apply_gradients([(tf.ones(2), v)])
+    with pytest.raises(ValueError):
+        L4Adam().apply_gradients([(tf.ones(2), v)], loss=None)
+
+
+def test_l4adam_rejected_with_float16():
+    model = nif.NIF(cfg_shape_net, cfg_parameter_net, mixed_policy='mixed_float16')
+    with pytest.raises(ValueError):
+        model.compile(L4Adam(), 'mse')
+
+
+@pytest.mark.parametrize('jit_compile_train_step', [False, True])
+def test_l4adam_train_step_gets_loss(jit_compile_train_step):
+    data, u = snapshot_batch()
+    model = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    model.compile(L4Adam(learning_rate=0.05), 'mse', jit_compile_train_step=jit_compile_train_step)
+    loss_0 = float(tf.reduce_mean(tf.square(model(data) - u)))
+    # one step on the whole batch, l_min only depends on the loss passed to the optimizer
+    model.fit(data, u, batch_size=len(data), epochs=1, verbose=0)
+    assert int(model.optimizer.iterations) == 1
+    np.testing.assert_allclose(model.optimizer.l_min.numpy(), 0.75*loss_0*(1. + 1./1000.), rtol=1e-5)
+
+
+def _adabelief_steps(fused, n_steps=5, **kwargs):
+    rng = np.random.default_rng(0)
+    var_list = [tf.Variable(rng.standard_normal(shape).astype('float32'))
+                for shape in [(3, 8), (8,), (8, 8), (8,), (8, 2), (2,)]]
+    opt = AdaBeliefOptimizer(1e-2, fused=fused, print_change_log=False, **kwargs)
+
+    @tf.function
+    def step(i):
+        grads = [tf.sin(v*tf.cast(i + 1, tf.float32)) for v in var_list]
+        opt.apply_gradients(zip(grads, var_list))
+
+    for i in range(n_steps):
+        step(tf.constant(i))
+    return [v.numpy() for v in var_list] + [w.numpy() for w in opt.weights]
+
+
+@pytest.mark.parametrize('kwargs', [{},
+                                    {'amsgrad': True},
+                                    {'rectify': False},
+                                    {'weight_decay': 1e-2},
+                                    {'total_steps': 4},
+                                    {'amsgrad': True, 'rectify': False, 'weight_decay': 1e-2}])
+def test_adabelief_fused_matches_per_variable(kwargs):
+    fused = _adabelief_steps(True, **kwargs)
+    per_variable = _adabelief_steps(False, **kwargs)
+    assert len(fused) == len(per_variable)
+    for a, b in zip(fused, per_variable):
+        np.testing.assert_array_equal(a, b)
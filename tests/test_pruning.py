@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from nif.layers import ActiveColumnDense, MaskLayer
+from nif.layers.masklayer import magnitude_mask
+from nif.model import PNIF, NIFCompact
+from nif.pruning import PruningScheduler, polynomial_sparsity
+
+from .test_model import cfg_shape_net, cfg_parameter_net, snapshot_batch
+
+
+def pruned_pnif(data, sparsity=0.5, ranking='layer', shape_net='columns'):
+    model = PNIF(cfg_shape_net, cfg_parameter_net)
+    model(data)
+    model.update_masks(sparsity, ranking=ranking, shape_net=shape_net)
+    return model
+
+
+@pytest.mark.parametrize('sparsity', [0., 0.1, 0.25, 0.5, 0.9, 1.])
+def test_magnitude_mask_prunes_exactly_sparsity(sparsity):
+    # many ties, including at the threshold, and already pruned zeros
+    w_abs = tf.constant([0., 0., 0.3, 0.1, 0.1, 0.1, 0.1, 0.2, 0.2, 0.1, 0.3, 0., 0.2, 0.1, 0.1, 0.1, 0.3, 0.2, 0.1, 0.1])
+    keep = magnitude_mask(w_abs, sparsity).numpy()
+    n_prune = int(round(sparsity*20))
+    assert set(np.unique(keep)) <= {0., 1.}
+    assert np.sum(keep == 0) == n_prune
+    # no kept value is smaller than a pruned one
+    if 0 < n_prune < 20:
+        assert w_abs.numpy()[keep == 1].min() >= w_abs.numpy()[keep == 0].max()
+    # ties are broken by position
+    order = np.argsort(w_abs.numpy(), kind='stable')
+    np.testing.assert_array_equal(np.flatnonzero(keep == 0), np.sort(order[:n_prune]))
+    np.testing.assert_array_equal(tf.function(magnitude_mask)(w_abs, tf.constant(sparsity)).numpy(), keep)
+
+
+def test_prune_low_magnitude_with_ties():
+    layer = MaskLayer(4, 5, None, tf.keras.initializers.Ones(), tf.keras.initializers.Zeros())
+    layer.pruneLowMagnitude(0.3)
+    assert np.sum(layer.mask.numpy() == 0) == 6
+    # already pruned weights count towards the sparsity
+    layer.pruneLowMagnitude(0.5)
+    assert np.sum(layer.mask.numpy() == 0) == 10
+    layer.pruneLowMagnitude(0.2)
+    assert np.sum(layer.mask.numpy() == 0) == 10
+
+
+@pytest.mark.parametrize('ranking', ['layer', 'global'])
+def test_update_masks_prunes_exactly_sparsity(ranking):
+    data, _ = snapshot_batch()
+    model = PNIF(cfg_shape_net, cfg_parameter_net)
+    model(data)
+    # tie every weight of the parameter net but the last layer
+    for layer in model.pnet_list[:-1]:
+        layer.w.assign(tf.fill(layer.w.shape, 0.1))
+    model.update_masks(0.4, ranking=ranking)
+    masks = [layer.mask.numpy() for layer in model.pnet_list[:-1]]
+    if ranking == 'layer':
+        assert [np.sum(m == 0) for m in masks] == [np.round(0.4*m.size) for m in masks]
+    else:
+        assert sum(np.sum(m == 0) for m in masks) == np.round(0.4*sum(m.size for m in masks))
+    # shapenet weights (not biases), one column of the last layer each
+    n_shape_net_weights = model.si_dim*model.n_sx + model.l_sx*model.n_sx**2 + model.so_dim*model.n_sx
+    assert np.sum(np.all(model.pnet_list[-1].mask.numpy() == 0, axis=0)) == np.round(0.4*n_shape_net_weights)
+
+
+@pytest.mark.parametrize('ranking', ['layer', 'global'])
+@pytest.mark.parametrize('shape_net', ['columns', 'neurons'])
+def test_compact_matches_masked_pnif(ranking, shape_net):
+    data, _ = snapshot_batch()
+    model = pruned_pnif(data, 0.6, ranking, shape_net)
+    compact = model.compact()
+    assert isinstance(compact, NIFCompact)
+    # pruned shapenet weights are not computed, removed neurons take all their columns with them
+    assert isinstance(compact.pnet_list[-1], ActiveColumnDense) == (shape_net == 'columns')
+    n_params = sum(np.prod(v.shape) for v in model.trainable_variables)
+    assert sum(np.prod(v.shape) for v in compact.trainable_variables) < n_params
+    if shape_net == 'neurons':
+        assert compact.n_sx < model.n_sx
+    np.testing.assert_allclose(compact(data).numpy(), model(data).numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_compact_unpruned_pnif():
+    data, _ = snapshot_batch()
+    model = PNIF(cfg_shape_net, cfg_parameter_net)
+    model(data)
+    compact = model.compact()
+    assert compact.n_sx == model.n_sx
+    assert not isinstance(compact.pnet_list[-1], ActiveColumnDense)
+    np.testing.assert_allclose(compact(data).numpy(), model(data).numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_pruning_scheduler_sparsity_ramp():
+    data, u = snapshot_batch()
+    model = PNIF(cfg_shape_net, cfg_parameter_net)
+    model.compile(tf.keras.optimizers.Adam(1e-3), 'mse')
+    pruning = PruningScheduler(0.8, begin_epoch=1, end_epoch=5, frequency=2, initial_sparsity=0.2, verbose=False)
+    model.fit(data, u, batch_size=16, epochs=7, verbose=0, callbacks=[pruning])
+
+    ramp = [polynomial_sparsity(epoch, 0.2, 0.8, 1, 5) for epoch in [1, 3, 5]]
+    assert ramp[0] == pytest.approx(0.2) and ramp[-1] == pytest.approx(0.8)
+    assert np.all(np.diff(ramp) > 0)
+    # a stage is logged before each next pruning step and at the end of training
+    assert [stage['epoch'] for stage in pruning.history] == [3, 5, None]
+    np.testing.assert_allclose([stage['sparsity'] for stage in pruning.history], ramp)
+    assert np.all(np.diff([stage['n_params_nonzero'] for stage in pruning.history]) < 0)
+    for layer in model.pnet_list[:-1]:
+        mask = layer.mask.numpy()
+        assert np.sum(mask == 0) == np.round(0.8*mask.size)
+
+
+class RecordEpochBegin(tf.keras.callbacks.Callback):
+    """weights and optimizer slots right after the callbacks before it ran"""
+    def __init__(self):
+        super(RecordEpochBegin, self).__init__()
+        self.weights, self.slots = {}, {}
+
+    def on_epoch_begin(self, epoch, logs=None):
+        optimizer = self.model.optimizer
+        if hasattr(optimizer, 'get_slot_names'):
+            slots = [optimizer.get_slot(v, name) for name in optimizer.get_slot_names()
+                     for v in self.model.trainable_variables] if optimizer.iterations > 0 else []
+        else:
+            slots = [v for v in optimizer.variables if v is not optimizer.iterations]
+        self.weights[epoch] = [v.numpy() for v in self.model.trainable_variables]
+        self.slots[epoch] = [v.numpy() for v in slots]
+
+
+optimizers = [tf.keras.optimizers.Adam]
+if hasattr(tf.keras.optimizers, 'legacy'):
+    optimizers.append(tf.keras.optimizers.legacy.Adam)
+
+
+@pytest.mark.parametrize('optimizer', optimizers)
+def test_pruning_scheduler_rewinds_weights_and_optimizer_slots(optimizer):
+    data, u = snapshot_batch()
+    model = PNIF(cfg_shape_net, cfg_parameter_net)
+    model.compile(optimizer(1e-2), 'mse')
+    pruning = PruningScheduler(0.5, begin_epoch=2, end_epoch=3, frequency=1, rewind_epoch=1, verbose=False)
+    record = RecordEpochBegin()
+    model.fit(data, u, batch_size=16, epochs=4, verbose=0, callbacks=[pruning, record])
+
+    for epoch in [2, 3]:
+        # the whole variables are rewound, pruned weights are then zeroed by the masks
+        for w, w_rewind in zip(record.weights[epoch], pruning.rewind_weights):
+            np.testing.assert_array_equal(w, w_rewind)
+        assert len(record.slots[epoch]) > 0
+        for slot in record.slots[epoch]:
+            np.testing.assert_array_equal(slot, 0.)
+    # training moved away from the rewind point in between
+    assert not np.array_equal(record.weights[1][0], record.weights[0][0])
+    assert any(np.any(slot != 0) for slot in record.slots[1])
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import nif
+from nif.layers import ActiveColumnDense
+from nif.model import PNIF
+from nif.quantization import QuantizedDense, quantize_head, save_quantized, load_quantized, quantization_report
+
+from .test_model import cfg_shape_net, cfg_parameter_net, snapshot_batch
+
+
+def relative_error(u, u_ref):
+    return np.linalg.norm(u - u_ref)/np.linalg.norm(u_ref)
+
+
+def pnet_output(model, data):
+    return model._call_parameter_net(data[:, :model.pi_dim], model.pnet_list)[0].numpy()
+
+
+def pruned_pnif(data, shape_net='columns'):
+    model = PNIF(cfg_shape_net, cfg_parameter_net)
+    model(data)
+    model.update_masks(0.5, shape_net=shape_net)
+    return model
+
+
+@pytest.mark.parametrize('dtype, tolerance', [('int8', 2e-2), ('float16', 1e-3)])
+def test_quantize_plain_head(dtype, tolerance):
+    data, _ = snapshot_batch()
+    model = nif.NIF(cfg_shape_net, cfg_parameter_net)
+    u = model(data).numpy()
+    report = quantization_report(model, data, dtype)
+    np.testing.assert_array_equal(model(data).numpy(), u)
+    assert report['head_bytes_quantized'] < report['head_bytes']
+
+    quantize_head(model, dtype)
+    assert isinstance(model.pnet_list[-1], QuantizedDense)
+    assert pnet_output(model, data).shape == (data.shape[0], model.po_dim)
+    assert relative_error(model(data).numpy(), u) < tolerance
+    assert abs(relative_error(model(data).numpy(), u) - report['relative_l2_error']) < 1e-6
+    with pytest.raises(ValueError):
+        quantize_head(model, dtype)
+
+
+def test_quantize_pruned_pnif_head():
+    data, _ = snapshot_batch()
+    model = pruned_pnif(data)
+    pruned = np.all(pnet_output(model, data) == 0, axis=0)
+    assert pruned.any()
+    u = model(data).numpy()
+
+    quantize_head(model)
+    # pruned shapenet weights stay exactly zero
+    w = pnet_output(model, data)
+    np.testing.assert_array_equal(w[:, pruned], 0.)
+    assert relative_error(model(data).numpy(), u) < 2e-2
+
+
+def test_quantize_compact_head():
+    data, _ = snapshot_batch()
+    model = pruned_pnif(data).compact()
+    assert isinstance(model.pnet_list[-1], ActiveColumnDense)
+    w_ref = pnet_output(model, data)
+    u = model(data).numpy()
+
+    quantize_head(model)
+    w = pnet_output(model, data)
+    assert w.shape == w_ref.shape
+    np.testing.assert_array_equal(w[:, np.all(w_ref == 0, axis=0)], 0.)
+    assert relative_error(model(data).numpy(), u) < 2e-2
+
+
+def test_save_and_load_quantized_pnif(tmp_path):
+    data, _ = snapshot_batch()
+    model = pruned_pnif(data)
+    u = model(data).numpy()
+    save_quantized(model, tmp_path/'model.npz')
+
+    loaded = PNIF(cfg_shape_net, cfg_parameter_net)
+    loaded(data)
+    load_quantized(loaded, tmp_path/'model.npz')
+    for l, l_ref in zip(loaded.pnet_list, model.pnet_list):
+        np.testing.assert_array_equal(l.mask.numpy(), l_ref.mask.numpy())
+    np.testing.assert_array_equal(pnet_output(loaded, data) == 0, pnet_output(model, data) == 0)
+    assert relative_error(loaded(data).numpy(), u) < 2e-2
@@ -1,5 +1,6 @@
 import tensorflow as tf
 import nif
+nif.configure_devices()
 import numpy as np
 import time
 import logging
@@ -86,7 +87,7 @@ class LossAndErrorPrintingCallback(tf.keras.callbacks.Callback):
             tnow = time.time()
             te = tnow - self.ts
             logging.info("Epoch {:6d}: avg.loss pe = {:4.3e}, {:d} points/sec, time elapsed = {:4.3f} hours".format(
-                epoch, logs['loss'], int(batch_size / te), (tnow - self.train_begin_time) / 3600.0))
+                epoch, logs['loss'], int(num_total_data / te), (tnow - self.train_begin_time) / 3600.0))
             self.history_loss.append(logs['loss'])
         if epoch % print_figure_epoch == 0:
             plt.figure()